@@ -0,0 +1,81 @@
+"""
+Benchmark write time, read time and size of snapshot files for the available
+compression codecs on synthetic snapshots shaped like watcher outputs.
+
+Usage (from the repository root): python -m benchmarks.bench_codecs [n-rows]
+"""
+
+import hashlib
+import json
+import random
+import sys
+import time
+from diffport.compression import ZlibCodec, decode, encode, get_codec, train_zdict
+
+
+def synthetic_items(n_rows: int, seed: int):
+    """
+    Return watcher items similar to what the watchers save
+    """
+
+    rng = random.Random(seed)
+    row_hash = lambda: hashlib.md5(str(rng.random()).encode("utf-8")).hexdigest()
+    tables = [f"original_data.table_{idx}" for idx in range(200)]
+
+    return [{
+        "watcher": "number-of-rows",
+        "data": {
+            "config": [{"table": "cases", "groupby": ["disease", "year"]}],
+            "data": [["cases", [[[f"disease_{d}", 2000 + y], rng.randint(0, 10000)]
+                                for d in range(20) for y in range(20)]]]
+        }
+    }, {
+        "watcher": "number-of-rows-hash",
+        "data": {"config": [{"table": "cases"}], "data": [["cases", [row_hash() for _ in range(n_rows)]]]}
+    }, {
+        "watcher": "tables-in-schema",
+        "data": {"config": ["original_data"], "data": [["original_data", [t.split(".")[1] for t in tables]]]}
+    }, {
+        "watcher": "table-change",
+        "data": {"config": {"schemas": ["original_data"]}, "data": [[t, row_hash()] for t in tables]}
+    }]
+
+
+def payloads(items):
+    return [json.dumps(item["data"], sort_keys=True).encode("utf-8") for item in items]
+
+
+def bench(codec, samples, repeat=3):
+    write_time = read_time = 0.0
+    size = 0
+    for _ in range(repeat):
+        size = 0
+        for payload in samples:
+            start = time.perf_counter()
+            encoded = b"".join(encode([payload], codec))
+            write_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            decode(encoded, lambda _: codec.zdict)
+            read_time += time.perf_counter() - start
+            size += len(encoded)
+
+    return size, write_time / repeat, read_time / repeat
+
+
+if __name__ == "__main__":
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    training = payloads(synthetic_items(n_rows, seed=0))
+    samples = payloads(synthetic_items(n_rows, seed=1))
+    raw_size = sum(len(it) for it in samples)
+
+    codecs = [get_codec(spec) for spec in ["none", "gzip:1", "gzip:6", "gzip:9", "lzma:1", "lzma:6", "zlib:6"]]
+    codecs.append(ZlibCodec(6, train_zdict(training)))
+
+    print(f"Raw size: {raw_size / 2 ** 20:.2f} MiB")
+    print(f"{'codec':>24} {'size (MiB)':>11} {'ratio':>7} {'write (ms)':>11} {'read (ms)':>10}")
+    for codec in codecs:
+        size, write_time, read_time = bench(codec, samples)
+        print(f"{codec.spec:>24} {size / 2 ** 20:>11.2f} {raw_size / size:>7.2f} "
+              f"{write_time * 1000:>11.1f} {read_time * 1000:>10.1f}")
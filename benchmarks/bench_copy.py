@@ -0,0 +1,56 @@
+"""
+Benchmark extraction of row hashes for NumberOfRowsHash from a postgres
+table using the row query loop, the streaming cursor and COPY in text and
+binary formats. Needs a postgres database to create a scratch table in.
+
+Usage (from the repository root): python -m benchmarks.bench_copy <db-url> [n-rows]
+"""
+
+import sys
+import time
+import dataset
+from diffport.hashes import HashArray
+from diffport.query import copy_binary_values, copy_text_lines, stream_query
+
+
+TABLE = "diffport_bench_copy"
+
+
+def query_loop(db):
+    return [r["hash"] for r in db.query(f"SELECT md5({TABLE}::text) as hash FROM {TABLE}")]
+
+
+def stream_loop(db):
+    return [r["hash"] for r in stream_query(db, f"SELECT md5({TABLE}::text) as hash FROM {TABLE}")]
+
+
+def copy_text(db):
+    return copy_text_lines(db, f"SELECT md5({TABLE}::text) FROM {TABLE}")
+
+
+def copy_binary(db, width=8):
+    stmt = f"SELECT substring(decode(md5({TABLE}::text), 'hex') from 1 for {width}) FROM {TABLE} ORDER BY 1"
+    return HashArray(copy_binary_values(db, stmt), width)
+
+
+if __name__ == "__main__":
+    db_url = sys.argv[1]
+    n_rows = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+
+    db = dataset.connect(db_url)
+    db.query(f"DROP TABLE IF EXISTS {TABLE}")
+    db.query(f"""CREATE TABLE {TABLE} AS
+      SELECT idx, md5(idx::text) AS name, idx % 100 AS category
+        FROM generate_series(1, {n_rows}) AS idx""")
+
+    try:
+        print(f"{'method':>12} {'time (s)':>9} {'rows/s':>12}")
+        for name, fn in [("query", query_loop), ("stream", stream_loop),
+                         ("copy-text", copy_text), ("copy-binary", copy_binary)]:
+            start = time.perf_counter()
+            n_out = len(fn(db))
+            elapsed = time.perf_counter() - start
+            assert n_out == n_rows
+            print(f"{name:>12} {elapsed:>9.3f} {n_rows / elapsed:>12.0f}")
+    finally:
+        db.query(f"DROP TABLE IF EXISTS {TABLE}")
@@ -0,0 +1,84 @@
+"""
+Benchmark disk use and reconstruction latency of delta encoded snapshot chains
+against the keyframe interval.
+
+Usage (from the repository root): python -m benchmarks.bench_delta [n-snapshots]
+"""
+
+import hashlib
+import random
+import sys
+import tempfile
+import time
+from diffport.store import StoreDirectory
+from pathlib import Path
+
+
+def row_hash(value) -> str:
+    return hashlib.md5(str(value).encode("utf-8")).hexdigest()
+
+
+def synthetic_snaps(n_snaps: int, n_groups=20000, n_rows=100000, change=0.01):
+    """
+    Yield snapshots with grouped number-of-rows and number-of-rows-hash data
+    where a small share of groups and rows change between saves
+    """
+
+    rng = random.Random(42)
+    counts = [[["region", f"g{idx}"], rng.randint(0, 1000)] for idx in range(n_groups)]
+    hashes = [row_hash(idx) for idx in range(n_rows)]
+    next_row = n_rows
+
+    for snap_idx in range(n_snaps):
+        for _ in range(int(n_groups * change)):
+            counts[rng.randrange(n_groups)][1] += rng.randint(1, 10)
+        for _ in range(int(n_rows * change)):
+            hashes[rng.randrange(n_rows)] = row_hash(next_row)
+            next_row += 1
+
+        yield {
+            "time": snap_idx,
+            "hash": f"snap-{snap_idx}",
+            "items": [{
+                "watcher": "number-of-rows",
+                "data": {
+                    "config": [{"table": "cases", "groupby": ["region", "district"]}],
+                    "data": [["cases", [list(it) for it in counts]]]
+                }
+            }, {
+                "watcher": "number-of-rows-hash",
+                "data": {"config": [{"table": "cases"}], "data": [["cases", list(hashes)]]}
+            }]
+        }
+
+
+def dir_size(path: Path) -> int:
+    return sum(it.stat().st_size for it in path.glob("**/*") if it.is_file())
+
+
+def bench(keyframe_interval: int, n_snaps: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        store_path = Path(tmp).joinpath("store")
+        store = StoreDirectory(store_path, cache_size=0, keyframe_interval=keyframe_interval)
+
+        start = time.perf_counter()
+        for snap in synthetic_snaps(n_snaps):
+            store.add_snapshot(snap)
+        write_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for entry in store.get_index():
+            store.get_snapshot(entry["hash"])
+        read_time = (time.perf_counter() - start) / n_snaps
+
+        return dir_size(store_path), write_time, read_time
+
+
+if __name__ == "__main__":
+    n_snaps = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    print(f"{'keyframe interval':>18} {'disk (MiB)':>12} {'write (s)':>10} {'read/snap (ms)':>15}")
+    for interval in [0, 2, 5, 10, 20]:
+        size, write_time, read_time = bench(interval, n_snaps)
+        label = "none" if interval == 0 else str(interval)
+        print(f"{label:>18} {size / 2 ** 20:>12.2f} {write_time:>10.2f} {read_time * 1000:>15.1f}")
@@ -0,0 +1,77 @@
+"""
+Benchmark keyed diffing of grouped snapshots (find_col_diff) as used by the
+watchers, comparing the earlier lookup per item against the hash join and
+the sort-merge of split_items.
+
+Usage (from the repository root): python -m benchmarks.bench_diff [max-groups]
+"""
+
+import random
+import sys
+import time
+from diffport.watchers import find_col_diff, split_items
+from pydash import py_
+
+
+# The lookup based diff scans all items for each item, skip it beyond this
+LOOKUP_MAX_GROUPS = 5000
+
+
+def grouped_counts(n_groups: int, seed: int):
+    """
+    Return sorted NumberOfRows like grouped data with about 1% of groups
+    added, removed or changed between seeds
+    """
+
+    rng = random.Random(seed)
+    return [[[f"region_{idx // 100:06d}", idx % 100], rng.randint(0, 100) if rng.random() < 0.01 else 1]
+            for idx in range(n_groups) if rng.random() > 0.005]
+
+
+def lookup_split(a, b):
+    common_a, common_b = [], []
+    for item_id, item_data in a:
+        idx_b = py_.find_index(b, lambda x: x[0] == item_id)
+        if idx_b > -1:
+            common_a.append((item_id, item_data))
+            common_b.append((item_id, b[idx_b][1]))
+    return common_a, common_b, py_.difference_by(a, b, lambda x: x[0]), py_.difference_by(b, a, lambda x: x[0])
+
+
+def count_diff(old, new):
+    if old is None:
+        return new
+    elif new is None:
+        return -old
+    return None if new == old else new - old
+
+
+def bench(split_fn, old, new):
+    start = time.perf_counter()
+    common_old, common_new, only_old, only_new = split_fn(old, new)
+    for (_, old_data), (_, new_data) in zip(common_old, common_new):
+        count_diff(old_data, new_data)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    max_groups = int(sys.argv[1]) if len(sys.argv) > 1 else 10000000
+
+    print(f"{'groups':>10} {'lookup (s)':>11} {'merge (s)':>10} {'hash (s)':>9} {'find_col_diff (s)':>18}")
+    n_groups = 1000
+    while n_groups <= max_groups:
+        old, new = grouped_counts(n_groups, 0), grouped_counts(n_groups, 1)
+        # Shuffled copies take the hash join path
+        shuffled_old, shuffled_new = random.sample(old, len(old)), random.sample(new, len(new))
+
+        lookup = f"{bench(lookup_split, old, new):.3f}" if n_groups <= LOOKUP_MAX_GROUPS else "-"
+        merge = bench(split_items, old, new)
+        hashed = bench(split_items, shuffled_old, shuffled_new)
+
+        start = time.perf_counter()
+        find_col_diff(old, new, count_diff)
+        full = time.perf_counter() - start
+
+        print(f"{n_groups:>10} {lookup:>11} {merge:>10.3f} {hashed:>9.3f} {full:>18.3f}")
+        del old, new, shuffled_old, shuffled_new
+        n_groups *= 10
@@ -0,0 +1,59 @@
+"""
+Benchmark grouping of ordered (group, hash) rows as done by NumberOfRowsHash,
+comparing the earlier lookup per row against the single pass run grouping.
+
+Usage (from the repository root): python -m benchmarks.bench_grouping [max-rows]
+"""
+
+import sys
+import time
+from diffport.watchers import group_runs
+from pydash import py_
+
+
+# The lookup based grouping scans all groups for every row, skip it beyond
+# this many rows x groups
+LOOKUP_MAX_WORK = 10 ** 7
+
+
+def ordered_rows(n_rows: int, n_groups: int):
+    """
+    Yield rows ordered by group fields like the watcher query returns them
+    """
+
+    per_group = n_rows // n_groups
+    for idx in range(n_rows):
+        group = idx // per_group
+        yield {"disease": f"disease_{group % 50}", "year": group // 50, "hash": f"{idx:032x}"}
+
+
+def group_lookup(rows, fields, value_field):
+    grouped_data = [] # type: list
+    for res in rows:
+        group_values = [res[field] for field in fields]
+        group_values_idx = py_.find_index(grouped_data, lambda x: x[0] == group_values)
+        if group_values_idx > -1:
+            grouped_data[group_values_idx][1].append(res[value_field])
+        else:
+            grouped_data.append([group_values, [res[value_field]]])
+    return grouped_data
+
+
+def bench(group_fn, n_rows, n_groups):
+    start = time.perf_counter()
+    n_out = sum(1 for _ in group_fn(ordered_rows(n_rows, n_groups), ["disease", "year"], "hash"))
+    assert n_out == n_groups
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    max_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+
+    print(f"{'rows':>10} {'groups':>10} {'lookup (s)':>11} {'runs (s)':>9} {'rows/s (runs)':>14}")
+    n_rows = 10000
+    while n_rows <= max_rows:
+        for n_groups in [100, n_rows // 10, n_rows]:
+            lookup = f"{bench(group_lookup, n_rows, n_groups):.3f}" if n_rows * n_groups <= LOOKUP_MAX_WORK else "-"
+            runs = bench(group_runs, n_rows, n_groups)
+            print(f"{n_rows:>10} {n_groups:>10} {lookup:>11} {runs:>9.3f} {n_rows / runs:>14.0f}")
+        n_rows *= 10
@@ -0,0 +1,61 @@
+"""
+Catalog of tables and columns for the schemas watched in a save
+"""
+
+from typing import Dict, List, Set
+
+
+class Catalog:
+    """
+    Tables and columns of a set of schemas, fetched with a single pg_catalog
+    query. Relation kinds are the ones listed by information_schema.tables
+    (tables, partitioned tables, views and foreign tables) and, like there,
+    only relations and columns the user has some privilege on are listed.
+    """
+
+    def __init__(self, db, schemas: List[str]) -> None:
+        self.tables = {schema: [] for schema in schemas} # type: Dict[str, List[str]]
+        self.columns = {schema: [] for schema in schemas} # type: Dict[str, List[str]]
+
+        if not schemas:
+            return
+
+        # Privilege checks are the ones information_schema.tables and
+        # information_schema.columns use to hide relations and columns
+        res = db.query("""SELECT n.nspname AS schema_name, c.relname AS table_name, a.attname AS column_name
+          FROM pg_class c
+          JOIN pg_namespace n ON n.oid = c.relnamespace
+          LEFT JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+            AND (pg_has_role(c.relowner, 'USAGE')
+                 OR has_column_privilege(c.oid, a.attnum, 'SELECT, INSERT, UPDATE, REFERENCES'))
+          WHERE n.nspname = ANY(:schemas) AND c.relkind IN ('r', 'p', 'v', 'f')
+            AND (pg_has_role(c.relowner, 'USAGE')
+                 OR has_table_privilege(c.oid, 'SELECT, INSERT, UPDATE, DELETE, TRUNCATE, REFERENCES, TRIGGER')
+                 OR has_any_column_privilege(c.oid, 'SELECT, INSERT, UPDATE, REFERENCES'))
+          ORDER BY n.nspname, c.relname, a.attnum""", schemas=list(schemas))
+
+        seen_columns = {schema: set() for schema in schemas} # type: Dict[str, Set[str]]
+        last_table = None
+        for r in res:
+            schema = r["schema_name"]
+            if (schema, r["table_name"]) != last_table:
+                self.tables[schema].append(r["table_name"])
+                last_table = (schema, r["table_name"])
+            if r["column_name"] is not None and r["column_name"] not in seen_columns[schema]:
+                seen_columns[schema].add(r["column_name"])
+                self.columns[schema].append(r["column_name"])
+
+    def covers(self, schemas: List[str]) -> bool:
+        return all(schema in self.tables for schema in schemas)
+
+
+def get_catalog(db, schemas: List[str]) -> Catalog:
+    """
+    Return the catalog shared for the save (kept on the planned db) if it
+    has the schemas, else fetch one for them
+    """
+
+    catalog = getattr(db, "catalog", None)
+    if catalog is not None and catalog.covers(schemas):
+        return catalog
+    return Catalog(db, schemas)
@@ -2,10 +2,10 @@
 Command Line::
 
   Usage:
-    diffport save [--identifier=ID] [--config=CFG] [--source=CON] [--dialect=DIA]
-    diffport (rm | remove) <snap-hash> [--config=CFG]
-    diffport (ls | list) [--json] [--config=CFG]
-    diffport diff [<snap-old> <snap-new>] [--config=CFG]
+    diffport save [--identifier=ID] [--config=CFG] [--source=CON] [--dialect=DIA] [--store=STO] [--keyframe-interval=N] [--codec=COD] [--dry-run]
+    diffport (rm | remove) <snap-hash> [--config=CFG] [--store=STO]
+    diffport (ls | list) [--json] [--config=CFG] [--store=STO]
+    diffport diff [<snap-old> <snap-new>] [--config=CFG] [--store=STO] [--diff-cache=N]
 
   Arguments:
     save                 Save a snapshot at current time
@@ -19,6 +19,16 @@ Command Line::
     --config=CFG         Configuration file [default: ./diffport.yaml]
     --source=CON         Database source [default: env]
     --dialect=DIA        Database type [default: postgresql]
+    --store=STO          Snapshot store, directory or sqlite [default: directory]
+    --keyframe-interval=N
+                         Save deltas with a full snapshot every N saves
+                         (directory store only, 0 to disable) [default: 0]
+    --codec=COD          Compression for new snapshot files, one of gzip:<level>,
+                         lzma:<preset>, zlib:<level>, zlib:<level>:dict (with a
+                         trained dictionary) or none
+    --dry-run            Show the query plan for saving without running it
+    --diff-cache=N       Bytes of watcher diffs to keep cached in the store
+                         directory, 0 to disable [default: 67108864]
     -h, --help           Open help
     -v, --version        Show version
 """
@@ -27,6 +37,7 @@ import colorama
 import os
 import sys
 import yaml
+from . import __version__
 from .core import Diffport
 from .connection import get_connection_string
 from colorama import Fore, Back, Style
@@ -52,7 +63,7 @@ def warn(text, end="\n"):
 
 
 def main():
-    args = docopt(__doc__, argv=sys.argv[1:], version="v0.4.0")
+    args = docopt(__doc__, argv=sys.argv[1:], version=f"v{__version__}")
 
     config_file = Path(args["--config"])
     store_path = config_file.parent.joinpath("diffport.d")
@@ -60,10 +71,23 @@ def main():
     if not config_file.is_file():
         raise Exception("Config file not found")
 
-    with config_file.open() as fp:
-        diffp = Diffport(yaml.load(fp), store_path)
+    store_options = {}
+    if args["--store"] == "directory":
+        store_options["keyframe_interval"] = int(args["--keyframe-interval"])
+    if args["--codec"]:
+        store_options["codec"] = args["--codec"]
 
-    if args["save"]:
+    with config_file.open() as fp:
+        diffp = Diffport(yaml.load(fp), store_path, args["--store"],
+                         diff_cache_size=int(args["--diff-cache"]), **store_options)
+
+    if args["save"] and args["--dry-run"]:
+        plan = diffp.plan()
+        if len(plan) == 0:
+            info("No queries to fuse, each watcher runs its own queries")
+        for fused in plan:
+            print(fused.describe() + "\n")
+    elif args["save"]:
         source_path = str(Path(args["--source"]).expanduser().absolute())
         database_url = get_connection_string(source_path, args["--dialect"])
         diffp.connect(database_url)
@@ -0,0 +1,209 @@
+"""
+Compression codecs for snapshot files
+
+Files written with gzip are plain gzip streams, same as what older versions
+wrote. Files using any other codec start with a small header telling the codec
+spec so that they can be read back irrespective of what the store is currently
+configured to write.
+"""
+
+import gzip
+import hashlib
+import lzma
+import zlib
+from abc import ABC, abstractmethod
+from typing import Callable, Iterable, Iterator, List
+
+
+GZIP_MAGIC = b"\x1f\x8b"
+HEADER_MAGIC = b"DPSNAP1\n"
+
+# zlib can only use the last 32KiB of a preset dictionary
+ZDICT_SIZE = 32 * 1024
+
+
+class Codec(ABC):
+    """
+    A compression codec identified by a spec string like `gzip:9`
+    """
+
+    @property
+    @abstractmethod
+    def spec(self) -> str:
+        ...
+
+    @abstractmethod
+    def compressor(self):
+        """
+        Return an object with compress(bytes) and flush() methods
+        """
+        ...
+
+    @abstractmethod
+    def decompress(self, data: bytes) -> bytes:
+        ...
+
+
+class NullCodec(Codec):
+    """
+    Store data as it is
+    """
+
+    class Compressor:
+        def compress(self, data: bytes) -> bytes:
+            return data
+
+        def flush(self) -> bytes:
+            return b""
+
+    spec = "none"
+
+    def compressor(self):
+        return self.Compressor()
+
+    def decompress(self, data: bytes) -> bytes:
+        return data
+
+
+class GzipCodec(Codec):
+
+    def __init__(self, level: int = 9) -> None:
+        self.level = level
+
+    @property
+    def spec(self):
+        return f"gzip:{self.level}"
+
+    def compressor(self):
+        # wbits of 31 gives a gzip container
+        return zlib.compressobj(self.level, zlib.DEFLATED, 31)
+
+    def decompress(self, data: bytes) -> bytes:
+        return gzip.decompress(data)
+
+
+class LzmaCodec(Codec):
+
+    def __init__(self, preset: int = 6) -> None:
+        self.preset = preset
+
+    @property
+    def spec(self):
+        return f"lzma:{self.preset}"
+
+    def compressor(self):
+        return lzma.LZMACompressor(preset=self.preset)
+
+    def decompress(self, data: bytes) -> bytes:
+        return lzma.decompress(data)
+
+
+class ZlibCodec(Codec):
+    """
+    Raw zlib, optionally with a preset dictionary shared by all the files of
+    a store. The dictionary is identified by its digest in the spec.
+    """
+
+    def __init__(self, level: int = 6, zdict: bytes = None) -> None:
+        self.level = level
+        self.zdict = zdict
+
+    @staticmethod
+    def dict_id(zdict: bytes) -> str:
+        return hashlib.sha1(zdict).hexdigest()[:16]
+
+    @property
+    def spec(self):
+        if self.zdict:
+            return f"zlib:{self.level}:{self.dict_id(self.zdict)}"
+        return f"zlib:{self.level}"
+
+    def compressor(self):
+        if self.zdict:
+            return zlib.compressobj(self.level, zdict=self.zdict)
+        return zlib.compressobj(self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        if self.zdict:
+            decompressor = zlib.decompressobj(zdict=self.zdict)
+        else:
+            decompressor = zlib.decompressobj()
+        return decompressor.decompress(data) + decompressor.flush()
+
+
+def train_zdict(samples: List[bytes], size: int = ZDICT_SIZE) -> bytes:
+    """
+    Return a preset dictionary for zlib from sample payloads. Snapshot files
+    mostly share structure (keys, table and column names) so the tails of the
+    samples, with later samples placed closer to the end where zlib finds
+    them cheaper, work as a dictionary.
+    """
+
+    parts = [] # type: List[bytes]
+    remaining = size
+    for sample in reversed(samples):
+        if remaining <= 0:
+            break
+        part = sample[-remaining:]
+        parts.insert(0, part)
+        remaining -= len(part)
+
+    return b"".join(parts)
+
+
+def get_codec(spec: str, load_zdict: Callable[[str], bytes] = None) -> Codec:
+    """
+    Return codec for a spec like `gzip:9`, `lzma:6`, `zlib:6:<dict-id>` or
+    `none`. load_zdict is used to get the preset dictionary for an id.
+    Stores also accept `zlib:<level>:dict` which means zlib with the store's
+    trained dictionary.
+    """
+
+    name, *args = spec.split(":")
+
+    if name == "none":
+        return NullCodec()
+    elif name == "gzip":
+        return GzipCodec(*[int(arg) for arg in args[:1]])
+    elif name == "lzma":
+        return LzmaCodec(*[int(arg) for arg in args[:1]])
+    elif name == "zlib":
+        level = int(args[0]) if len(args) > 0 else 6
+        if len(args) > 1:
+            if load_zdict is None:
+                raise ValueError(f"No dictionary available for codec {spec}")
+            return ZlibCodec(level, load_zdict(args[1]))
+        return ZlibCodec(level)
+    else:
+        raise ValueError(f"Unknown codec {spec}")
+
+
+def encode(chunks: Iterable[bytes], codec: Codec) -> Iterator[bytes]:
+    """
+    Yield compressed bytes for the chunks, with a header if needed
+    """
+
+    if not isinstance(codec, GzipCodec):
+        yield HEADER_MAGIC + codec.spec.encode("ascii") + b"\n"
+
+    compressor = codec.compressor()
+    for chunk in chunks:
+        out = compressor.compress(chunk)
+        if out:
+            yield out
+    yield compressor.flush()
+
+
+def decode(data: bytes, load_zdict: Callable[[str], bytes] = None) -> bytes:
+    """
+    Return decompressed bytes from file content written by encode
+    """
+
+    if data.startswith(GZIP_MAGIC):
+        return gzip.decompress(data)
+    elif data.startswith(HEADER_MAGIC):
+        spec_end = data.index(b"\n", len(HEADER_MAGIC))
+        spec = data[len(HEADER_MAGIC):spec_end].decode("ascii")
+        return get_codec(spec, load_zdict).decompress(data[spec_end + 1:])
+    else:
+        raise ValueError("Unknown snapshot file format")
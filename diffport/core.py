@@ -14,8 +14,10 @@ from .watchers import (
 )
 from datetime import datetime
 from pathlib import Path
-from typing import Dict
-from .store import StoreDirectory
+from typing import Dict, List
+from .diffcache import DEFAULT_DIFF_CACHE_SIZE, DiffCache
+from .planner import FusedQuery, PlannedDatabase, plan_queries
+from .store import StoreDirectory, StoreSQLite, chunks
 
 
 WATCHER_MAP = {
@@ -26,20 +28,32 @@ WATCHER_MAP = {
     "table-change": TableChange
 }
 
+STORE_MAP = {
+    "directory": StoreDirectory,
+    "sqlite": StoreSQLite
+}
+
 
 class Diffport:
     """
     Main diffport class. Coordinates the cli, watchers and the storage backend
     """
 
-    def __init__(self, config: Dict, store_path: Path) -> None:
+    DIFF_CACHE_DIR = "diff-cache"
+
+    def __init__(self, config: List[Dict], store_path: Path, store_type: str = "directory",
+                 diff_cache_size: int = DEFAULT_DIFF_CACHE_SIZE, **store_options) -> None:
         """
-        Initialize diffport using the provided config
+        Initialize diffport using the provided config. store_type selects the
+        storage backend from STORE_MAP and store_options (like cache_size or
+        keyframe_interval) are passed to it. Watcher diffs are cached in the
+        store directory using up to diff_cache_size bytes, 0 disables it.
         """
 
         self.config = config
-        self.store = StoreDirectory(store_path)
+        self.store = STORE_MAP[store_type](store_path, **store_options)
         self.index = self.store.get_index()
+        self.diff_cache = DiffCache(store_path.joinpath(self.DIFF_CACHE_DIR), diff_cache_size)
 
     def connect(self, database_url: str):
         """
@@ -52,27 +66,101 @@ class Diffport:
         """
         Take a snapshot by looping over the watchers specified in the config
         and save it via store object. Optionally apply identifier to it.
+
+        Each watcher's output is serialized once, fed to the snapshot hash and
+        handed over to the store before moving on to the next watcher. The hash
+        is the same as the sha1 of the utf-16be encoded sorted json dump of
+        the complete list of items.
         """
 
-        items = [{
-            "watcher": watcher["name"],
-            "data": WATCHER_MAP[watcher["name"]].take_snapshot(self.db, watcher["config"])
-        } for watcher in self.config]
+        hasher = hashlib.sha1()
+        hasher.update("[".encode("utf-16be"))
+        previous = self.previous_items()
+        plan = self.plan()
+        schemas = self.catalog_schemas()
+        db = PlannedDatabase(self.db, plan, schemas) if plan or schemas else self.db
+        writer = self.store.begin_snapshot()
+
+        try:
+            for idx, watcher in enumerate(self.config):
+                watcher_previous = previous[watcher["name"]].pop(0) if previous.get(watcher["name"]) else None
+                data = WATCHER_MAP[watcher["name"]].take_snapshot(db, watcher["config"], previous=watcher_previous)
+                dump = json.dumps(data, sort_keys=True)
+
+                # Sorted dump of the item is {"data": ..., "watcher": ...}
+                hasher.update(((", " if idx > 0 else "") + '{"data": ').encode("utf-16be"))
+                for chunk in chunks(dump):
+                    hasher.update(chunk.encode("utf-16be"))
+                hasher.update(f', "watcher": {json.dumps(watcher["name"])}}}'.encode("utf-16be"))
+
+                writer.add_item(watcher["name"], data, dump)
+                del data, dump
+
+            hasher.update("]".encode("utf-16be"))
+            snap = {"hash": hasher.hexdigest(), "time": int(time.time())}
+
+            if identifier:
+                snap["identifier"] = identifier
+
+            # The store checks for duplicates while committing, since another
+            # process might have saved the same snapshot meanwhile
+            added = writer.commit(snap)
+        except BaseException:
+            writer.abort()
+            raise
+
+        if not added:
+            return None
 
-        sorted_dump = json.dumps(items, sort_keys=True)
-        snap_hash = hashlib.sha1(sorted_dump.encode("utf-16be")).hexdigest()
+        self.index = self.store.get_index()
+        return snap["hash"]
 
-        snap = {"hash": snap_hash, "time": int(time.time()), "items": items}
+    def plan(self) -> List[FusedQuery]:
+        """
+        Return queries fused across the watchers in config for a save
+        """
 
-        if identifier:
-            snap["identifier"] = identifier
+        return plan_queries(self.config)
 
-        if snap["hash"] in [item["hash"] for item in self.index]:
-            return None
-        else:
-            self.store.add_snapshot(snap)
-            self.index = self.store.get_index()
-            return snap["hash"]
+    def catalog_schemas(self) -> List[str]:
+        """
+        Return schemas watchers in config read from the catalog
+        """
+
+        schemas = [] # type: List[str]
+        for watcher in self.config:
+            for schema in WATCHER_MAP[watcher["name"]].catalog_schemas(watcher["config"]):
+                if schema not in schemas:
+                    schemas.append(schema)
+        return schemas
+
+    def previous_items(self) -> Dict[str, List]:
+        """
+        Return data of watchers from the latest snapshot in store, as a list
+        per watcher name in config order. Entries are None for watchers which
+        don't use the previous snapshot with their config, the rest are
+        trimmed to what the watcher needs.
+        """
+
+        needed = [WATCHER_MAP[watcher["name"]].uses_previous(watcher["config"]) for watcher in self.config]
+        names = list({watcher["name"] for watcher, need in zip(self.config, needed) if need})
+        if not names or len(self.index) == 0:
+            return {}
+
+        # Blobs are kept out of the store's cache so that the trimmed parts
+        # are freed before the save starts
+        items = {} # type: Dict[str, List]
+        for item in self.store.get_snapshot(self.index[0]["hash"], watchers=names, cached=False)["items"]:
+            items.setdefault(item["watcher"], []).append(item["data"])
+
+        previous = {} # type: Dict[str, List]
+        for watcher, need in zip(self.config, needed):
+            name = watcher["name"]
+            data = items[name].pop(0) if items.get(name) else None
+            if need and data is not None:
+                data = WATCHER_MAP[name].trim_previous(watcher["config"], data)
+            previous.setdefault(name, []).append(data if need else None)
+        return previous
 
     def remove_snapshot(self, snap_hash: str):
         """
@@ -80,15 +168,25 @@ class Diffport:
         """
 
         self.store.remove_snapshot(snap_hash)
+        self.diff_cache.invalidate(snap_hash)
         self.index = self.store.get_index()
 
     def report(self, old_snap_hash, new_snap_hash):
         """
-        Report diff for the given hashes
+        Report diff for the given hashes. Diffs found in the diff cache are
+        reused and snapshot data is only read for the other watchers.
         """
 
-        old_snap = self.store.get_snapshot(old_snap_hash)
-        new_snap = self.store.get_snapshot(new_snap_hash)
+        cached = [
+            self.diff_cache.get(old_snap_hash, new_snap_hash, watcher["name"], watcher["config"])
+            for watcher in self.config
+        ]
+
+        # Only read data for watchers in the current config which need a diff.
+        # Hash arrays in hash blobs are left in the store for diffs to stream.
+        watchers = [watcher["name"] for watcher, hit in zip(self.config, cached) if hit is None]
+        old_snap = self.store.get_snapshot(old_snap_hash, watchers, lazy_hashes=True)
+        new_snap = self.store.get_snapshot(new_snap_hash, watchers, lazy_hashes=True)
 
         old_items = old_snap["items"]
         new_items = new_snap["items"]
@@ -98,17 +196,24 @@ class Diffport:
         new_watchers = [item["watcher"] for item in new_items]
         reports = []
 
-        for watcher in self.config:
+        for watcher, hit in zip(self.config, cached):
             name = watcher["name"]
-            try:
+            if hit is not None:
+                diff = hit["diff"]
+            elif name in old_watchers and name in new_watchers:
                 old = old_items[old_watchers.index(name)]["data"]
                 new = new_items[new_watchers.index(name)]["data"]
                 diff = WATCHER_MAP[name].diff(old, new)
-                if diff is not None:
-                    reports.append(WATCHER_MAP[name].report(diff))
-            except ValueError:
+                # Round trip through json so that reports see the same
+                # data whether the diff is fresh or cached
+                diff = json.loads(json.dumps(diff))
+                self.diff_cache.put(old_snap_hash, new_snap_hash, name, watcher["config"], diff)
+            else:
                 continue
 
+            if diff is not None:
+                reports.append(WATCHER_MAP[name].report(diff))
+
         # Add time information about snapshots as the header
         old_time = datetime.fromtimestamp(old_snap["time"]).strftime("%Y-%m-%d %H:%M:%S")
         new_time = datetime.fromtimestamp(new_snap["time"]).strftime("%Y-%m-%d %H:%M:%S")
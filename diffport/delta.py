@@ -0,0 +1,143 @@
+"""
+Delta encoding for json like snapshot data
+
+A delta is a tree of nodes describing how to get the target value from a base
+value. Each node is a dictionary with an `op` key:
+
+- `same` : target is same as base
+- `set` : target is `value`
+- `dict` : target is a dictionary with keys `keys`, values for keys present in
+  `items` are deltas against the base values, rest are taken from base as is
+- `seq` : target is a list built by running `ops` over base. Ops are
+  `["c", start, length]` for copying a run from base, `["i", [values...]]` for
+  inserting literal values and `["m", index, node]` for a `[key, value]` pair
+  from base with its value patched using node.
+"""
+
+import json
+from collections import defaultdict, deque
+from typing import Any, Callable, Dict, List, Sequence
+
+
+Node = Dict[str, Any]
+
+
+def _is_pairs(seq) -> bool:
+    """
+    Tell whether the sequence looks like a SnapList, i.e. is made of
+    [key, value] pairs
+    """
+
+    return len(seq) > 0 and all(isinstance(it, (list, tuple)) and len(it) == 2 for it in seq)
+
+
+def _canonical(value):
+    """
+    Return a hashable representation of value for matching items
+    """
+
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return (type(value).__name__, value)
+    return json.dumps(value, sort_keys=True)
+
+
+def _same(a, b) -> bool:
+    """
+    Tell whether a and b are the same json value. Plain == takes True, 1 and
+    1.0 as equal, so values which compare equal are also checked on their
+    serialization.
+    """
+
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        if list(a) != list(b):
+            return False
+    elif a != b:
+        return False
+    return json.dumps(a, sort_keys=True) == json.dumps(b, sort_keys=True)
+
+
+def _seq_delta(base: Sequence, target: Sequence) -> Node:
+    """
+    Return delta for sequences. Items are matched on their value or, for
+    sequences of pairs, on the key of the pair.
+    """
+
+    pairs = _is_pairs(base) and _is_pairs(target)
+    key_fn = (lambda it: _canonical(it[0])) if pairs else _canonical # type: Callable
+
+    positions = defaultdict(deque) # type: Dict[Any, deque]
+    for idx, item in enumerate(base):
+        positions[key_fn(item)].append(idx)
+
+    ops = [] # type: List[List]
+    for item in target:
+        base_positions = positions.get(key_fn(item))
+        if not base_positions:
+            if ops and ops[-1][0] == "i":
+                ops[-1][1].append(item)
+            else:
+                ops.append(["i", [item]])
+            continue
+
+        idx = base_positions.popleft()
+        if not pairs or _same(base[idx], item):
+            if ops and ops[-1][0] == "c" and ops[-1][1] + ops[-1][2] == idx:
+                ops[-1][2] += 1
+            else:
+                ops.append(["c", idx, 1])
+        else:
+            ops.append(["m", idx, make_delta(base[idx][1], item[1])])
+
+    return {"op": "seq", "ops": ops}
+
+
+def make_delta(base, target) -> Node:
+    """
+    Return delta node which gives target when applied on base
+    """
+
+    if _same(base, target):
+        return {"op": "same"}
+    elif isinstance(base, dict) and isinstance(target, dict):
+        items = {}
+        for key, value in target.items():
+            node = make_delta(base[key], value) if key in base else {"op": "set", "value": value}
+            if node["op"] != "same":
+                items[key] = node
+        return {"op": "dict", "keys": list(target.keys()), "items": items}
+    elif isinstance(base, (list, tuple)) and isinstance(target, (list, tuple)):
+        return _seq_delta(base, target)
+    else:
+        return {"op": "set", "value": target}
+
+
+def apply_delta(base, node: Node):
+    """
+    Return target value by applying delta node on base
+    """
+
+    op = node["op"]
+
+    if op == "same":
+        return base
+    elif op == "set":
+        return node["value"]
+    elif op == "dict":
+        items = node["items"]
+        return {
+            key: apply_delta(base.get(key), items[key]) if key in items else base[key]
+            for key in node["keys"]
+        }
+    elif op == "seq":
+        output = [] # type: List
+        for seq_op in node["ops"]:
+            if seq_op[0] == "c":
+                output.extend(base[seq_op[1]:seq_op[1] + seq_op[2]])
+            elif seq_op[0] == "i":
+                output.extend(seq_op[1])
+            elif seq_op[0] == "m":
+                key, value = base[seq_op[1]]
+                output.append([key, apply_delta(value, seq_op[2])])
+        return output
+    else:
+        raise ValueError(f"Unknown delta op {op}")
@@ -0,0 +1,131 @@
+"""
+On disk cache for outputs of watchers' diff
+"""
+
+import hashlib
+import json
+import os
+from . import __version__
+from .store import atomic_write
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+
+# Default budget for cached diffs on disk in bytes
+DEFAULT_DIFF_CACHE_SIZE = 64 * 1024 * 1024
+
+
+class DiffCache:
+    """
+    Cache watcher diffs in a directory, one json file per diff. Files are
+    named by the old and new snapshot hashes followed by a digest of the
+    watcher name, its config and diffport's version, so diffs from an older
+    version or for a changed config are never served.
+
+    Diffs involving a snapshot are found from the file names, which lets a
+    removed snapshot drop its diffs without keeping an index. Least recently
+    used files are evicted when the directory grows over max_bytes, a
+    max_bytes of 0 disables the cache.
+    """
+
+    def __init__(self, directory_path: Path, max_bytes: int = DEFAULT_DIFF_CACHE_SIZE) -> None:
+        self.path = directory_path
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def watcher_digest(watcher: str, config: Any) -> str:
+        """
+        Return digest identifying the watcher and its config for this version
+        """
+
+        dump = json.dumps([watcher, config, __version__], sort_keys=True)
+        return hashlib.sha1(dump.encode("utf-8")).hexdigest()
+
+    def diff_file(self, old_hash: str, new_hash: str, watcher: str, config: Any) -> Path:
+        return self.path.joinpath(f"{old_hash}.{new_hash}.{self.watcher_digest(watcher, config)}.json")
+
+    def get(self, old_hash: str, new_hash: str, watcher: str, config: Any) -> Optional[Dict]:
+        """
+        Return {"diff": <watcher diff>} if the diff is cached, else None. The
+        diff itself can be None for watchers reporting no change.
+        """
+
+        if self.max_bytes <= 0:
+            return None
+
+        diff_file = self.diff_file(old_hash, new_hash, watcher, config)
+        try:
+            with diff_file.open() as fp:
+                cached = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        try:
+            # Mark as recently used for eviction
+            os.utime(str(diff_file))
+        except OSError:
+            # Read only stores still serve their cached diffs
+            pass
+
+        return cached
+
+    def put(self, old_hash: str, new_hash: str, watcher: str, config: Any, diff):
+        """
+        Cache the diff for the watcher between the snapshots and evict old
+        diffs to stay within the budget
+        """
+
+        if self.max_bytes <= 0:
+            return
+
+        dump = json.dumps({"diff": diff})
+        if len(dump) > self.max_bytes:
+            return
+
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+            atomic_write(self.diff_file(old_hash, new_hash, watcher, config), [dump.encode("utf-8")])
+        except OSError:
+            # Caching is best effort, a failed write only costs a recompute
+            return
+        self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used diffs until the cache is within budget
+        """
+
+        files = []
+        for diff_file in self.path.glob("*.json"):
+            try:
+                stat = diff_file.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, diff_file))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, diff_file in sorted(files, key=lambda it: it[0]):
+            if total <= self.max_bytes:
+                break
+            self.remove(diff_file)
+            total -= size
+
+    def invalidate(self, snap_hash: str):
+        """
+        Remove cached diffs involving the snapshot
+        """
+
+        if not self.path.is_dir():
+            return
+
+        for pattern in [f"{snap_hash}.*.json", f"*.{snap_hash}.*.json"]:
+            for diff_file in self.path.glob(pattern):
+                self.remove(diff_file)
+
+    @staticmethod
+    def remove(diff_file: Path):
+        try:
+            diff_file.unlink()
+        except FileNotFoundError:
+            # Already removed by another process
+            pass
@@ -0,0 +1,325 @@
+"""
+Compact binary representation for lists of row hashes
+"""
+
+import base64
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+try:
+    import numpy as np
+except ImportError:
+    np = None # type: ignore
+
+
+class HashArray:
+    """
+    Sorted array of fixed width binary digests packed in a single bytes
+    buffer. Digests are truncated to `width` bytes, so a hash list takes
+    `width` bytes per row instead of a 32 character hex string object.
+    """
+
+    def __init__(self, buffer: bytes, width: int) -> None:
+        """
+        Wrap an already sorted buffer of digests
+        """
+
+        if len(buffer) % width != 0:
+            raise ValueError(f"Buffer size {len(buffer)} is not a multiple of width {width}")
+
+        self.buffer = buffer
+        self.width = width
+
+    @classmethod
+    def from_hex(cls, hashes: Iterable[str], width: int) -> "HashArray":
+        """
+        Build array from hex digests like the ones returned by postgres' md5
+        """
+
+        digests = sorted(bytes.fromhex(h)[:width] for h in hashes)
+        return cls(b"".join(digests), width)
+
+    @classmethod
+    def from_json(cls, obj: Dict) -> "HashArray":
+        return cls(base64.b64decode(obj["hash-array"]), obj["width"])
+
+    def to_json(self) -> Dict:
+        """
+        Return json friendly representation for keeping in snapshots
+        """
+
+        return {"hash-array": base64.b64encode(self.buffer).decode("ascii"), "width": self.width}
+
+    def __len__(self) -> int:
+        return len(self.buffer) // self.width
+
+    def __iter__(self) -> Iterator[bytes]:
+        width = self.width
+        view = memoryview(self.buffer)
+        for start in range(0, len(self.buffer), width):
+            yield view[start:start + width].tobytes()
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, HashArray) and self.width == other.width and self.buffer == other.buffer
+
+    def truncate(self, width: int) -> "HashArray":
+        """
+        Return array with digests cut to given width. Prefixes of sorted
+        digests stay sorted so no sorting is needed.
+        """
+
+        if width >= self.width:
+            return self
+        return HashArray(b"".join(digest[:width] for digest in self), width)
+
+    def count_unique(self) -> int:
+        """
+        Return number of distinct digests
+        """
+
+        count = 0
+        last = None
+        for digest in self:
+            if digest != last:
+                count += 1
+                last = digest
+        return count
+
+
+class HashBlob:
+    """
+    Packed hash array kept by the store in its own blob. Digests are read from
+    the store in chunks while iterating, so the array is never in memory as a
+    whole unless loaded.
+    """
+
+    def __init__(self, read: Callable[[], Iterator[bytes]], width: int, size: int) -> None:
+        """
+        read returns an iterator over chunks of the sorted buffer. Chunks
+        don't need to be aligned to width.
+        """
+
+        self.read = read
+        self.width = width
+        self.size = size
+
+    def __len__(self) -> int:
+        return self.size // self.width
+
+    def __iter__(self) -> Iterator[bytes]:
+        width = self.width
+        rest = b""
+        for chunk in self.read():
+            chunk = rest + chunk
+            end = len(chunk) - len(chunk) % width
+            for start in range(0, end, width):
+                yield chunk[start:start + width]
+            rest = chunk[end:]
+
+    def load(self) -> HashArray:
+        return HashArray(b"".join(self.read()), self.width)
+
+
+def is_hash_array(obj) -> bool:
+    """
+    Tell whether obj is the json representation of a HashArray
+    """
+
+    return isinstance(obj, dict) and "hash-array" in obj
+
+
+def is_hash_blob(obj) -> bool:
+    """
+    Tell whether obj is the json reference to a hash array kept in its own
+    blob by the store
+    """
+
+    return isinstance(obj, dict) and "hash-blob" in obj
+
+
+def replace_hashes(obj, replace: Callable[[Dict], Any]):
+    """
+    Return json data with each packed hash array and hash blob reference
+    replaced by the output of replace. Parts of the data without any are not
+    copied.
+    """
+
+    if is_hash_array(obj) or is_hash_blob(obj):
+        return replace(obj)
+    elif isinstance(obj, dict):
+        replaced = {key: replace_hashes(value, replace) for key, value in obj.items()}
+        return replaced if any(replaced[key] is not obj[key] for key in obj) else obj
+    elif isinstance(obj, (list, tuple)):
+        items = [replace_hashes(value, replace) for value in obj]
+        return items if any(new is not old for new, old in zip(items, obj)) else obj
+    return obj
+
+
+def as_hash_array(hashes: Union[Dict, Iterable[str]], width: int) -> HashArray:
+    """
+    Return HashArray for either a json representation or a list of hex
+    digests, with digests cut to width
+    """
+
+    if is_hash_array(hashes):
+        return HashArray.from_json(hashes).truncate(width) # type: ignore
+    return HashArray.from_hex(hashes, width) # type: ignore
+
+
+def count_sub(a: HashArray, b: HashArray) -> int:
+    """
+    Return number of distinct digests in a which are not in b by merging the
+    two sorted arrays
+    """
+
+    count = 0
+    last = None
+    b_iter = iter(b)
+    b_item = next(b_iter, None)
+
+    for a_item in a:
+        if a_item == last:
+            continue
+        last = a_item
+        while b_item is not None and b_item < a_item:
+            b_item = next(b_iter, None)
+        if b_item != a_item:
+            count += 1
+
+    return count
+
+
+def hash_width(hashes) -> int:
+    """
+    Return bytes per digest for a list of hex md5 digests or a packed array
+    """
+
+    if isinstance(hashes, HashBlob):
+        return hashes.width
+    return hashes["width"] if is_hash_array(hashes) else 16
+
+
+def _digest_matrix(hashes, width: int):
+    """
+    Return digests as a (rows, width) uint8 numpy array, cut to width
+    """
+
+    if hashes is None:
+        return np.empty((0, width), dtype=np.uint8)
+    elif is_hash_array(hashes):
+        array = HashArray.from_json(hashes)
+        return np.frombuffer(array.buffer, dtype=np.uint8).reshape(-1, array.width)[:, :width]
+    else:
+        return np.frombuffer(bytes.fromhex("".join(hashes)), dtype=np.uint8).reshape(-1, 16)[:, :width]
+
+
+def _batch_keys(hashes_list: List, width: int) -> List:
+    """
+    Return key columns for the digests of all the hash lists together, the
+    index of the list followed by the digest as 64 bit words. Digests of
+    4 bytes or less share a word with the list index.
+    """
+
+    digests = [_digest_matrix(hashes, width) for hashes in hashes_list]
+    groups = np.repeat(np.arange(len(digests), dtype=np.uint64), [len(it) for it in digests])
+    matrix = np.vstack(digests)
+
+    n_words = (width + 7) // 8
+    padded = np.zeros((len(matrix), n_words * 8), dtype=np.uint8)
+    padded[:, :width] = matrix
+    words = padded.view(">u8").astype(np.uint64)
+
+    if width <= 4:
+        return [(groups << np.uint64(32)) | (words[:, 0] >> np.uint64(32))]
+    return [groups] + [words[:, idx] for idx in range(n_words)]
+
+
+def _sorted_unique(columns: List, presorted: bool = False) -> List:
+    """
+    Return key columns sorted, with repeated keys dropped. Sorting is skipped
+    if the keys are known to be in order already.
+    """
+
+    if not presorted:
+        order = np.lexsort(columns[::-1])
+        columns = [col[order] for col in columns]
+    if len(columns[0]) == 0:
+        return columns
+
+    first = np.ones(len(columns[0]), dtype=bool)
+    first[1:] = np.any([col[1:] != col[:-1] for col in columns], axis=0)
+    return [col[first] for col in columns]
+
+
+def _common_mask(old_columns: List, new_columns: List) -> Tuple[Any, Any]:
+    """
+    Return masks over sorted distinct old and new keys telling which keys
+    are present on both sides
+    """
+
+    n_old = len(old_columns[0])
+    columns = [np.concatenate([old_col, new_col]) for old_col, new_col in zip(old_columns, new_columns)]
+    side = np.concatenate([np.zeros(n_old, dtype=np.uint8), np.ones(len(new_columns[0]), dtype=np.uint8)])
+
+    # Sorted by key and then side, a common key is an old key right before
+    # the same new key
+    order = np.lexsort([side] + columns[::-1])
+    same_next = np.all([col[order][1:] == col[order][:-1] for col in columns], axis=0)
+
+    old_common = np.zeros(n_old, dtype=bool)
+    new_common = np.zeros(len(side) - n_old, dtype=bool)
+    if len(order) > 1:
+        pairs = np.nonzero(same_next)[0]
+        old_common[order[pairs]] = True
+        new_common[order[pairs + 1] - n_old] = True
+    return old_common, new_common
+
+
+def _all_packed(hashes_list: List) -> bool:
+    return all(hashes is None or is_hash_array(hashes) for hashes in hashes_list)
+
+
+def batch_diff_counts(pairs: List[Tuple[Any, Any]]) -> Optional[List[Tuple[int, int]]]:
+    """
+    Return (removed, added) counts of distinct digests for each (old, new)
+    pair of hash lists (hex lists, packed arrays or None). Pairs with packed
+    arrays are done in one vectorized pass per digest width, comparing at the
+    smaller width of the two. Return None if numpy is not available.
+    """
+
+    if np is None:
+        return None
+
+    counts = [(0, 0)] * len(pairs) # type: List[Tuple[int, int]]
+
+    by_width = {} # type: Dict[int, List[int]]
+    for idx, (old, new) in enumerate(pairs):
+        if not (is_hash_array(old) or is_hash_array(new)):
+            # Hex lists are already python strings, set operations on them
+            # are faster than converting them to arrays
+            old_set, new_set = set(old or []), set(new or [])
+            counts[idx] = (len(old_set - new_set), len(new_set - old_set))
+        else:
+            width = min(hash_width(it) for it in [old, new] if it is not None)
+            by_width.setdefault(width, []).append(idx)
+
+    for width, indices in by_width.items():
+        old_list = [pairs[idx][0] for idx in indices]
+        new_list = [pairs[idx][1] for idx in indices]
+
+        # Packed arrays keep digests sorted, and the list index leads the
+        # keys, so keys from packed arrays alone come out in order
+        old_columns = _sorted_unique(_batch_keys(old_list, width), presorted=_all_packed(old_list))
+        new_columns = _sorted_unique(_batch_keys(new_list, width), presorted=_all_packed(new_list))
+        old_common, new_common = _common_mask(old_columns, new_columns)
+
+        # The list index is the first key column (or its upper half)
+        shift = np.uint64(32) if width <= 4 else np.uint64(0)
+        old_groups = (old_columns[0] >> shift).astype(np.int64)
+        new_groups = (new_columns[0] >> shift).astype(np.int64)
+
+        removed = np.bincount(old_groups[~old_common], minlength=len(indices))
+        added = np.bincount(new_groups[~new_common], minlength=len(indices))
+        for pos, idx in enumerate(indices):
+            counts[idx] = (int(removed[pos]), int(added[pos]))
+
+    return counts
@@ -0,0 +1,151 @@
+"""
+Planning of watcher queries across a save
+
+Watchers build their queries independently, so several of them can scan the
+same table. The planner looks at the config before a save and fuses counting
+queries of NumberOfRows on the same table (with different or no groupby) in a
+single GROUPING SETS scan. The fused results are split back in the rows each
+original query would have returned and served to the watchers through
+PlannedDatabase. Catalog lookups of all the watched schemas are also done
+once for the save.
+"""
+
+from typing import Dict, Iterator, List
+from .catalog import Catalog
+from .query import stream_query
+from .watchers import NumberOfRows
+
+
+class FusedQuery:
+    """
+    Single scan of a table answering several counting queries. Each part is
+    the original statement with its group columns.
+    """
+
+    def __init__(self, table: str, parts: List[Dict]) -> None:
+        self.table = table
+        self.parts = parts
+        self.columns = [] # type: List[str]
+        for part in parts:
+            self.columns += [col for col in part["columns"] if col not in self.columns]
+
+    def grouping_id(self, columns: List[str]) -> int:
+        """
+        Return value of GROUPING() over all columns for a grouping set, bits
+        are set for the columns not in the set
+        """
+
+        n_cols = len(self.columns)
+        return sum(1 << (n_cols - 1 - idx) for idx, col in enumerate(self.columns) if col not in columns)
+
+    @property
+    def stmt(self) -> str:
+        all_fields = ", ".join(self.columns)
+        grouping = f"GROUPING({all_fields})"
+        sets = ", ".join(f"({', '.join(part['columns'])})" for part in self.parts)
+
+        # Rows of each set are ordered by its own columns, as in the original
+        # queries. Each column gets its own CASE so that types don't mix.
+        order = ["grouping_id"]
+        for part in self.parts:
+            part_id = self.grouping_id(part["columns"])
+            order += [f"CASE WHEN {grouping} = {part_id} THEN {col} END" for col in part["columns"]]
+
+        return f"""SELECT {all_fields}, {grouping} AS grouping_id, count(*) AS count
+          FROM {self.table}
+          GROUP BY GROUPING SETS ({sets})
+          ORDER BY {", ".join(order)}"""
+
+    def split(self, rows: Iterator[Dict]) -> Dict[str, List[Dict]]:
+        """
+        Return rows of the fused scan as the rows of each original statement
+        """
+
+        parts = {self.grouping_id(part["columns"]): part for part in self.parts}
+        results = {part["stmt"]: [] for part in self.parts} # type: Dict[str, List[Dict]]
+        for row in rows:
+            part = parts[row["grouping_id"]]
+            output = {col: row[col] for col in part["columns"]}
+            output["count"] = row["count"]
+            results[part["stmt"]].append(output)
+        return results
+
+    def describe(self) -> str:
+        lines = [f"Single scan of {self.table} for:"]
+        for part in self.parts:
+            lines.append(f"  - {part['watcher']}: " + (f"groupby {', '.join(part['columns'])}" if part["columns"] else "total"))
+        lines.append(self.stmt)
+        return "\n".join(lines)
+
+
+def plan_queries(config: List[Dict]) -> List[FusedQuery]:
+    """
+    Return fused queries for tables counted more than once across the
+    watchers in config. Tables with a single counting query are left alone.
+    """
+
+    tables = {} # type: Dict[str, List[Dict]]
+    for watcher in config:
+        if watcher["name"] != "number-of-rows":
+            continue
+        for table_config in watcher["config"]:
+            stmt = NumberOfRows.count_stmt(table_config)
+            columns = table_config.get("groupby", [])
+            parts = tables.setdefault(table_config["table"], [])
+
+            # Same columns in another order would share a grouping set, such
+            # queries run on their own
+            if not any(set(part["columns"]) == set(columns) for part in parts):
+                parts.append({
+                    "watcher": watcher["name"],
+                    "stmt": stmt,
+                    "columns": columns
+                })
+
+    # A single grouping set or only totals gain nothing from fusing
+    return [
+        FusedQuery(table, parts) for table, parts in tables.items()
+        if len(parts) > 1 and any(part["columns"] for part in parts)
+    ]
+
+
+class PlannedDatabase:
+    """
+    Wrapper over a dataset db which answers the statements of a plan from
+    the fused results and passes everything else on to db. It also carries
+    the catalog for the schemas watched in the save.
+    """
+
+    def __init__(self, db, plan: List[FusedQuery], schemas: List[str] = None) -> None:
+        self.db = db
+        self.prefetched = {} # type: Dict[str, List[Dict]]
+        for fused in plan:
+            self.prefetched.update(fused.split(stream_query(db, fused.stmt)))
+
+        # Catalog of all the schemas watched, shared across watchers
+        self.catalog = Catalog(db, schemas) if schemas else None
+
+    def query(self, stmt, **params):
+        if isinstance(stmt, str) and stmt in self.prefetched and not params:
+            return PrefetchedResult(self.prefetched[stmt])
+        return self.db.query(stmt, **params)
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+
+class PrefetchedResult:
+    """
+    Iterator over prefetched rows, with next() like dataset's ResultIter
+    """
+
+    def __init__(self, rows: List[Dict]) -> None:
+        self.rows = iter(rows)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.rows)
+
+    next = __next__
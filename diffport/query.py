@@ -0,0 +1,216 @@
+"""
+Helpers for running watcher queries
+"""
+
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import NullPool
+from typing import Callable, Dict, Iterator, List
+
+
+# Rows fetched from the server at a time by stream_query
+DEFAULT_BATCH_SIZE = 10000
+
+
+def stream_query(db, stmt: str, batch_size: int = DEFAULT_BATCH_SIZE, **params) -> Iterator[Dict]:
+    """
+    Run stmt on the dataset db using a server side (named) cursor and yield
+    rows as dicts. Only batch_size rows are fetched and kept in memory at a
+    time, unlike db.query which buffers the complete result on the client.
+    Keyword arguments are bound to the named parameters in stmt.
+
+    Results already fetched by the planner (see diffport.planner) are served
+    from memory.
+    """
+
+    prefetched = getattr(db, "prefetched", {})
+    if stmt in prefetched and not params:
+        yield from prefetched[stmt]
+        return
+
+    query = text(stmt).execution_options(stream_results=True, max_row_buffer=batch_size)
+    result = db.executable.execute(query, params)
+
+    try:
+        keys = list(result.keys())
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(zip(keys, row))
+    finally:
+        result.close()
+
+
+# Bytes of COPY output collected before parsing
+COPY_CHUNK_SIZE = 1 << 20
+
+PGCOPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+
+
+class CopyReader:
+    """
+    Writable file like object for psycopg2's copy_expert. psycopg2 writes
+    the output row by row, so the data is collected in a buffer and handed
+    over to the parser in large chunks. The parser gets the buffer and
+    returns the number of bytes it consumed.
+    """
+
+    def __init__(self, parser: Callable[[bytearray], int]) -> None:
+        self.parser = parser
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= COPY_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        consumed = self.parser(self.buffer)
+        del self.buffer[:consumed]
+
+
+class TextLineParser:
+    """
+    Parser for the text format COPY output of a single column query with
+    values free of special characters (e.g. hex digests)
+    """
+
+    def __init__(self) -> None:
+        self.lines = [] # type: List[str]
+
+    def __call__(self, buffer: bytearray) -> int:
+        end = buffer.rfind(b"\n") + 1
+        if end > 0:
+            self.lines.extend(buffer[:end].decode("utf-8").splitlines())
+        return end
+
+
+class BinaryValueParser:
+    """
+    Parser for the binary format COPY output of a single column query. The
+    raw values are concatenated in the output buffer.
+    """
+
+    def __init__(self) -> None:
+        self.output = bytearray()
+        self.in_header = True
+
+    def __call__(self, buffer: bytearray) -> int:
+        pos = 0
+        size = len(buffer)
+
+        if self.in_header:
+            # Signature, flags and header extension
+            if size < 19:
+                return 0
+            if buffer[:11] != PGCOPY_SIGNATURE:
+                raise ValueError("Not a binary COPY stream")
+            pos = 19 + struct.unpack_from("!I", buffer, 15)[0]
+            self.in_header = False
+
+        while pos + 2 <= size:
+            n_fields = struct.unpack_from("!h", buffer, pos)[0]
+            if n_fields == -1:
+                # Trailer
+                return size
+            elif n_fields != 1:
+                raise ValueError(f"Expected a single column in COPY stream, got {n_fields}")
+
+            if pos + 6 > size:
+                break
+            length = struct.unpack_from("!i", buffer, pos + 2)[0]
+            if length < 0:
+                raise ValueError("Unexpected NULL in COPY stream")
+            if pos + 6 + length > size:
+                break
+
+            self.output += buffer[pos + 6:pos + 6 + length]
+            pos += 6 + length
+
+        return pos
+
+
+def copy_query(db, stmt: str, parser: Callable[[bytearray], int], binary: bool = False):
+    """
+    Run the select stmt with COPY ... TO STDOUT on the raw psycopg2
+    connection of dataset db, feeding the output to parser
+    """
+
+    options = " (FORMAT binary)" if binary else ""
+    reader = CopyReader(parser)
+
+    cursor = db.executable.connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY ({stmt}) TO STDOUT{options}", reader)
+    finally:
+        cursor.close()
+
+    reader.flush()
+    if reader.buffer:
+        raise ValueError("Truncated COPY stream")
+
+
+def copy_text_lines(db, stmt: str) -> List[str]:
+    """
+    Return values of a single column select as strings using text COPY
+    """
+
+    parser = TextLineParser()
+    copy_query(db, stmt, parser)
+    return parser.lines
+
+
+def copy_binary_values(db, stmt: str) -> bytes:
+    """
+    Return values of a single column (bytea) select concatenated in one
+    buffer using binary COPY
+    """
+
+    parser = BinaryValueParser()
+    copy_query(db, stmt, parser, binary=True)
+    return bytes(parser.output)
+
+
+def parallel_query(db, stmts: List[str], workers: int) -> List[Dict]:
+    """
+    Run statements concurrently over `workers` connections of their own and
+    return the first row of each, in order of stmts. A repeatable read
+    transaction exports its snapshot with pg_export_snapshot() and all the
+    workers import it, so the results describe one point in time.
+    """
+
+    # Connections outside dataset's pool, which is sized for serial use
+    engine = create_engine(db.engine.url, poolclass=NullPool)
+    exporter = engine.connect().execution_options(isolation_level="REPEATABLE READ")
+    local = threading.local()
+    connections = []
+    lock = threading.Lock()
+
+    def _connection():
+        if not hasattr(local, "conn"):
+            conn = engine.connect().execution_options(isolation_level="REPEATABLE READ")
+            with lock:
+                connections.append(conn)
+            # Has to be the first statement of the worker's transaction
+            conn.execute(text("SET TRANSACTION SNAPSHOT :snapshot"), {"snapshot": snapshot_id})
+            local.conn = conn
+        return local.conn
+
+    def _run(stmt):
+        result = _connection().execute(text(stmt))
+        return dict(zip(result.keys(), result.fetchone()))
+
+    try:
+        # The exporting transaction stays open until all workers are done
+        snapshot_id = exporter.execute(text("SELECT pg_export_snapshot()")).scalar()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(_run, stmts))
+    finally:
+        for conn in connections:
+            conn.close()
+        exporter.close()
+        engine.dispose()
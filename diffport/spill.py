@@ -0,0 +1,162 @@
+"""
+Diff of row hash lists using sorted runs on disk, for hash lists which are
+too big to compare in memory. Packed arrays in hash blobs are streamed from
+the store as they are.
+"""
+
+import heapq
+import os
+import tempfile
+from itertools import islice
+from typing import Iterator, List, Optional, Tuple
+
+from .hashes import HashArray, HashBlob, hash_width, is_hash_array
+
+
+def is_packed(hashes) -> bool:
+    """
+    Tell whether hashes are a packed array, inline or in a hash blob
+    """
+
+    return is_hash_array(hashes) or isinstance(hashes, HashBlob)
+
+
+def hashes_size(hashes) -> int:
+    """
+    Return approximate number of bytes taken by the binary digests of a hex
+    list or a packed array
+    """
+
+    if hashes is None:
+        return 0
+    elif isinstance(hashes, HashBlob):
+        return hashes.size
+    elif is_hash_array(hashes):
+        return len(hashes["hash-array"]) * 3 // 4
+    return len(hashes) * 16
+
+
+def _digests(hashes, width: int) -> Iterator[bytes]:
+    """
+    Yield binary digests cut to width
+    """
+
+    if isinstance(hashes, HashBlob):
+        for digest in hashes:
+            yield digest[:width]
+    elif is_hash_array(hashes):
+        for digest in HashArray.from_json(hashes):
+            yield digest[:width]
+    else:
+        for h in hashes:
+            yield bytes.fromhex(h)[:width]
+
+
+def write_runs(digests: Iterator[bytes], run_rows: int, directory: str) -> List[str]:
+    """
+    Write digests in sorted runs of at most run_rows digests each, one file
+    per run, and return the paths of the runs
+    """
+
+    paths = [] # type: List[str]
+    while True:
+        run = list(islice(digests, run_rows))
+        if len(run) == 0:
+            return paths
+
+        run.sort()
+        path = os.path.join(directory, f"run-{len(paths)}")
+        with open(path, "wb") as fp:
+            fp.write(b"".join(run))
+        paths.append(path)
+
+
+def read_run(path: str, width: int, buffer_rows: int) -> Iterator[bytes]:
+    """
+    Yield digests from a run, reading buffer_rows digests at a time
+    """
+
+    with open(path, "rb") as fp:
+        while True:
+            block = fp.read(width * buffer_rows)
+            if not block:
+                return
+            for start in range(0, len(block), width):
+                yield block[start:start + width]
+
+
+def sorted_digests(hashes, width: int, memory: int, directory: str) -> Iterator[bytes]:
+    """
+    Yield digests of hashes in sorted order keeping at most around `memory`
+    bytes of digests in memory. Packed arrays are already sorted, hex lists
+    are sorted in runs on disk which are then merged.
+    """
+
+    if hashes is None:
+        return iter([])
+    elif is_packed(hashes):
+        return _digests(hashes, width)
+
+    paths = write_runs(_digests(hashes, width), max(1, memory // width), directory)
+    buffer_rows = max(1, memory // (width * max(1, len(paths))))
+    return heapq.merge(*[read_run(path, width, buffer_rows) for path in paths])
+
+
+def _unique(digests: Iterator[bytes]) -> Iterator[bytes]:
+    last = None
+    for digest in digests:
+        if digest != last:
+            yield digest
+            last = digest
+
+
+def merge_counts(a: Iterator[bytes], b: Iterator[bytes]) -> Tuple[int, int]:
+    """
+    Return number of distinct digests only in a and only in b by scanning two
+    sorted streams of digests
+    """
+
+    a, b = _unique(a), _unique(b)
+    only_a = only_b = 0
+    a_item, b_item = next(a, None), next(b, None)
+
+    while a_item is not None and b_item is not None:
+        if a_item == b_item:
+            a_item, b_item = next(a, None), next(b, None)
+        elif a_item < b_item:
+            only_a += 1
+            a_item = next(a, None)
+        else:
+            only_b += 1
+            b_item = next(b, None)
+
+    if a_item is not None:
+        only_a += 1 + sum(1 for _ in a)
+    if b_item is not None:
+        only_b += 1 + sum(1 for _ in b)
+
+    return only_a, only_b
+
+
+def spill_diff_counts(old_hashes, new_hashes, memory: int, directory: Optional[str] = None) -> Tuple[int, int]:
+    """
+    Return (removed, added) counts of distinct digests between two hash lists
+    (hex lists, packed arrays, hash blobs or None), sorting them on disk
+    with about `memory` bytes of digests held in memory at a time. Runs go in
+    a temporary directory under `directory`, or the system's default.
+    """
+
+    widths = [hash_width(it) for it in [old_hashes, new_hashes] if is_packed(it)]
+    width = min(widths) if widths else 16
+
+    with tempfile.TemporaryDirectory(prefix="diffport-", dir=directory) as tmp_dir:
+        old_dir, new_dir = os.path.join(tmp_dir, "old"), os.path.join(tmp_dir, "new")
+        os.mkdir(old_dir)
+        os.mkdir(new_dir)
+
+        # Each side gets half of the memory
+        side_memory = max(width, memory // 2)
+        return merge_counts(
+            sorted_digests(old_hashes, width, side_memory, old_dir),
+            sorted_digests(new_hashes, width, side_memory, new_dir)
+        )
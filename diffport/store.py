@@ -2,77 +2,1158 @@
 Storate for snapshots
 """
 
-import gzip
+import base64
+import fcntl
+import hashlib
 import json
+import os
+import sqlite3
+import tempfile
+import uuid
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from .compression import Codec, GzipCodec, ZlibCodec, decode, encode, get_codec, train_zdict
+from .delta import make_delta, apply_delta
+from .hashes import HashBlob, is_hash_array, is_hash_blob, replace_hashes
 from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+
+# Default memory budget for decoded snapshots in bytes
+DEFAULT_CACHE_SIZE = 128 * 1024 * 1024
+
+# Packed hash arrays of at least these many bytes are kept in their own blobs
+DEFAULT_HASH_BLOB_SIZE = 1024 * 1024
+
+
+class SnapshotCache:
+    """
+    LRU cache for decoded snapshots bounded by a budget in bytes. The size of
+    an item is taken as the size of its uncompressed json serialization.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_CACHE_SIZE) -> None:
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.items = OrderedDict() # type: OrderedDict
+
+    def get(self, key):
+        """
+        Return cached value for key or None, marking it as recently used
+        """
+
+        item = self.get_item(key)
+        return None if item is None else item[0]
+
+    def get_item(self, key) -> Optional[Tuple[Any, int]]:
+        """
+        Like get but return a tuple of the value and its size
+        """
+
+        try:
+            item = self.items[key]
+        except KeyError:
+            self.misses += 1
+            return None
+
+        self.items.move_to_end(key)
+        self.hits += 1
+        return item
+
+    def put(self, key, value, size: int):
+        """
+        Cache value for key, evicting least recently used items to stay
+        within the budget. Items bigger than the whole budget are not kept.
+        """
+
+        self.pop(key)
+        if size > self.max_bytes:
+            return
+
+        self.items[key] = (value, size)
+        self.current_bytes += size
+        while self.current_bytes > self.max_bytes:
+            _, (_, evicted_size) = self.items.popitem(last=False)
+            self.current_bytes -= evicted_size
+
+    def pop(self, key):
+        """
+        Remove key from the cache if present
+        """
+
+        if key in self.items:
+            _, size = self.items.pop(key)
+            self.current_bytes -= size
+
+    def clear(self):
+        self.items.clear()
+        self.current_bytes = 0
 
 
 class Store(ABC):
+    """
+    Base class for snapshot stores. A stored snapshot is a manifest listing
+    a blob for each watcher. Blobs are compressed independently, so reading
+    some watchers of a snapshot only decodes the blobs for those. Decoded
+    blobs are served from an LRU cache so that repeated reports don't decode
+    the same data again, and data shared by snapshots is cached once.
+
+    codec is the spec of compression codec used for writing (see
+    diffport.compression). With `zlib:<level>:dict`, a preset dictionary is
+    trained from the latest snapshot and shared by the files written after.
+    Files are readable whatever the codec store is set to write with.
+
+    Packed hash arrays of at least hash_blob_size bytes are taken out of the
+    watcher data and kept uncompressed in their own hash blobs. The data
+    keeps a reference like {"hash-blob": <digest>, "width": <int>, "size": <int>},
+    and manifest items list the hash blobs they use. Readers can then stream
+    the digests instead of decoding the whole array.
+    """
+
+    def __init__(self, cache_size: int = DEFAULT_CACHE_SIZE, codec: str = "gzip:9") -> None:
+        self.cache = SnapshotCache(cache_size)
+        self.codec_spec = codec
+        self.hash_blob_size = DEFAULT_HASH_BLOB_SIZE
+
+    def get_write_codec(self) -> Codec:
+        """
+        Return codec for writing new files, training the dictionary if needed
+        """
+
+        name, *args = self.codec_spec.split(":")
+        if not (name == "zlib" and args[-1:] == ["dict"]):
+            return get_codec(self.codec_spec)
+
+        level = int(args[0]) if len(args) > 1 else 6
+        zdict_id = self.current_zdict_id()
+        if zdict_id is None:
+            index = self.get_index()
+            if len(index) == 0:
+                # Nothing to train with yet
+                return ZlibCodec(level)
+            latest = self.get_snapshot(index[0]["hash"])
+            samples = [json.dumps(item["data"], sort_keys=True).encode("utf-8") for item in latest["items"]]
+            zdict_id = self.save_zdict(train_zdict(samples))
+
+        return ZlibCodec(level, self.load_zdict(zdict_id))
 
     @abstractmethod
-    def get_snapshot(self, snap_hash):
+    def current_zdict_id(self) -> Optional[str]:
+        """
+        Return id of the dictionary to use for new files or None
+        """
+        ...
+
+    @abstractmethod
+    def save_zdict(self, zdict: bytes) -> str:
+        """
+        Save a trained dictionary, make it current and return its id
+        """
+        ...
+
+    @abstractmethod
+    def load_zdict(self, zdict_id: str) -> bytes:
+        ...
+
+    def get_snapshot(self, snap_hash, watchers: List[str] = None, cached: bool = True, lazy_hashes: bool = False):
+        """
+        Return snap item for hash or None if it is not in the store. If
+        watchers are given, only items for those are read and returned. With
+        cached False, blobs read from the backend are not kept in the cache.
+        Hash arrays kept in hash blobs are loaded back in the data, or with
+        lazy_hashes, given as HashBlob objects reading them from the store.
+        """
+
+        manifest = self.load_manifest(snap_hash)
+        if manifest is None:
+            return None
+
+        snap = {k: v for k, v in manifest.items() if k != "items"}
+        snap["items"] = []
+        for item in manifest["items"]:
+            if watchers is not None and item["watcher"] not in watchers:
+                continue
+            if "blob" in item:
+                # Older snapshots in directory store have the data inline
+                data = self.get_blob(item["blob"], cached)
+                if item.get("hash-blobs"):
+                    data = replace_hashes(data, lambda ref: self.open_hashes(ref, lazy_hashes))
+                item = {"watcher": item["watcher"], "data": data}
+            snap["items"].append(item)
+
+        return snap
+
+    def open_hashes(self, ref: Dict, lazy: bool):
+        """
+        Return HashBlob for a hash blob reference if lazy, else the json of
+        the packed array. Inline arrays are returned as is.
+        """
+
+        if not is_hash_blob(ref):
+            return ref
+
+        blob = HashBlob(lambda: self.read_hashes(ref["hash-blob"]), ref["width"], ref["size"])
+        return blob if lazy else blob.load().to_json()
+
+    @abstractmethod
+    def read_hashes(self, digest: str) -> Iterator[bytes]:
+        """
+        Yield the buffer of a hash blob in chunks
+        """
+        ...
+
+    def get_blob(self, digest: str, cached: bool = True):
+        """
+        Return decoded data of blob, going via the cache
+        """
+
+        return self.get_blob_item(digest, cached)[0]
+
+    def get_blob_item(self, digest: str, cached: bool = True) -> Tuple[Any, int]:
+        """
+        Like get_blob but return a tuple of the data and its decoded size
+        """
+
+        item = self.cache.get_item(digest)
+        if item is None:
+            item = self.load_blob(digest)
+            if cached:
+                self.cache.put(digest, *item)
+        return item
+
+    @abstractmethod
+    def load_manifest(self, snap_hash) -> Optional[Dict]:
+        """
+        Return manifest for the snapshot or None if not found. Items in the
+        manifest have a watcher name and either a blob digest or inline data.
+        """
+        ...
+
+    @abstractmethod
+    def load_blob(self, digest: str) -> Tuple[Any, int]:
+        """
+        Read data of blob from the backend. Return a tuple of the data and its
+        decoded size in bytes.
+        """
         ...
 
     @abstractmethod
     def get_index(self):
         ...
 
+    def has_snapshot(self, snap_hash) -> bool:
+        """
+        Tell whether a snapshot with the hash is in the store
+        """
+
+        return any(entry["hash"] == snap_hash for entry in self.get_index())
+
     @abstractmethod
-    def add_snapshot(self, snap):
+    def begin_snapshot(self) -> "SnapshotWriter":
+        """
+        Return a writer for adding a snapshot one watcher item at a time
+        """
         ...
 
+    def add_snapshot(self, snap) -> bool:
+        """
+        Add a complete snapshot to the store. Return False if it was already
+        present.
+        """
+
+        writer = self.begin_snapshot()
+        for item in snap["items"]:
+            writer.add_item(item["watcher"], item["data"])
+        return writer.commit({k: v for k, v in snap.items() if k != "items"})
+
     @abstractmethod
     def remove_snapshot(self, snap_hash):
+        """
+        Remove snapshot with the hash, raising KeyError if it is not in the
+        store
+        """
+        ...
+
+
+class SnapshotWriter(ABC):
+    """
+    Incremental writer for a snapshot. Items are persisted as soon as they are
+    added so only one watcher's output needs to be in memory at a time. The
+    snapshot becomes visible in the store only on commit.
+    """
+
+    @abstractmethod
+    def add_item(self, watcher: str, data, dump: str = None):
+        """
+        Write data for watcher. dump, if given, is the json serialization of
+        data with sorted keys and saves serializing the data again.
+        """
+        ...
+
+    @abstractmethod
+    def commit(self, meta: Dict) -> bool:
+        """
+        Make the snapshot with given metadata (hash, time and identifier)
+        visible in the store. If a snapshot with the same hash is already
+        present, drop this one (like abort) and return False.
+        """
+        ...
+
+    @abstractmethod
+    def abort(self):
+        """
+        Drop whatever was written for this snapshot
+        """
         ...
 
 class StoreDirectory(Store):
     """
     Store snapshots in a directory
+
+    Output of each watcher is kept once as a content addressed blob (a gzipped
+    json file named by the digest of its content) under the blobs directory.
+    Each snapshot file is a small manifest pointing to the blobs for its
+    watchers, so watcher output which didn't change between saves takes no
+    extra space.
+
+    With a non zero keyframe_interval, the store works in delta mode. A blob is
+    then saved as a delta against the blob of the same watcher in the previous
+    snapshot, with a full keyframe written after every keyframe_interval - 1
+    deltas in a chain. Delta blobs keep a reference to their base blob.
+    Hash blobs are raw files next to the other blobs and are never deltas.
+
+    A sidecar index file keeps the metadata (hash, time, identifier, file name
+    and size) of all the snapshots along with reference counts of blobs. This
+    way listing doesn't need to open any snapshot and reading one snapshot only
+    decompresses its own files. Snapshot files of older versions, with watcher
+    data inline, are converted to manifests when the index is built.
+
+    Several processes can use a store together. All files are written to a
+    temporary file first and renamed in place, and snapshot files are named
+    using both time and hash. Updates to the index are done under an exclusive
+    lock after reloading it. Each save in progress keeps a locked marker file
+    listing the blobs it uses, which removals don't collect. Savers only hold
+    a shared lock on the store while writing a blob and removals take it
+    exclusively, so a removal waits for at most one blob write.
     """
 
-    def __init__(self, directory_path: Path) -> None:
+    INDEX_FILE = "index.json"
+    INDEX_VERSION = 2
+    BLOBS_DIR = "blobs"
+    DICTS_DIR = "dicts"
+    PENDING_DIR = "pending"
+    INDEX_LOCK = "index.lock"
+    GC_LOCK = "gc.lock"
+
+    def __init__(self, directory_path: Path, cache_size: int = DEFAULT_CACHE_SIZE,
+                 keyframe_interval: int = 0, codec: str = "gzip:9") -> None:
+        super().__init__(cache_size, codec)
+        self.keyframe_interval = keyframe_interval
         self.path = directory_path
         self.path.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.path.joinpath(self.INDEX_FILE)
+        self.blobs_path = self.path.joinpath(self.BLOBS_DIR)
+        self.dicts_path = self.path.joinpath(self.DICTS_DIR)
+        self.pending_path = self.path.joinpath(self.PENDING_DIR)
+        self.write_codec = None # type: Optional[Codec]
+
+        self.init_index()
+
+    @contextmanager
+    def lock(self, name: str, shared: bool = False, blocking: bool = True):
+        """
+        Hold an advisory lock on the named lock file. Raises BlockingIOError
+        if not blocking and the lock is taken.
+        """
+
+        with self.path.joinpath(name).open("a") as fp:
+            flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+            fcntl.flock(fp.fileno(), flags if blocking else flags | fcntl.LOCK_NB)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+    def init_index(self):
+        """
+        Load the sidecar index, building it from the snapshot files if it is
+        not present (e.g. for stores written by older versions)
+        """
+
+        if not self.index_path.is_file():
+            with self.lock(self.INDEX_LOCK):
+                if not self.index_path.is_file():
+                    self.rebuild_index()
+                    return
+
+        self.load_index()
+
+    def load_index(self):
+        """
+        Read the index from disk. The index is replaced atomically so this
+        doesn't need a lock.
+        """
+
+        with self.index_path.open() as fp:
+            index = json.load(fp)
+
+        self.entries = {entry["hash"]: entry for entry in index["snapshots"]} # type: Dict[str, Dict]
+        self.blobs = index.get("blobs", {}) # type: Dict[str, Dict]
+        self.zdict_id = index.get("zdict") # type: Optional[str]
+
+    def rebuild_index(self):
+        self.entries = {}
+        self.blobs = {}
+        self.zdict_id = None
+
+        # Files converted from older versions are written as gzip, like the
+        # files they replace
+        write_codec, self.write_codec = self.write_codec, GzipCodec()
+        try:
+            files = [it for it in self.path.iterdir() if it.is_file() and it.suffix == ".gz"]
+            for sf in files:
+                snap, _ = self.read_file(sf)
+                if any("blob" not in item for item in snap["items"]):
+                    snap = self.convert_inline(snap, sf)
+                self.entries[snap["hash"]] = self.make_entry(snap, sf)
+                for digest in manifest_blobs(snap):
+                    self.ref_blob(digest)
+        finally:
+            self.write_codec = write_codec
+        self.write_index()
+
+    def convert_inline(self, snap, snap_file: Path) -> Dict:
+        """
+        Move watcher data kept inline in a snapshot file by older versions to
+        blobs and rewrite the file as a manifest. Reads then go via the cache
+        and partial reads only decode the blobs they need.
+        """
+
+        items = []
+        for item in snap["items"]:
+            if "blob" not in item:
+                digest, _ = self.put_blob(item["data"])
+                item = {"watcher": item["watcher"], "blob": digest}
+            items.append(item)
+
+        manifest = dict(snap)
+        manifest["items"] = items
+        self.write_file(snap_file, json.dumps(manifest))
+        return manifest
+
+    def write_index(self):
+        dump = json.dumps({
+            "version": self.INDEX_VERSION,
+            "snapshots": list(self.entries.values()),
+            "blobs": self.blobs,
+            "zdict": self.zdict_id
+        })
+        atomic_write(self.index_path, [dump.encode("utf-8")])
+
+    def current_zdict_id(self):
+        return self.zdict_id
+
+    def save_zdict(self, zdict: bytes) -> str:
+        zdict_id = ZlibCodec.dict_id(zdict)
+        self.dicts_path.mkdir(parents=True, exist_ok=True)
+        atomic_write(self.dicts_path.joinpath(f"{zdict_id}.zdict"), [zdict])
+
+        with self.lock(self.INDEX_LOCK):
+            self.load_index()
+            self.zdict_id = zdict_id
+            self.write_index()
+        return zdict_id
+
+    def load_zdict(self, zdict_id: str) -> bytes:
+        return self.dicts_path.joinpath(f"{zdict_id}.zdict").read_bytes()
+
+    def read_file(self, json_file: Path):
+        """
+        Return decoded json from a snapshot file along with its uncompressed
+        size. Snapshot files keep the .gz suffix whatever their codec is.
+        """
+
+        raw = decode(json_file.read_bytes(), self.load_zdict)
+        return json.loads(raw.decode("utf-8")), len(raw)
+
+    def write_file(self, json_file: Path, dump: str):
+        """
+        Write json dump string to a snapshot file using the store's codec
+        """
+
+        if self.write_codec is None:
+            self.write_codec = self.get_write_codec()
 
-        # Load everything upfront
-        # TODO: Don't load everything upfront
-        self.init_snaps()
+        json_file.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write(json_file, encode((chunk.encode("utf-8") for chunk in chunks(dump)), self.write_codec))
 
-    def init_snaps(self):
-        self.snaps = []
-        files = [it for it in self.path.iterdir() if it.is_file() and it.suffix == ".gz"]
+    @staticmethod
+    def make_entry(snap, snap_file: Path) -> Dict:
+        """
+        Return index entry for the snap stored in snap_file
+        """
+
+        entry = {k: v for k, v in snap.items() if k != "items"}
+        entry["file"] = snap_file.name
+        entry["size"] = snap_file.stat().st_size
+        return entry
+
+    def blob_file(self, digest: str, delta: bool = None) -> Path:
+        """
+        Return path for blob. Delta blobs get a different suffix so that they
+        can be told apart even without the index.
+        """
+
+        if delta is None:
+            delta = "base" in self.blobs.get(digest, {})
+        suffix = ".delta.gz" if delta else ".gz"
+        return self.blobs_path.joinpath(digest[:2], f"{digest}{suffix}")
+
+    def hashes_file(self, digest: str) -> Path:
+        return self.blobs_path.joinpath(digest[:2], f"{digest}.hashes")
+
+    def ref_blob(self, digest: str):
+        """
+        Increment reference count of blob with the given digest
+        """
+
+        if digest in self.blobs:
+            self.blobs[digest]["refs"] += 1
+            return
+
+        blob_file = self.blob_file(digest, delta=False)
+        hashes_file = self.hashes_file(digest)
+        if blob_file.exists():
+            self.blobs[digest] = {"refs": 1, "size": blob_file.stat().st_size}
+        elif hashes_file.exists():
+            self.blobs[digest] = {"refs": 1, "size": hashes_file.stat().st_size, "hashes": True}
+        else:
+            # A delta blob not in the index yet, read its base from the file
+            blob_file = self.blob_file(digest, delta=True)
+            content, _ = self.read_file(blob_file)
+            self.blobs[digest] = {
+                "refs": 1,
+                "size": blob_file.stat().st_size,
+                "base": content["base"],
+                "depth": content["depth"]
+            }
+            self.ref_blob(content["base"])
+
+    def unref_blob(self, digest: str, pending: Set[str] = None):
+        """
+        Decrement reference count of blob, deleting it if not used anymore.
+        Files of pending blobs (used by saves in progress) are kept.
+        """
+
+        blob = self.blobs.get(digest)
+        if blob is None:
+            return
+
+        blob["refs"] -= 1
+        if blob["refs"] <= 0:
+            blob_file = self.hashes_file(digest) if blob.get("hashes") else self.blob_file(digest)
+            self.blobs.pop(digest)
+            if blob_file.exists() and digest not in (pending or set()):
+                blob_file.unlink()
+            if "base" in blob:
+                self.unref_blob(blob["base"], pending)
+
+    def put_blob(self, data, base: str = None, dump: str = None) -> Tuple[str, Optional[Path]]:
+        """
+        Write watcher data as a blob if not already present. Return its digest
+        and the file written, if any. In delta mode, base is the digest of the
+        blob to delta against. The blob is added to the index only when a
+        snapshot referring to it is committed.
+        """
+
+        dump, digest = dump_digest(data, dump)
+
+        # The files are checked rather than the index, which might be older
+        # than a removal that collected the blob
+        if self.blob_file(digest, delta=False).exists() or self.blob_file(digest, delta=True).exists():
+            return digest, None
+
+        if self.keyframe_interval and base in self.blobs:
+            depth = self.blobs[base].get("depth", 0) + 1
+            if depth < self.keyframe_interval:
+                delta_dump = json.dumps({
+                    "base": base,
+                    "depth": depth,
+                    "delta": make_delta(self.get_blob(base), data)
+                })
+                if len(delta_dump) < len(dump):
+                    blob_file = self.blob_file(digest, delta=True)
+                    self.write_file(blob_file, delta_dump)
+                    return digest, blob_file
+
+        blob_file = self.blob_file(digest, delta=False)
+        self.write_file(blob_file, dump)
+        return digest, blob_file
+
+    def put_hashes(self, buffer: bytes) -> Tuple[str, Optional[Path]]:
+        """
+        Write buffer of a packed hash array as a hash blob if not already
+        present. Return its digest and the file written, if any.
+        """
+
+        digest = hashlib.sha1(buffer).hexdigest()
+        hashes_file = self.hashes_file(digest)
+        if hashes_file.exists():
+            return digest, None
+
+        hashes_file.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write(hashes_file, [buffer])
+        return digest, hashes_file
+
+    def read_hashes(self, digest: str):
+        with self.hashes_file(digest).open("rb") as fp:
+            while True:
+                chunk = fp.read(CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+
+    def load_blob(self, digest: str):
+        """
+        Read data for blob. Delta blobs are applied over their base which in
+        turn comes via the cache, so walking a chain reuses decoded bases. The
+        size of a delta blob is taken as its base's size plus the delta's.
+        """
+
+        if "base" in self.blobs.get(digest, {}):
+            content, size = self.read_file(self.blob_file(digest, delta=True))
+            base, base_size = self.get_blob_item(content["base"])
+            return apply_delta(base, content["delta"]), base_size + size
+
+        return self.read_file(self.blob_file(digest, delta=False))
+
+    def latest_blobs(self) -> Dict[str, str]:
+        """
+        Return mapping of watcher name to blob digest for the latest snapshot
+        """
+
+        if len(self.entries) == 0:
+            return {}
 
-        for sf in files:
-            with gzip.open(sf) as fp:
-                self.snaps.append(json.loads(fp.read().decode("utf-8")))
+        latest = max(self.entries.values(), key=lambda entry: entry["time"])
+        manifest, _ = self.read_file(self.path.joinpath(latest["file"]))
+        return {item["watcher"]: item["blob"] for item in reversed(manifest["items"]) if "blob" in item}
 
     def get_index(self):
         """
         Return a thin index of items in store
         """
 
-        return sorted([
-            {k:v for k, v in snap.items() if k != "items"} for snap in self.snaps
-        ], key=lambda x: x["time"], reverse=True)
+        return sorted([dict(entry) for entry in self.entries.values()], key=lambda x: x["time"], reverse=True)
 
-    def get_snapshot(self, snap_hash):
+    def has_snapshot(self, snap_hash) -> bool:
+        return snap_hash in self.entries
+
+    def load_manifest(self, snap_hash):
+        entry = self.entries.get(snap_hash)
+        if entry is None:
+            return None
+        return self.read_file(self.path.joinpath(entry["file"]))[0]
+
+    def begin_snapshot(self):
+        return DirectoryWriter(self)
+
+    def remove_snapshot(self, snap_hash):
+        with self.lock(self.GC_LOCK), self.lock(self.INDEX_LOCK):
+            self.load_index()
+            entry = self.entries.pop(snap_hash)
+            snap_file = self.path.joinpath(entry["file"])
+            pending = self.pending_digests()
+
+            manifest, _ = self.read_file(snap_file)
+            for digest in manifest_blobs(manifest):
+                self.unref_blob(digest, pending)
+
+            self.write_index()
+            snap_file.unlink()
+            self.sweep(pending)
+
+    def open_marker(self):
+        """
+        Create the marker of a save in progress and return it open. The marker
+        stays locked for as long as the save runs. Needs the shared store lock
+        so that a removal doesn't take it for a crashed save's marker.
+        """
+
+        self.pending_path.mkdir(parents=True, exist_ok=True)
+        marker = self.pending_path.joinpath(f"{uuid.uuid4().hex}.pending").open("a")
+        fcntl.flock(marker.fileno(), fcntl.LOCK_EX)
+        return marker
+
+    def pending_digests(self) -> Set[str]:
+        """
+        Return digests of blobs used by saves in progress, along with the
+        bases of pending delta blobs which are needed to read them. Markers
+        which are not locked anymore are left by crashed saves and are
+        deleted. Needs the exclusive store lock so that no marker is being
+        written, and the index loaded to find the bases.
+        """
+
+        digests = set() # type: Set[str]
+        for marker_file in self.pending_path.glob("*.pending"):
+            with marker_file.open() as fp:
+                try:
+                    fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    digests.update(line.strip() for line in fp if line.strip())
+                    continue
+            marker_file.unlink()
+
+        for digest in list(digests):
+            while "base" in self.blobs.get(digest, {}):
+                digest = self.blobs[digest]["base"]
+                digests.add(digest)
+
+        return digests
+
+    def sweep(self, pending: Set[str] = None):
         """
-        Return snap item for hash
+        Delete files not known to the index, left by aborted or crashed saves,
+        except the pending blobs of saves in progress. Needs the exclusive
+        store lock so that no blob is being written.
         """
 
+        pending = self.pending_digests() if pending is None else pending
+        known_files = {entry["file"] for entry in self.entries.values()}
+        for snap_file in self.path.glob("*.gz"):
+            if snap_file.name not in known_files:
+                snap_file.unlink()
+
+        for pattern in ["*/*.gz", "*/*.hashes"]:
+            for blob_file in self.blobs_path.glob(pattern):
+                digest = blob_file.name.split(".")[0]
+                if digest not in self.blobs and digest not in pending:
+                    blob_file.unlink()
+
+        for tmp_file in self.path.glob("**/.*.tmp"):
+            tmp_file.unlink()
+
+
+class StoreSQLite(Store):
+    """
+    Store snapshots in a SQLite database inside the given directory
+
+    Snapshot metadata goes in an indexed table so that lookups by hash, time or
+    identifier don't scan all the snapshots. Like StoreDirectory, output of each
+    watcher is kept once as a reference counted, compressed blob keyed by the
+    digest of its content. Adding and removing snapshots are single
+    transactions. Hash blobs have an empty payload in the blobs table, with
+    the buffer split in rows of hash_chunks so that it can be read a chunk at
+    a time.
+    """
+
+    DB_FILE = "snapshots.sqlite"
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS snapshots (
+             hash TEXT PRIMARY KEY,
+             time INTEGER NOT NULL,
+             identifier TEXT
+           )""",
+        "CREATE INDEX IF NOT EXISTS snapshots_time ON snapshots (time)",
+        "CREATE INDEX IF NOT EXISTS snapshots_identifier ON snapshots (identifier)",
+        """CREATE TABLE IF NOT EXISTS blobs (
+             digest TEXT PRIMARY KEY,
+             refs INTEGER NOT NULL,
+             payload BLOB NOT NULL
+           )""",
+        """CREATE TABLE IF NOT EXISTS items (
+             snap_hash TEXT NOT NULL REFERENCES snapshots (hash),
+             position INTEGER NOT NULL,
+             watcher TEXT NOT NULL,
+             digest TEXT NOT NULL REFERENCES blobs (digest),
+             PRIMARY KEY (snap_hash, position)
+           )""",
+        "CREATE INDEX IF NOT EXISTS items_digest ON items (digest)",
+        """CREATE TABLE IF NOT EXISTS item_hashes (
+             snap_hash TEXT NOT NULL REFERENCES snapshots (hash),
+             position INTEGER NOT NULL,
+             digest TEXT NOT NULL REFERENCES blobs (digest)
+           )""",
+        "CREATE INDEX IF NOT EXISTS item_hashes_snap_hash ON item_hashes (snap_hash)",
+        """CREATE TABLE IF NOT EXISTS hash_chunks (
+             digest TEXT NOT NULL REFERENCES blobs (digest),
+             position INTEGER NOT NULL,
+             payload BLOB NOT NULL,
+             PRIMARY KEY (digest, position)
+           )""",
+        """CREATE TABLE IF NOT EXISTS dicts (
+             id TEXT PRIMARY KEY,
+             zdict BLOB NOT NULL,
+             created INTEGER NOT NULL
+           )"""
+    ]
+
+    def __init__(self, directory_path: Path, cache_size: int = DEFAULT_CACHE_SIZE, codec: str = "zlib:6") -> None:
+        super().__init__(cache_size, codec)
+        self.path = directory_path
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        # Transactions are handled explicitly, waiting on other writers
+        self.conn = sqlite3.connect(str(self.path.joinpath(self.DB_FILE)), timeout=60, isolation_level=None)
+        with self.transaction():
+            for stmt in self.SCHEMA:
+                self.conn.execute(stmt)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run a write transaction, taking the database write lock upfront
+        """
+
+        self.conn.execute("BEGIN IMMEDIATE")
         try:
-            return next((snap for snap in self.snaps if snap["hash"] == snap_hash))
-        except IndexError:
+            yield
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def current_zdict_id(self):
+        row = self.conn.execute("SELECT id FROM dicts ORDER BY created DESC LIMIT 1").fetchone()
+        return None if row is None else row[0]
+
+    def save_zdict(self, zdict: bytes) -> str:
+        zdict_id = ZlibCodec.dict_id(zdict)
+        with self.transaction():
+            self.conn.execute(
+                "INSERT OR REPLACE INTO dicts (id, zdict, created) VALUES (?, ?, (SELECT count(*) FROM dicts))",
+                (zdict_id, zdict)
+            )
+        return zdict_id
+
+    def load_zdict(self, zdict_id: str) -> bytes:
+        return self.conn.execute("SELECT zdict FROM dicts WHERE id = ?", (zdict_id,)).fetchone()[0]
+
+    @staticmethod
+    def make_entry(row) -> Dict:
+        # Databases made by older versions have a REAL time column
+        time = int(row[1]) if isinstance(row[1], float) and row[1].is_integer() else row[1]
+        entry = {"hash": row[0], "time": time}
+        if row[2] is not None:
+            entry["identifier"] = row[2]
+        return entry
+
+    def get_index(self):
+        """
+        Return a thin index of items in store
+        """
+
+        rows = self.conn.execute("SELECT hash, time, identifier FROM snapshots ORDER BY time DESC")
+        return [self.make_entry(row) for row in rows]
+
+    def has_snapshot(self, snap_hash) -> bool:
+        row = self.conn.execute("SELECT 1 FROM snapshots WHERE hash = ?", (snap_hash,)).fetchone()
+        return row is not None
+
+    def load_manifest(self, snap_hash):
+        row = self.conn.execute("SELECT hash, time, identifier FROM snapshots WHERE hash = ?", (snap_hash,)).fetchone()
+        if row is None:
             return None
 
-    def add_snapshot(self, snap):
-        self.snaps.append(snap)
+        manifest = self.make_entry(row)
+        rows = self.conn.execute(
+            "SELECT watcher, digest FROM items WHERE snap_hash = ? ORDER BY position",
+            (snap_hash,)
+        )
+        manifest["items"] = [{"watcher": watcher, "blob": digest} for watcher, digest in rows]
+
+        rows = self.conn.execute("SELECT position, digest FROM item_hashes WHERE snap_hash = ? ORDER BY rowid", (snap_hash,))
+        for position, digest in rows:
+            manifest["items"][position].setdefault("hash-blobs", []).append(digest)
+        return manifest
+
+    def load_blob(self, digest: str):
+        payload = self.conn.execute("SELECT payload FROM blobs WHERE digest = ?", (digest,)).fetchone()[0]
+        raw = decode(payload, self.load_zdict)
+        return json.loads(raw.decode("utf-8")), len(raw)
 
-        with gzip.open(self.path.joinpath(f"{snap['time']}.gz"), "w") as fp:
-            fp.write(json.dumps(snap).encode("utf-8"))
+    def read_hashes(self, digest: str):
+        rows = self.conn.execute("SELECT payload FROM hash_chunks WHERE digest = ? ORDER BY position", (digest,))
+        for (payload,) in rows:
+            yield payload
+
+    def begin_snapshot(self):
+        return SQLiteWriter(self)
 
     def remove_snapshot(self, snap_hash):
-        snap_idx = next((idx for idx, it in enumerate(self.snaps) if it["hash"] == snap_hash))
-        self.path.joinpath(str(self.snaps[snap_idx]["time"]) + ".gz").unlink()
-        self.snaps.pop(snap_idx)
+        with self.transaction():
+            if not self.has_snapshot(snap_hash):
+                # Same as StoreDirectory
+                raise KeyError(snap_hash)
+
+            for table in ["items", "item_hashes"]:
+                self.conn.execute(f"""UPDATE blobs
+                  SET refs = refs - (SELECT count(*) FROM {table}
+                                      WHERE {table}.snap_hash = ? AND {table}.digest = blobs.digest)
+                  WHERE digest IN (SELECT digest FROM {table} WHERE snap_hash = ?)""", (snap_hash, snap_hash))
+                self.conn.execute(f"DELETE FROM {table} WHERE snap_hash = ?", (snap_hash,))
+            self.conn.execute("DELETE FROM snapshots WHERE hash = ?", (snap_hash,))
+            self.conn.execute("DELETE FROM hash_chunks WHERE digest IN (SELECT digest FROM blobs WHERE refs <= 0)")
+            self.conn.execute("DELETE FROM blobs WHERE refs <= 0")
+
+
+class DirectoryWriter(SnapshotWriter):
+    """
+    Snapshot writer for StoreDirectory. Blobs are written as items come in,
+    the manifest and index are written on commit.
+    """
+
+    def __init__(self, store: StoreDirectory) -> None:
+        self.store = store
+        self.items = [] # type: List[Dict]
+        self.created = [] # type: List[Path]
+
+        with store.lock(store.GC_LOCK, shared=True):
+            store.load_index()
+            store.write_codec = store.get_write_codec()
+            self.bases = store.latest_blobs() if store.keyframe_interval else {}
+
+            # Blobs used by the save, starting with the delta bases, are listed
+            # in its marker so that removals leave them alone until commit
+            self.marker = store.open_marker()
+            self.mark(self.bases.values())
+
+    def mark(self, digests: Iterable[str]):
+        for digest in digests:
+            self.marker.write(digest + "\n")
+        self.marker.flush()
+
+    def close_marker(self):
+        if not self.marker.closed:
+            Path(self.marker.name).unlink()
+            self.marker.close()
+
+    def add_item(self, watcher: str, data, dump: str = None):
+        store = self.store
+        with store.lock(store.GC_LOCK, shared=True):
+            data, hash_digests = split_hashes(data, store.hash_blob_size, self.put_hashes)
+            digest, blob_file = store.put_blob(data, self.bases.get(watcher), None if hash_digests else dump)
+            self.mark([digest])
+
+        if blob_file is not None:
+            self.created.append(blob_file)
+        item = {"watcher": watcher, "blob": digest} # type: Dict[str, Any]
+        if hash_digests:
+            item["hash-blobs"] = hash_digests
+        self.items.append(item)
+
+    def put_hashes(self, buffer: bytes) -> str:
+        digest, hashes_file = self.store.put_hashes(buffer)
+        self.mark([digest])
+        if hashes_file is not None:
+            self.created.append(hashes_file)
+        return digest
+
+    def commit(self, meta: Dict):
+        manifest = dict(meta)
+        manifest["items"] = self.items
+        store = self.store
+
+        with store.lock(store.INDEX_LOCK):
+            store.load_index()
+            if meta["hash"] in store.entries:
+                added = False
+            else:
+                snap_file = store.path.joinpath(f"{meta['time']}-{meta['hash'][:12]}.gz")
+                store.write_file(snap_file, json.dumps(manifest))
+
+                for digest in manifest_blobs(manifest):
+                    store.ref_blob(digest)
+                store.entries[meta["hash"]] = store.make_entry(manifest, snap_file)
+                store.write_index()
+                added = True
+
+            if added:
+                # Blobs are referred by the index now
+                self.close_marker()
+
+        if not added:
+            self.abort()
+        return added
+
+    def abort(self):
+        """
+        Drop the marker and delete the blobs written by this writer unless the
+        index or another save in progress uses them
+        """
+
+        store = self.store
+        with store.lock(store.GC_LOCK), store.lock(store.INDEX_LOCK):
+            self.close_marker()
+            store.load_index()
+            pending = store.pending_digests()
+            for blob_file in self.created:
+                digest = blob_file.name.split(".")[0]
+                if digest not in store.blobs and digest not in pending and blob_file.exists():
+                    blob_file.unlink()
+
+
+class SQLiteWriter(SnapshotWriter):
+    """
+    Snapshot writer for StoreSQLite. Items are compressed as they come in and
+    everything is written in one short transaction on commit, so the database
+    isn't locked while watchers run. Buffers of hash blobs are kept in a
+    temporary file until then rather than in memory.
+    """
+
+    def __init__(self, store: StoreSQLite) -> None:
+        self.store = store
+        self.codec = store.get_write_codec()
+        self.items = [] # type: List[Tuple[str, str, bytes, List[str]]]
+        # Offset and size of hash blobs in the temporary file
+        self.hashes = {} # type: Dict[str, Tuple[int, int]]
+        self.hashes_file = None # type: Any
+
+    def add_item(self, watcher: str, data, dump: str = None):
+        data, hash_digests = split_hashes(data, self.store.hash_blob_size, self.put_hashes)
+        dump, digest = dump_digest(data, None if hash_digests else dump)
+        payload = b"".join(encode((chunk.encode("utf-8") for chunk in chunks(dump)), self.codec))
+        self.items.append((watcher, digest, payload, hash_digests))
+
+    def put_hashes(self, buffer: bytes) -> str:
+        digest = hashlib.sha1(buffer).hexdigest()
+        if digest not in self.hashes:
+            if self.hashes_file is None:
+                self.hashes_file = tempfile.TemporaryFile(prefix=".hashes-", dir=str(self.store.path))
+            self.hashes[digest] = (self.hashes_file.tell(), len(buffer))
+            self.hashes_file.write(buffer)
+        return digest
+
+    def read_hashes(self, offset: int, size: int) -> Iterator[bytes]:
+        """
+        Yield a hash blob from the temporary file in chunks
+        """
+
+        for start in range(offset, offset + size, CHUNK_SIZE):
+            self.hashes_file.seek(start)
+            yield self.hashes_file.read(min(CHUNK_SIZE, offset + size - start))
+
+    def commit(self, meta: Dict):
+        conn = self.store.conn
+
+        with self.store.transaction():
+            if self.store.has_snapshot(meta["hash"]):
+                self.abort()
+                return False
+
+            conn.execute(
+                "INSERT INTO snapshots (hash, time, identifier) VALUES (?, ?, ?)",
+                (meta["hash"], meta["time"], meta.get("identifier"))
+            )
+            for digest, (offset, size) in self.hashes.items():
+                inserted = conn.execute(
+                    "INSERT OR IGNORE INTO blobs (digest, refs, payload) VALUES (?, 0, ?)",
+                    (digest, b"")
+                ).rowcount
+                if inserted:
+                    conn.executemany(
+                        "INSERT INTO hash_chunks (digest, position, payload) VALUES (?, ?, ?)",
+                        ((digest, position, chunk) for position, chunk in enumerate(self.read_hashes(offset, size)))
+                    )
+
+            for position, (watcher, digest, payload, hash_digests) in enumerate(self.items):
+                conn.execute("INSERT OR IGNORE INTO blobs (digest, refs, payload) VALUES (?, 0, ?)", (digest, payload))
+                conn.execute("UPDATE blobs SET refs = refs + 1 WHERE digest = ?", (digest,))
+                conn.execute(
+                    "INSERT INTO items (snap_hash, position, watcher, digest) VALUES (?, ?, ?, ?)",
+                    (meta["hash"], position, watcher, digest)
+                )
+                for hash_digest in hash_digests:
+                    conn.execute("UPDATE blobs SET refs = refs + 1 WHERE digest = ?", (hash_digest,))
+                    conn.execute(
+                        "INSERT INTO item_hashes (snap_hash, position, digest) VALUES (?, ?, ?)",
+                        (meta["hash"], position, hash_digest)
+                    )
+
+        self.abort()
+        return True
+
+    def abort(self):
+        self.items = []
+        self.hashes = {}
+        if self.hashes_file is not None:
+            self.hashes_file.close()
+            self.hashes_file = None
+
+
+# Number of characters to encode at a time when hashing or writing dumps
+CHUNK_SIZE = 1 << 20
+
+
+def chunks(text: str) -> Iterator[str]:
+    for start in range(0, len(text), CHUNK_SIZE):
+        yield text[start:start + CHUNK_SIZE]
+
+
+def dump_digest(data, dump: str = None) -> Tuple[str, str]:
+    """
+    Return sorted json dump of watcher data along with its digest. The dump is
+    only computed if not given.
+    """
+
+    if dump is None:
+        dump = json.dumps(data, sort_keys=True)
+
+    hasher = hashlib.sha1()
+    for chunk in chunks(dump):
+        hasher.update(chunk.encode("utf-8"))
+    return dump, hasher.hexdigest()
+
+
+def atomic_write(target: Path, chunks: Iterable[bytes]):
+    """
+    Write chunks to a temporary file next to target and rename it in place,
+    so that readers never see a partially written file
+    """
+
+    tmp_file = target.parent.joinpath(f".{target.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        with tmp_file.open("wb") as fp:
+            for chunk in chunks:
+                fp.write(chunk)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(str(tmp_file), str(target))
+    except BaseException:
+        if tmp_file.exists():
+            tmp_file.unlink()
+        raise
+
+
+def split_hashes(data, min_size: int, put_hashes: Callable[[bytes], str]) -> Tuple[Any, List[str]]:
+    """
+    Move packed hash arrays of at least min_size bytes out of watcher data,
+    writing their buffers using put_hashes which returns the digest. Return
+    data with references in place of the arrays and the digests used.
+    """
+
+    digests = [] # type: List[str]
+
+    def _split(obj):
+        if not is_hash_array(obj) or len(obj["hash-array"]) * 3 // 4 < min_size:
+            return obj
+
+        buffer = base64.b64decode(obj["hash-array"])
+        digests.append(put_hashes(buffer))
+        return {"hash-blob": digests[-1], "width": obj["width"], "size": len(buffer)}
+
+    return replace_hashes(data, _split), digests
+
+
+def manifest_blobs(manifest) -> List[str]:
+    """
+    Return digests of blobs, including hash blobs, referred by a snapshot
+    manifest
+    """
+
+    return [digest for item in manifest["items"] if "blob" in item
+            for digest in [item["blob"], *item.get("hash-blobs", [])]]
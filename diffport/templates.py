@@ -86,7 +86,17 @@ tpl_table_change = tpl("""## Tables changes
 {% if changed_tables|length > 0 -%}
   {% for table in changed_tables -%}
     - {{ table }}
+    {%- if table in ranges %} (`{{ ranges[table].key }}` in
+      {%- for r in ranges[table].ranges %} {% if r[0] is none %}NULL{% else %}[{{ r[0] }}, {{ r[1] }}){% endif %}{{ "," if not loop.last }}{% endfor %})
+    {%- endif %}
   {% endfor -%}
 {% else -%}
   *None*
+{% endif %}
+{%- if skipped_tables|length > 0 %}
+Not compared since the digest mode changed:
+
+  {% for table in skipped_tables -%}
+    - {{ table }}
+  {% endfor -%}
 {% endif %}""")
@@ -4,9 +4,15 @@ Modules for watchers
 
 from abc import ABC, abstractmethod
 from tabulate import tabulate
-from typing import Dict, List, Any, Tuple, Union, Callable
+from typing import Dict, Iterable, Iterator, List, Any, Optional, Tuple, Union, Callable
 from .templates import *
-from functools import partial
+from .hashes import HashArray, HashBlob, as_hash_array, batch_diff_counts, count_sub, is_hash_array
+from .spill import hashes_size, spill_diff_counts
+from .catalog import get_catalog
+from .query import DEFAULT_BATCH_SIZE, copy_binary_values, copy_text_lines, parallel_query, stream_query
+import hashlib
+import json
+from itertools import groupby
 from copy import deepcopy
 from pydash import py_
 
@@ -17,6 +23,98 @@ SnapList = List[SnapItem]
 Snap = Dict[str, Any]
 
 
+def _hashable(item_id):
+    """
+    Return a hashable version of an item identifier, which can be a list
+    of grouped column values
+    """
+
+    if isinstance(item_id, (list, tuple)):
+        return tuple(_hashable(it) for it in item_id)
+    elif isinstance(item_id, dict):
+        return json.dumps(item_id, sort_keys=True)
+    return item_id
+
+
+def _is_sorted(items: SnapList) -> bool:
+    """
+    Tell whether items are sorted on their identifiers with no repeats. Items
+    from the watchers' ORDER BY queries usually are, but the database's order
+    (collations, NULLs) need not be python's so this is checked.
+    """
+
+    ids = [item[0] for item in items] # type: List[Any]
+    try:
+        return all(ids[idx] < ids[idx + 1] for idx in range(len(ids) - 1))
+    except TypeError:
+        return False
+
+
+def split_items(a: SnapList, b: SnapList) -> Tuple[SnapList, SnapList, SnapList, SnapList]:
+    """
+    Return (common_a, common_b, only_a, only_b) for SnapLists a and b in
+    linear time. Common items are ordered as in a, paired with the first
+    item of b with the same identifier. Items only in a or only in b keep
+    their order. Sorted inputs are merged, others are joined using a hash
+    table on the identifiers of b.
+    """
+
+    if _is_sorted(a) and _is_sorted(b):
+        try:
+            return _merge_split(a, b)
+        except TypeError:
+            # Each side is sorted but identifiers don't compare across the
+            # two, like when a group column changed type between snapshots
+            pass
+
+    # Items are indexed rather than unpacked as some carry more than an
+    # identifier and data (like aggregated groups with their digest)
+    b_index = {} # type: Dict[Any, int]
+    for idx, item in enumerate(b):
+        b_index.setdefault(_hashable(item[0]), idx)
+
+    common_a, common_b, only_a = [], [], []
+    a_keys = set()
+    for item in a:
+        key = _hashable(item[0])
+        a_keys.add(key)
+        idx_b = b_index.get(key)
+        if idx_b is None:
+            only_a.append(item)
+        else:
+            common_a.append((item[0], item[1]))
+            common_b.append((item[0], b[idx_b][1]))
+
+    only_b = [item for item in b if _hashable(item[0]) not in a_keys]
+    return common_a, common_b, only_a, only_b
+
+
+def _merge_split(a: SnapList, b: SnapList) -> Tuple[SnapList, SnapList, SnapList, SnapList]:
+    """
+    split_items for inputs sorted on unique identifiers
+    """
+
+    common_a, common_b, only_a, only_b = [], [], [], []
+    idx_a = idx_b = 0
+    while idx_a < len(a) and idx_b < len(b):
+        id_a, id_b = a[idx_a][0], b[idx_b][0] # type: Any, Any
+        if id_a == id_b:
+            common_a.append((id_a, a[idx_a][1]))
+            common_b.append((id_a, b[idx_b][1]))
+            idx_a += 1
+            idx_b += 1
+        elif id_a < id_b:
+            only_a.append(a[idx_a])
+            idx_a += 1
+        else:
+            only_b.append(b[idx_b])
+            idx_b += 1
+
+    only_a += a[idx_a:]
+    only_b += b[idx_b:]
+    return common_a, common_b, only_a, only_b
+
+
 def items_common(a: SnapList, b: SnapList) -> Tuple[SnapList, SnapList]:
     """
     Return new [a, b] for SnapItems that are present in a AND b.
@@ -24,15 +122,8 @@ def items_common(a: SnapList, b: SnapList) -> Tuple[SnapList, SnapList]:
     ordered as in a.
     """
 
-    n_a = []
-    n_b = []
-    for item_id, item_data in a:
-        idx_b = py_.find_index(b, lambda x: x[0] == item_id)
-        if idx_b > -1:
-            n_a.append((item_id, item_data))
-            n_b.append((item_id, b[idx_b][1]))
-
-    return n_a, n_b
+    common_a, common_b, _, _ = split_items(a, b)
+    return common_a, common_b
 
 
 def items_sub(a: SnapList, b: SnapList) -> SnapList:
@@ -40,7 +131,17 @@ def items_sub(a: SnapList, b: SnapList) -> SnapList:
     Return SnapItems from a which are not in b.
     """
 
-    return py_.difference_by(a, b, lambda x: x[0])
+    return split_items(a, b)[2]
+
+
+def group_runs(rows: Iterable[Dict], fields: List[str], value_field: str) -> Iterator[List]:
+    """
+    Group rows, ordered by the given fields, into [[field values, ...], [values, ...]]
+    pairs in a single pass. Only the current run of rows is kept in memory.
+    """
+
+    for group_values, run in groupby(rows, key=lambda row: [row[field] for field in fields]):
+        yield [group_values, [row[value_field] for row in run]]
 
 
 def find_col_diff(col_data_old: SnapList, col_data_new: SnapList, diff_fn: Callable):
@@ -63,22 +164,21 @@ def find_col_diff(col_data_old: SnapList, col_data_new: SnapList, diff_fn: Calla
 
     output = [] # type: SnapList
 
+    common_old, common_new, only_removed, only_added = split_items(col_data_old, col_data_new)
+
     # First work on the common items
-    common_old, common_new = items_common(col_data_old, col_data_new)
     for old_col_set, new_col_set in zip(common_old, common_new):
         diff = diff_fn(old_col_set[1], new_col_set[1])
         if diff is not None:
             output.append((old_col_set[0], diff))
 
     # Now do only items which are only present in old data
-    only_removed = items_sub(col_data_old, col_data_new)
     for col_set in only_removed:
         diff = diff_fn(col_set[1], None)
         if diff is not None:
             output.append((col_set[0], diff))
 
     # Finally do items which are only in new data
-    only_added = items_sub(col_data_new, col_data_old)
     for col_set in only_added:
         diff = diff_fn(None, col_set[1])
         if diff is not None:
@@ -91,12 +191,41 @@ class Watcher(ABC):
 
     @staticmethod
     @abstractmethod
-    def take_snapshot(db, config: Dict) -> Snap:
+    def take_snapshot(db, config: Dict, previous: Snap = None) -> Snap:
         """
-        Return a snapshot dictionary using the config and db.
+        Return a snapshot dictionary using the config and db. previous is the
+        snapshot of the same watcher from the latest saved snapshot, if the
+        watcher uses it.
         """
         ...
 
+    @staticmethod
+    def uses_previous(config) -> bool:
+        """
+        Tell whether take_snapshot wants the watcher's snapshot from the
+        latest saved snapshot as previous for the given config
+        """
+
+        return False
+
+    @staticmethod
+    def trim_previous(config, previous: Snap) -> Snap:
+        """
+        Return the parts of the previous snapshot which take_snapshot needs
+        for the config, so that the rest is not held while saving
+        """
+
+        return previous
+
+    @staticmethod
+    def catalog_schemas(config) -> List[str]:
+        """
+        Return schemas whose tables or columns the watcher reads from the
+        catalog, these are fetched once for all watchers in a save.
+        """
+
+        return []
+
     @staticmethod
     @abstractmethod
     def diff(old_snap: Snap, new_snap: Snap):
@@ -122,36 +251,209 @@ class NumberOfRowsHash(Watcher):
     """
 
     @staticmethod
-    def take_snapshot(db, config: Any) -> Snap:
+    def uses_previous(config) -> bool:
+        return any(NumberOfRowsHash.reuses_hashes(table_config) for table_config in config)
+
+    @staticmethod
+    def reuses_hashes(table_config) -> bool:
+        """
+        Tell whether hashes of the table are reused from the previous snapshot
+        """
+
+        return bool(table_config.get("aggregate") or "buckets" in table_config)
+
+    @staticmethod
+    def trim_previous(config, previous: Snap) -> Snap:
+        tables = {table_config["table"] for table_config in config if NumberOfRowsHash.reuses_hashes(table_config)}
+        return {**previous, "data": [item for item in previous["data"] if item[0] in tables]}
+
+    @staticmethod
+    def take_snapshot(db, config: Any, previous: Snap = None) -> Snap:
         """
         Take snapshot for number of rows in given table grouped by asked fields
 
         config:
           [{groupby: [cols, ...]
-            table: <string>},
+            table: <string>
+            hash_bytes: <int, optional>
+            batch_size: <int, optional>
+            copy: <text|binary, optional>
+            aggregate: <bool, optional>
+            buckets: <int, optional>
+            spill_memory: <int, optional>},
            ...]
+
+        In aggregate mode (only for grouped tables), each group also keeps a
+        digest of its sorted row hashes, like [[group values...], hashes, digest].
+        The digests are computed in the database and only groups with a digest
+        different from the previous snapshot have their row hashes fetched.
+
+        With buckets (only for tables without grouping), rows are split in
+        buckets by the first `buckets` hex characters of their hash and the
+        table data is like {prefix: <int>, buckets: [[prefix, count, digest, hashes], ...]}.
+        As in aggregate mode, only changed buckets have their hashes fetched
+        and diff only compares the hashes of buckets with different digests.
+
+        spill_memory is only used while diffing. Hash lists with more than
+        these many bytes of digests are sorted in runs on disk and merged
+        instead of being compared in memory. Packed hashes (with hash_bytes)
+        big enough to be in the store's hash blobs are streamed from the store
+        without loading them, hex lists are still loaded as a whole.
         """
 
+        previous_tables = dict(previous["data"]) if previous else {}
+
         def _get_table_hashes(table_config):
+            batch_size = table_config.get("batch_size", DEFAULT_BATCH_SIZE)
+
+            if "buckets" in table_config:
+                if "groupby" in table_config:
+                    raise ValueError(f"Buckets can't be used with groupby for table {table_config['table']}")
+                return _get_bucketed_hashes(table_config, batch_size)
+
+            if table_config.get("aggregate"):
+                if "groupby" not in table_config:
+                    raise ValueError(f"Aggregate mode needs groupby for table {table_config['table']}")
+                return _get_aggregated_hashes(table_config, batch_size)
+
             if "groupby" in table_config:
+                if "copy" in table_config:
+                    raise ValueError(f"COPY extraction is not supported for grouped table {table_config['table']}")
+
                 group_fields = ", ".join(table_config["groupby"])
                 select_fields = f"{group_fields}, md5({table_config['table']}::text) as hash"
                 stmt = f"SELECT {select_fields} FROM {table_config['table']} ORDER BY {group_fields}"
 
+                # Rows come ordered by the group fields so each group is one run
                 grouped_data = []
-                for res in db.query(stmt):
-                    group_values = [res[field] for field in table_config["groupby"]]
-
-                    group_values_idx = py_.find_index(grouped_data, lambda x: x[0] == group_values)
-                    if group_values_idx > -1:
-                        grouped_data[group_values_idx][1].append(res["hash"])
-                    else:
-                        grouped_data.append([group_values, [res["hash"]]])
+                for group in group_runs(stream_query(db, stmt, batch_size), table_config["groupby"], "hash"):
+                    if "hash_bytes" in table_config:
+                        group[1] = _pack(group[1], table_config["hash_bytes"])
+                    grouped_data.append(group)
 
                 return grouped_data
+            elif "copy" in table_config:
+                return _copy_hashes(table_config)
             else:
                 stmt = f"SELECT md5({table_config['table']}::text) as hash FROM {table_config['table']}"
-                return [r["hash"] for r in db.query(stmt)]
+                hashes = (r["hash"] for r in stream_query(db, stmt, batch_size))
+                if "hash_bytes" in table_config:
+                    # Packed directly from the stream, hex strings are never all in memory
+                    return _pack(hashes, table_config["hash_bytes"])
+                return list(hashes)
+
+        def _pack(hashes, width):
+            return HashArray.from_hex(hashes, width).to_json()
+
+        def _get_aggregated_hashes(table_config, batch_size):
+            table = table_config["table"]
+            group_fields = ", ".join(table_config["groupby"])
+            group_key = f"md5(ROW({group_fields})::text)"
+            width = table_config.get("hash_bytes")
+
+            # Groups from previous snapshot which can be reused as is
+            reusable = {}
+            for group in previous_tables.get(table, []):
+                if len(group) == 3 and _hash_width(group[1]) == width:
+                    reusable[json.dumps(group[0])] = group
+
+            stmt = f"""SELECT {group_fields}, {group_key} AS group_key,
+                md5(string_agg(hash, '' ORDER BY hash COLLATE "C")) AS digest
+              FROM (SELECT {group_fields}, md5({table}::text) AS hash FROM {table}) AS t
+              GROUP BY {group_fields} ORDER BY {group_fields}"""
+
+            grouped_data = []
+            changed_keys = []
+            for res in stream_query(db, stmt, batch_size):
+                group_values = [res[field] for field in table_config["groupby"]]
+                prev_group = reusable.get(json.dumps(group_values))
+                if prev_group is not None and prev_group[2] == res["digest"]:
+                    grouped_data.append(prev_group)
+                else:
+                    grouped_data.append([group_values, None, res["digest"]])
+                    changed_keys.append(res["group_key"])
+
+            if not changed_keys:
+                return grouped_data
+
+            stmt = f"""SELECT {group_fields}, md5({table}::text) AS hash FROM {table}
+              WHERE {group_key} = ANY(:keys) ORDER BY {group_fields}"""
+            fetched = {}
+            for group_values, hashes in group_runs(stream_query(db, stmt, batch_size, keys=changed_keys),
+                                                   table_config["groupby"], "hash"):
+                fetched[json.dumps(group_values)] = [group_values, _pack(hashes, width) if width else hashes, _digest(hashes)]
+
+            output = []
+            for group in grouped_data:
+                if group[1] is not None:
+                    output.append(group)
+                elif json.dumps(group[0]) in fetched:
+                    output.append(fetched[json.dumps(group[0])])
+            return output
+
+        def _get_bucketed_hashes(table_config, batch_size):
+            table = table_config["table"]
+            prefix = table_config["buckets"]
+            width = table_config.get("hash_bytes")
+            hashed = f"(SELECT md5({table}::text) AS hash FROM {table}) AS t"
+
+            reusable = {}
+            previous_data = previous_tables.get(table)
+            if isinstance(previous_data, dict) and previous_data.get("prefix") == prefix:
+                reusable = {bucket[0]: bucket for bucket in previous_data["buckets"] if _hash_width(bucket[3]) == width}
+
+            # Buckets are ordered like the hashes, so with packed hashes the
+            # concatenated buckets are still sorted
+            stmt = f"""SELECT left(hash, {prefix}) AS bucket, count(*) AS count,
+                md5(string_agg(hash, '' ORDER BY hash COLLATE "C")) AS digest
+              FROM {hashed} GROUP BY 1 ORDER BY left(hash, {prefix}) COLLATE "C\""""
+
+            buckets = []
+            changed = []
+            for res in stream_query(db, stmt, batch_size):
+                prev_bucket = reusable.get(res["bucket"])
+                if prev_bucket is not None and prev_bucket[2] == res["digest"]:
+                    buckets.append(prev_bucket)
+                else:
+                    buckets.append([res["bucket"], res["count"], res["digest"], None])
+                    changed.append(res["bucket"])
+
+            if changed:
+                stmt = f"""SELECT left(hash, {prefix}) AS bucket, hash FROM {hashed}
+                  WHERE left(hash, {prefix}) = ANY(:buckets) ORDER BY left(hash, {prefix}) COLLATE "C\""""
+                fetched = {}
+                for (bucket,), hashes in group_runs(stream_query(db, stmt, batch_size, buckets=changed), ["bucket"], "hash"):
+                    fetched[bucket] = [bucket, len(hashes), _digest(hashes), _pack(hashes, width) if width else hashes]
+                buckets = [fetched.get(bucket[0]) if bucket[3] is None else bucket for bucket in buckets]
+
+            return {"prefix": prefix, "buckets": [bucket for bucket in buckets if bucket is not None]}
+
+        def _digest(hashes):
+            # Same as md5(string_agg(hash, '' ORDER BY hash COLLATE "C")) in
+            # postgres. Recomputing this for fetched hashes keeps the two in
+            # agreement even if rows changed between the queries.
+            return hashlib.md5("".join(sorted(hashes)).encode("utf-8")).hexdigest()
+
+        def _hash_width(hashes):
+            # Width of packed hashes or None for hex lists
+            return hashes["width"] if is_hash_array(hashes) else None
+
+        def _copy_hashes(table_config):
+            table = table_config["table"]
+            width = table_config.get("hash_bytes")
+
+            if table_config["copy"] == "text":
+                hashes = copy_text_lines(db, f"SELECT md5({table}::text) FROM {table}")
+                return _pack(hashes, width) if width else hashes
+            elif table_config["copy"] == "binary":
+                # Digests come cut to width and sorted, so the stream is
+                # already a HashArray buffer
+                stmt = f"""SELECT substring(decode(md5({table}::text), 'hex') from 1 for {width or 16})
+                  FROM {table} ORDER BY 1"""
+                hash_array = HashArray(copy_binary_values(db, stmt), width or 16)
+                return hash_array.to_json() if width else [digest.hex() for digest in hash_array]
+            else:
+                raise ValueError(f"Unknown COPY format {table_config['copy']}")
 
         return {
             "config": config,
@@ -163,28 +465,121 @@ class NumberOfRowsHash(Watcher):
         old, new = old_snap["data"], new_snap["data"]
         old, new = items_common(old, new)
 
+        def _load(hashes):
+            # Hash blobs are only streamed when spilling, other diffs work on
+            # arrays in memory
+            return hashes.load().to_json() if isinstance(hashes, HashBlob) else hashes
+
         def _get_diff(old_hashes, new_hashes, skip=False):
+            old_hashes, new_hashes = _load(old_hashes), _load(new_hashes)
             if old_hashes is None:
-                return { "removed": 0, "added": len(set(new_hashes)) }
+                return { "removed": 0, "added": _count_unique(new_hashes) }
             elif new_hashes is None:
-                return { "removed": len(set(old_hashes)), "added": 0 }
+                return { "removed": _count_unique(old_hashes), "added": 0 }
             else:
-                removed = len(set(old_hashes) - set(new_hashes))
-                added = len(set(new_hashes) - set(old_hashes))
+                if is_hash_array(old_hashes) or is_hash_array(new_hashes):
+                    width = min(it["width"] for it in [old_hashes, new_hashes] if is_hash_array(it))
+                    old_array = as_hash_array(old_hashes, width)
+                    new_array = as_hash_array(new_hashes, width)
+                    removed = count_sub(old_array, new_array)
+                    added = count_sub(new_array, old_array)
+                else:
+                    removed = len(set(old_hashes) - set(new_hashes))
+                    added = len(set(new_hashes) - set(old_hashes))
                 if skip and (removed == added == 0):
                     return None
                 else:
                     return { "removed": removed, "added": added }
 
+        def _get_spilled_diff(old_hashes, new_hashes, skip, memory):
+            # Hash lists bigger than the memory cap are sorted and compared on disk
+            if hashes_size(old_hashes) + hashes_size(new_hashes) <= memory:
+                return _get_diff(old_hashes, new_hashes, skip)
+
+            removed, added = spill_diff_counts(old_hashes, new_hashes, memory)
+            if skip and old_hashes is not None and new_hashes is not None and removed == added == 0:
+                return None
+            return { "removed": removed, "added": added }
+
+        def _get_diffs(pairs, skip=False, memory=None):
+            # Diffs for a list of (old, new) hash lists, done together in one
+            # vectorized batch if numpy is available
+            if memory is not None:
+                return [_get_spilled_diff(old_hashes, new_hashes, skip, memory) for old_hashes, new_hashes in pairs]
+
+            pairs = [(_load(old_hashes), _load(new_hashes)) for old_hashes, new_hashes in pairs]
+            counts = batch_diff_counts(pairs)
+            if counts is None:
+                return [_get_diff(old_hashes, new_hashes, skip) for old_hashes, new_hashes in pairs]
+
+            return [
+                None if skip and old_hashes is not None and new_hashes is not None and removed == added == 0
+                else { "removed": removed, "added": added }
+                for (old_hashes, new_hashes), (removed, added) in zip(pairs, counts)
+            ]
+
+        def _count_unique(hashes):
+            if is_hash_array(hashes):
+                return HashArray.from_json(hashes).count_unique()
+            return len(set(hashes))
+
+        def _is_bucketed(table_data):
+            return isinstance(table_data, dict) and "buckets" in table_data
+
+        def _flatten(table_data):
+            # Return hashes of all the buckets together, concatenating packed
+            # buffers keeps them sorted since buckets are ordered by prefix
+            if not _is_bucketed(table_data):
+                return table_data
+
+            hashes = [_load(bucket[3]) for bucket in table_data["buckets"]]
+            if len(hashes) > 0 and is_hash_array(hashes[0]):
+                arrays = [HashArray.from_json(it) for it in hashes]
+                return HashArray(b"".join(it.buffer for it in arrays), arrays[0].width).to_json()
+            return [h for bucket_hashes in hashes for h in bucket_hashes]
+
+        def _get_bucket_diff(old_data, new_data, memory):
+            if not (_is_bucketed(old_data) and _is_bucketed(new_data) and old_data["prefix"] == new_data["prefix"]):
+                return _get_diffs([(_flatten(old_data), _flatten(new_data))], memory=memory)[0]
+
+            old_buckets = {bucket[0]: bucket for bucket in old_data["buckets"]}
+            new_buckets = {bucket[0]: bucket for bucket in new_data["buckets"]}
+            pairs = []
+            for prefix in set(old_buckets) | set(new_buckets):
+                old_bucket, new_bucket = old_buckets.get(prefix), new_buckets.get(prefix)
+                if old_bucket and new_bucket and old_bucket[2] == new_bucket[2]:
+                    continue
+                pairs.append((old_bucket[3] if old_bucket else None, new_bucket[3] if new_bucket else None))
+
+            diffs = _get_diffs(pairs, memory=memory)
+            return { "removed": sum(d["removed"] for d in diffs), "added": sum(d["added"] for d in diffs) }
+
+        def _is_grouped(table_data):
+            # Grouped data is like [[grouped-cols, ...], [hashes]], rest is a
+            # list of hashes or a packed hash array
+            return isinstance(table_data, list) and len(table_data) > 0 and isinstance(table_data[0], list)
+
         output = [] # type: Any
         for row_old, row_new in zip(old, new):
-            if type(row_old[1][0]) == str:
+            table_config = py_.find(new_snap["config"], lambda x: x["table"] == row_old[0]) or {}
+            memory = table_config.get("spill_memory")
+
+            if _is_bucketed(row_old[1]) or _is_bucketed(row_new[1]):
+                # Hashes split in buckets, only the buckets which changed are compared
+                output.append([row_old[0], _get_bucket_diff(row_old[1], row_new[1], memory), "basic"])
+            elif not _is_grouped(row_old[1]):
                 # This data is without grouping, each row_old/new[1] is like ["hash1", "hash2", ...]
-                diff = _get_diff(row_old[1], row_new[1])
+                diff = _get_diffs([(row_old[1], row_new[1])], memory=memory)[0]
                 output.append([row_old[0], diff, "basic"])
             else:
                 # This is grouped data, each row_old/new[1] is like [[grouped-cols, ...], [hashes]]
-                col_set_diff = find_col_diff(row_old[1], row_new[1], partial(_get_diff, skip=True))
+                # All groups are diffed in one batch, output is ordered like find_col_diff
+                common_old, common_new, only_old, only_new = split_items(row_old[1], row_new[1])
+                col_sets = ([(it_old[0], it_old[1], it_new[1]) for it_old, it_new in zip(common_old, common_new)] +
+                            [(it[0], it[1], None) for it in only_old] +
+                            [(it[0], None, it[1]) for it in only_new])
+                diffs = _get_diffs([(old_hashes, new_hashes) for _, old_hashes, new_hashes in col_sets], skip=True, memory=memory)
+                col_set_diff = [(col_set[0], diff) for col_set, diff in zip(col_sets, diffs) if diff is not None]
                 output.append([row_old[0], col_set_diff, "grouped"])
 
         return {
@@ -220,13 +615,14 @@ class NumberOfRows(Watcher):
     """
 
     @staticmethod
-    def take_snapshot(db, config: Any) -> Snap:
+    def take_snapshot(db, config: Any, previous: Snap = None) -> Snap:
         """
         Take snapshot for number of rows in given table grouped by asked fields
 
         config:
           [{groupby: [cols, ...]
-            table: <string>},
+            table: <string>
+            batch_size: <int, optional>},
            ...]
         """
 
@@ -238,17 +634,13 @@ class NumberOfRows(Watcher):
             where each item is a pair of group by field values and count.
             """
 
+            stmt = NumberOfRows.count_stmt(table_config)
             if "groupby" in table_config:
-                group_fields = ", ".join(table_config["groupby"])
-                select_fields = f"{group_fields}, count(*) as count"
-                stmt = f"SELECT {select_fields} FROM {table_config['table']} GROUP BY {group_fields} ORDER BY {group_fields}"
-
                 counts = []
-                for res in db.query(stmt):
+                for res in stream_query(db, stmt, table_config.get("batch_size", DEFAULT_BATCH_SIZE)):
                     counts.append([[res[field] for field in table_config["groupby"]], res["count"]])
                 return counts
             else:
-                stmt = f"SELECT count(*) as count FROM {table_config['table']}"
                 return db.query(stmt).next()["count"]
 
         return {
@@ -256,6 +648,20 @@ class NumberOfRows(Watcher):
             "data": [(tc["table"], _get_table_counts(tc)) for tc in config]
         }
 
+    @staticmethod
+    def count_stmt(table_config: Dict) -> str:
+        """
+        Return the counting query for a table in config. The planner uses
+        these to find queries it can serve from a fused scan.
+        """
+
+        if "groupby" in table_config:
+            group_fields = ", ".join(table_config["groupby"])
+            select_fields = f"{group_fields}, count(*) as count"
+            return f"SELECT {select_fields} FROM {table_config['table']} GROUP BY {group_fields} ORDER BY {group_fields}"
+        else:
+            return f"SELECT count(*) as count FROM {table_config['table']}"
+
     @staticmethod
     def diff(old_snap: Snap, new_snap: Snap):
         old, new = old_snap["data"], new_snap["data"]
@@ -311,22 +717,24 @@ class SchemaTables(Watcher):
     """
 
     @staticmethod
-    def take_snapshot(db, config: Dict) -> Snap:
+    def take_snapshot(db, config: Any, previous: Snap = None) -> Snap:
         """
         Save list of tables in given schema
 
         config: [<schema>, ...]
         """
 
-        def get_schema_tables(schema):
-            res = db.query(f"SELECT table_name FROM information_schema.tables WHERE table_schema = '{schema}'")
-            return [r["table_name"] for r in res]
+        catalog = get_catalog(db, config)
 
         return {
             "config": config,
-            "data": [(schema, get_schema_tables(schema)) for schema in config]
+            "data": [(schema, catalog.tables[schema]) for schema in config]
         }
 
+    @staticmethod
+    def catalog_schemas(config) -> List[str]:
+        return config
+
     @staticmethod
     def diff(old_snap: Snap, new_snap: Snap):
         old, new = old_snap["data"], new_snap["data"]
@@ -357,22 +765,24 @@ class SchemaColumns(Watcher):
     """
 
     @staticmethod
-    def take_snapshot(db, config: Dict) -> Snap:
+    def take_snapshot(db, config: Any, previous: Snap = None) -> Snap:
         """
         Save all distinct table in given schema
 
         config: [<schema>, ...]
         """
 
-        def get_schema_columns(schema):
-            res = db.query(f"SELECT DISTINCT column_name FROM information_schema.columns WHERE table_schema = '{schema}'")
-            return [r["column_name"] for r in res]
+        catalog = get_catalog(db, config)
 
         return {
             "config": config,
-            "data": [(schema, get_schema_columns(schema)) for schema in config]
+            "data": [(schema, catalog.columns[schema]) for schema in config]
         }
 
+    @staticmethod
+    def catalog_schemas(config) -> List[str]:
+        return config
+
     @staticmethod
     def diff(old_snap: Snap, new_snap: Snap):
         old, new = old_snap["data"], new_snap["data"]
@@ -397,13 +807,29 @@ class SchemaColumns(Watcher):
         return tpl_schema_columns.render(data=diff["data"])
 
 
+def digest_mode(table_hash: Optional[str]) -> str:
+    """
+    Return the mode a TableChange digest was made in. Ordered digests are
+    plain md5 hex strings, digests of other modes are prefixed by the mode.
+    The ordered digest of an empty table is NULL.
+    """
+
+    if table_hash is None or ":" not in table_hash:
+        return "ordered"
+    return table_hash.split(":", 1)[0]
+
+
 class TableChange(Watcher):
     """
     Watch for table changes
     """
 
     @staticmethod
-    def take_snapshot(db, config: Dict) -> Snap:
+    def uses_previous(config) -> bool:
+        return bool(config.get("skip_unchanged") or config.get("chunks"))
+
+    @staticmethod
+    def take_snapshot(db, config: Dict, previous: Snap = None) -> Snap:
         """
         Save all table hashes in given schema
 
@@ -414,6 +840,33 @@ class TableChange(Watcher):
           tables:
             - <table-one>
             - <table-two>
+          skip_unchanged: <bool, optional>
+          workers: <int, optional>
+          digest: <ordered|unordered, optional>
+          chunks:
+            <table>:
+              key: <integer column, optional>
+              size: <int>
+
+        The default ordered digest is an md5 over the md5 of all rows sorted by
+        the first column. The unordered digest is the row count and the sum of
+        64 bit prefixes of row md5s, saved like `unordered:<count>:<sum>`. It
+        needs no sort and constant memory on the server.
+
+        Tables listed in chunks are split in ranges of `size` values of key
+        (the primary key by default) and hashed per range, rows with a NULL
+        key going in a range of their own. A fingerprint of each range (row
+        count and sum of xmin) is saved in `chunks` and only ranges whose
+        fingerprint changed since the previous snapshot are hashed again. Their
+        digests are saved like `chunked:<md5 of range digests>`.
+
+        With workers more than 1, tables are hashed concurrently over that many
+        connections, all reading the same exported database snapshot.
+
+        With skip_unchanged, a fingerprint of each table's statistics (file
+        node, size and insert/update/delete counters) is saved in `stats` and
+        tables with the same fingerprint as in the previous snapshot keep their
+        previous hash without being scanned.
         """
 
         # Create a list of tables to look for
@@ -424,40 +877,192 @@ class TableChange(Watcher):
             pass
 
         if "schemas" in config:
+            catalog = get_catalog(db, config["schemas"])
             for schema in config["schemas"]:
-                res = db.query(f"SELECT table_name FROM information_schema.tables WHERE table_schema = '{schema}'")
-                tables += [f"{schema}.{r['table_name']}" for r in res]
-
-        # Create hash of tables
-        def _table_hash(table):
-            res = db.query(f"""SELECT md5(array_agg(md5((t.*)::varchar))::varchar) as hash
+                tables += [f"{schema}.{table}" for table in catalog.tables[schema]]
+
+        def _stats_fingerprints():
+            # Taken before hashing so that changes made while hashing show up
+            # in the next snapshot
+            res = db.query("""SELECT t.name, c.relfilenode, pg_relation_size(c.oid) AS size,
+                s.n_tup_ins, s.n_tup_upd, s.n_tup_del
+              FROM unnest(CAST(:tables AS text[])) AS t(name)
+              JOIN pg_class c ON c.oid = CAST(t.name AS regclass)
+              LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid""", tables=tables)
+
+            fingerprints = {}
+            for r in res:
+                # Tables without statistics are always hashed
+                if r["n_tup_ins"] is not None:
+                    fingerprints[r["name"]] = [r["relfilenode"], r["size"], r["n_tup_ins"], r["n_tup_upd"], r["n_tup_del"]]
+            return fingerprints
+
+        fingerprints = _stats_fingerprints() if config.get("skip_unchanged") and tables else {}
+        previous_hashes = dict(previous["data"]) if previous else {}
+        previous_stats = previous.get("stats", {}) if previous else {}
+
+        mode = config.get("digest", "ordered")
+        if mode not in ["ordered", "unordered"]:
+            raise ValueError(f"Unknown digest mode {mode}")
+
+        chunked = config.get("chunks", {})
+        previous_chunks = previous.get("chunks", {}) if previous else {}
+
+        def _table_mode(table):
+            return "chunked" if table in chunked else mode
+
+        def _is_unchanged(table):
+            return (table in fingerprints and previous_stats.get(table) == fingerprints[table] and
+                    table in previous_hashes and digest_mode(previous_hashes[table]) == _table_mode(table) and
+                    (table not in chunked or table in previous_chunks))
+
+        def _hash_stmt(table):
+            if mode == "unordered":
+                # Sum is taken as numeric so it can't overflow
+                return f"""SELECT 'unordered:' || count(*) || ':' ||
+                    coalesce(sum(('x' || left(md5((t.*)::varchar), 16))::bit(64)::bigint::numeric), 0) as hash
+                  FROM {table} AS t"""
+
+            return f"""SELECT md5(array_agg(md5((t.*)::varchar))::varchar) as hash
               FROM (
                 SELECT *
                   FROM {table}
                 ORDER BY 1
-              ) AS t""")
-            return res.next()["hash"]
-
-        return {
+              ) AS t"""
+
+        def _chunk_key(table):
+            if "key" in chunked[table]:
+                return chunked[table]["key"]
+
+            res = list(db.query("""SELECT a.attname FROM pg_index i
+              JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+              WHERE i.indrelid = CAST(:table AS regclass) AND i.indisprimary""", table=table))
+            if len(res) != 1:
+                raise ValueError(f"Chunked table {table} needs a key as it has no single column primary key")
+            return res[0]["attname"]
+
+        def _chunk_fingerprints(table, key, size):
+            # Count and sum of xmin change when rows in the chunk are inserted,
+            # updated or deleted and need no per row hashing
+            res = db.query(f"""SELECT floor({key}::numeric / {size})::bigint AS chunk, count(*) AS count,
+                sum(xmin::text::bigint)::text AS xmins
+              FROM {table} GROUP BY 1 ORDER BY 1""")
+            return [(r["chunk"], [r["count"], r["xmins"]]) for r in res]
+
+        def _chunk_hash_stmt(table, key, size, chunk):
+            if chunk is None:
+                # Rows with a NULL key are a range of their own, ordered by
+                # their hashes as the key can't order them
+                return f"""SELECT md5(array_agg(md5((t.*)::varchar) ORDER BY md5((t.*)::varchar))::varchar) as hash
+                  FROM {table} AS t
+                  WHERE {key} IS NULL"""
+
+            return f"""SELECT md5(array_agg(md5((t.*)::varchar) ORDER BY {key})::varchar) as hash
+              FROM {table} AS t
+              WHERE {key} >= {chunk * size} AND {key} < {(chunk + 1) * size}"""
+
+        # Statements to run, keyed by table or (table, chunk)
+        jobs = {} # type: Dict[Any, str]
+        chunk_lists = {} # type: Dict[str, Dict]
+        for table in tables:
+            if _is_unchanged(table):
+                if table in chunked:
+                    chunk_lists[table] = previous_chunks[table]
+            elif table in chunked:
+                key, size = _chunk_key(table), chunked[table]["size"]
+                prev = previous_chunks.get(table, {})
+                prev_ranges = {it[0]: it for it in prev.get("ranges", [])} if (prev.get("key"), prev.get("size")) == (key, size) else {}
+
+                ranges = []
+                for chunk, chunk_fingerprint in _chunk_fingerprints(table, key, size):
+                    prev_range = prev_ranges.get(chunk)
+                    if prev_range is not None and prev_range[1] == chunk_fingerprint:
+                        ranges.append(prev_range)
+                    else:
+                        ranges.append([chunk, chunk_fingerprint, None])
+                        jobs[(table, chunk)] = _chunk_hash_stmt(table, key, size, chunk)
+                chunk_lists[table] = {"key": key, "size": size, "ranges": ranges}
+            else:
+                jobs[table] = _hash_stmt(table)
+
+        # Create hash of tables and changed chunks
+        job_keys = list(jobs.keys())
+        if config.get("workers", 1) > 1 and len(job_keys) > 1:
+            rows = parallel_query(db, [jobs[job_key] for job_key in job_keys], config["workers"])
+        else:
+            rows = [db.query(jobs[job_key]).next() for job_key in job_keys]
+        hashes = {job_key: row["hash"] for job_key, row in zip(job_keys, rows)}
+
+        for table, chunk_list in chunk_lists.items():
+            for chunk_range in chunk_list["ranges"]:
+                if chunk_range[2] is None:
+                    chunk_range[2] = hashes[(table, chunk_range[0])]
+            if table not in hashes and not _is_unchanged(table):
+                # Table digest over its chunk digests
+                digests = "".join(f"{it[0]}:{it[2]}," for it in chunk_list["ranges"])
+                hashes[table] = "chunked:" + hashlib.md5(digests.encode("utf-8")).hexdigest()
+
+        snap = {
             "config": config,
-            "data": [(table, _table_hash(table)) for table in tables]
+            "data": [(table, hashes[table] if table in hashes else previous_hashes[table]) for table in tables]
         }
 
+        if chunk_lists:
+            snap["chunks"] = chunk_lists
+
+        if fingerprints:
+            snap["stats"] = fingerprints
+
+        return snap
+
+    @staticmethod
+    def catalog_schemas(config) -> List[str]:
+        return config.get("schemas", [])
+
     @staticmethod
     def diff(old_snap: Snap, new_snap: Snap):
         old, new = old_snap["data"], new_snap["data"]
         old, new = items_common(old, new)
 
         changed = []
+        skipped = []
         for row_old, row_new in zip(old, new):
-            if row_new[1] != row_old[1]:
+            if digest_mode(row_old[1]) != digest_mode(row_new[1]):
+                # Digests made in different modes can't be compared
+                skipped.append(row_old[0])
+            elif row_new[1] != row_old[1]:
                 changed.append(row_old[0])
 
-        return {
+        output = {
             "config": new_snap["config"],
             "data": changed
         }
 
+        if skipped:
+            output["skipped"] = skipped
+
+        # Key ranges which changed in chunked tables
+        ranges = {}
+        old_chunks, new_chunks = old_snap.get("chunks", {}), new_snap.get("chunks", {})
+        for table in changed:
+            old_list, new_list = old_chunks.get(table), new_chunks.get(table)
+            if old_list and new_list and (old_list["key"], old_list["size"]) == (new_list["key"], new_list["size"]):
+                old_digests = {it[0]: it[2] for it in old_list["ranges"]}
+                new_digests = {it[0]: it[2] for it in new_list["ranges"]}
+                size = new_list["size"]
+                changed_chunks = sorted((c for c in set(old_digests) | set(new_digests) if old_digests.get(c) != new_digests.get(c)),
+                                        key=lambda c: (c is None, c or 0))
+                ranges[table] = {
+                    "key": new_list["key"],
+                    "ranges": [[None, None] if c is None else [c * size, (c + 1) * size] for c in changed_chunks]
+                }
+
+        if ranges:
+            output["ranges"] = ranges
+
+        return output
+
     @staticmethod
     def report(diff) -> str:
-        return tpl_table_change.render(changed_tables=diff["data"])
+        return tpl_table_change.render(changed_tables=diff["data"], skipped_tables=diff.get("skipped", []),
+                                       ranges=diff.get("ranges", {}))
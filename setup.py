@@ -23,6 +23,9 @@ setup(
         "tabulate",
         "psycopg2"
     ],
+    extras_require={
+        "numpy": ["numpy"]
+    },
     setup_requires=[
         "pytest-runner"
     ],
@@ -0,0 +1,13 @@
+"""
+Helpers shared by the tests
+"""
+
+import hashlib
+
+
+def md5(value):
+    """
+    Return hex md5 of the value's string, like postgres' md5 of a row
+    """
+
+    return hashlib.md5(str(value).encode("utf-8")).hexdigest()
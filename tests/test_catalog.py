@@ -0,0 +1,54 @@
+"""
+Tests for schema catalog
+"""
+
+from diffport.catalog import Catalog, get_catalog
+from diffport.watchers import SchemaColumns, SchemaTables
+
+
+class FakeDB:
+    """
+    Returns fixed catalog rows and counts queries
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.n_queries = 0
+
+    def query(self, stmt, **params):
+        self.n_queries += 1
+        return iter([row for row in self.rows if row["schema_name"] in params["schemas"]])
+
+
+rows = [
+    {"schema_name": "one", "table_name": "a", "column_name": "id"},
+    {"schema_name": "one", "table_name": "a", "column_name": "name"},
+    {"schema_name": "one", "table_name": "b", "column_name": "id"},
+    {"schema_name": "two", "table_name": "empty", "column_name": None}
+]
+
+
+def test_catalog():
+    """
+    Test that tables and distinct columns are collected per schema
+    """
+
+    catalog = Catalog(FakeDB(rows), ["one", "two", "three"])
+    assert catalog.tables == {"one": ["a", "b"], "two": ["empty"], "three": []}
+    assert catalog.columns == {"one": ["id", "name"], "two": [], "three": []}
+
+
+def test_shared_catalog():
+    """
+    Test that watchers use the shared catalog when it has their schemas
+    """
+
+    db = FakeDB(rows)
+    db.catalog = Catalog(db, ["one", "two"])
+
+    assert SchemaTables.take_snapshot(db, ["one"])["data"] == [("one", ["a", "b"])]
+    assert SchemaColumns.take_snapshot(db, ["two"])["data"] == [("two", [])]
+    assert db.n_queries == 1
+
+    assert get_catalog(db, ["three"]).tables == {"three": []}
+    assert db.n_queries == 2
@@ -8,6 +8,7 @@ from pathlib import Path
 from random import random
 import pytest
 import dataset
+import time
 
 
 @pytest.fixture
@@ -109,3 +110,62 @@ def test_diff(diffp):
     }
     report = SchemaTables.report(diff)
     assert diffp.report(old_hash, new_hash).endswith(report)
+
+
+def test_report_aggregated(tmpdir):
+    """
+    Test that aggregated groups are reported and watchers missing from a
+    snapshot are left out
+    """
+
+    config = [
+        {"name": "number-of-rows-hash", "config": [{"table": "tab", "groupby": ["g"], "aggregate": True}]},
+        {"name": "tables-in-schema", "config": ["scm"]}
+    ]
+    diffp = Diffport(config, Path(tmpdir).joinpath("store"))
+
+    for snap_hash, groups in [("hash-old", [[["a"], ["h1"], "d1"]]), ("hash-new", [[["a"], ["h2"], "d2"]])]:
+        diffp.store.add_snapshot({
+            "hash": snap_hash,
+            "time": time.time(),
+            "items": [{"watcher": "number-of-rows-hash", "data": {"config": config[0]["config"], "data": [["tab", groups]]}}]
+        })
+
+    report = diffp.report("hash-old", "hash-new")
+    assert "### `tab`" in report
+    assert report.rstrip().endswith("a                 1             1")
+    assert "Schema table changes" not in report
+
+
+def test_previous_items(tmpdir):
+    """
+    Test that only data needed by the watcher configs is read from the
+    latest snapshot
+    """
+
+    config = [
+        {"name": "number-of-rows-hash", "config": [{"table": "plain"}, {"table": "agg", "groupby": ["g"], "aggregate": True}]},
+        {"name": "number-of-rows-hash", "config": [{"table": "plain"}]},
+        {"name": "table-change", "config": {"tables": ["plain"]}}
+    ]
+    diffp = Diffport(config, Path(tmpdir).joinpath("store"))
+    assert diffp.previous_items() == {}
+
+    data = {"config": config[0]["config"], "data": [["plain", ["h1"]], ["agg", [[["a"], ["h2"], "d"]]]]}
+    diffp.store.add_snapshot({
+        "hash": "hash-old",
+        "time": time.time(),
+        "items": [
+            {"watcher": "number-of-rows-hash", "data": data},
+            {"watcher": "number-of-rows-hash", "data": {"config": config[1]["config"], "data": [["plain", ["h1"]]]}},
+            {"watcher": "table-change", "data": {"config": config[2]["config"], "data": [["plain", "x"]]}}
+        ]
+    })
+    diffp.index = diffp.store.get_index()
+
+    previous = diffp.previous_items()
+    assert previous == {
+        "number-of-rows-hash": [{"config": data["config"], "data": [["agg", [[["a"], ["h2"], "d"]]]]}, None],
+        "table-change": [None]
+    }
+    assert len(diffp.store.cache.items) == 0
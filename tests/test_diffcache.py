@@ -0,0 +1,118 @@
+"""
+Tests for the diff cache
+"""
+
+import os
+import time
+from diffport.core import Diffport
+from diffport.diffcache import DiffCache
+from diffport.watchers import SchemaTables
+from pathlib import Path
+
+
+def test_get_put(tmpdir):
+    """
+    Test that diffs are cached per watcher config and version
+    """
+
+    cache = DiffCache(Path(tmpdir.join("cache")))
+    assert cache.get("old", "new", "tables-in-schema", ["one"]) is None
+    assert not cache.path.exists()
+
+    cache.put("old", "new", "tables-in-schema", ["one"], {"data": [1, 2]})
+    cache.put("old", "new", "tables-in-schema", ["two"], None)
+
+    assert cache.get("old", "new", "tables-in-schema", ["one"]) == {"diff": {"data": [1, 2]}}
+    assert cache.get("old", "new", "tables-in-schema", ["two"]) == {"diff": None}
+    assert cache.get("new", "old", "tables-in-schema", ["one"]) is None
+    assert cache.get("old", "new", "columns-in-schema", ["one"]) is None
+
+
+def test_version(tmpdir, monkeypatch):
+    """
+    Test that diffs cached by another version are not used
+    """
+
+    cache = DiffCache(Path(tmpdir.join("cache")))
+    cache.put("old", "new", "tables-in-schema", ["one"], {"data": []})
+
+    monkeypatch.setattr("diffport.diffcache.__version__", "0.0.0")
+    assert cache.get("old", "new", "tables-in-schema", ["one"]) is None
+
+
+def test_read_only(tmpdir, monkeypatch):
+    """
+    Test that cached diffs are served when they can't be marked as used
+    """
+
+    cache = DiffCache(Path(tmpdir.join("cache")))
+    cache.put("old", "new", "tables-in-schema", ["one"], {"data": []})
+
+    def utime(path):
+        raise PermissionError(path)
+
+    monkeypatch.setattr(os, "utime", utime)
+    assert cache.get("old", "new", "tables-in-schema", ["one"]) == {"diff": {"data": []}}
+
+
+def test_evict(tmpdir):
+    """
+    Test that least recently used diffs are evicted over the budget
+    """
+
+    cache = DiffCache(Path(tmpdir.join("cache")), max_bytes=170)
+    diff = {"data": "x" * 30}
+
+    for idx, name in enumerate(["a", "b", "c"]):
+        cache.put("old", "new", name, [], diff)
+        diff_file = cache.diff_file("old", "new", name, [])
+        os.utime(str(diff_file), (idx, idx))
+
+    # Each diff takes 53 bytes, so the budget fits three. Reading "a" makes
+    # "b" the least recently used.
+    assert cache.get("old", "new", "a", []) is not None
+    cache.put("old", "new", "d", [], diff)
+
+    assert cache.get("old", "new", "b", []) is None
+    assert cache.get("old", "new", "c", []) is not None
+    assert cache.get("old", "new", "a", []) is not None
+    assert cache.get("old", "new", "d", []) is not None
+
+
+def test_disabled(tmpdir):
+    cache = DiffCache(Path(tmpdir.join("cache")), max_bytes=0)
+    cache.put("old", "new", "a", [], {"data": []})
+
+    assert cache.get("old", "new", "a", []) is None
+    assert not Path(tmpdir.join("cache")).exists()
+
+
+def test_report(tmpdir, monkeypatch):
+    """
+    Test that repeated reports reuse cached diffs and that removing a
+    snapshot drops its diffs
+    """
+
+    config = [{"name": "tables-in-schema", "config": ["scm"]}]
+    diffp = Diffport(config, Path(tmpdir.join("store")))
+
+    for snap_hash, tables in [("hash-old", ["a", "b"]), ("hash-new", ["b", "c"]), ("hash-other", ["c"])]:
+        diffp.store.add_snapshot({
+            "hash": snap_hash,
+            "time": time.time(),
+            "items": [{"watcher": "tables-in-schema", "data": {"config": ["scm"], "data": [["scm", tables]]}}]
+        })
+
+    calls = []
+    diff = SchemaTables.diff
+    monkeypatch.setattr(SchemaTables, "diff", staticmethod(lambda old, new: calls.append(1) or diff(old, new)))
+
+    report = diffp.report("hash-old", "hash-new")
+    assert diffp.report("hash-old", "hash-new") == report
+    assert len(calls) == 1
+
+    diffp.report("hash-new", "hash-other")
+    assert len(calls) == 2
+
+    diffp.remove_snapshot("hash-new")
+    assert list(diffp.diff_cache.path.glob("*.json")) == []
@@ -0,0 +1,83 @@
+"""
+Tests for query planner
+"""
+
+from diffport.planner import PlannedDatabase, plan_queries
+from diffport.query import stream_query
+from diffport.watchers import NumberOfRows
+
+
+config = [{
+    "name": "number-of-rows",
+    "config": [
+        {"table": "cases"},
+        {"table": "cases", "groupby": ["region", "year"]},
+        {"table": "doctors", "groupby": ["region"]}
+    ]
+}, {
+    "name": "number-of-rows",
+    "config": [
+        {"table": "cases", "groupby": ["sex"]},
+        {"table": "cases", "groupby": ["year", "region"]}
+    ]
+}]
+
+
+def test_plan():
+    """
+    Test that only tables counted more than once are fused
+    """
+
+    plan = plan_queries(config)
+    assert len(plan) == 1
+
+    fused = plan[0]
+    assert fused.table == "cases"
+    assert fused.columns == ["region", "year", "sex"]
+    assert [part["columns"] for part in fused.parts] == [[], ["region", "year"], ["sex"]]
+    assert "GROUPING SETS ((), (region, year), (sex))" in fused.stmt
+    assert [fused.grouping_id(part["columns"]) for part in fused.parts] == [7, 1, 6]
+
+
+def test_split():
+    """
+    Test that fused rows are split back in rows of the original queries
+    """
+
+    fused = plan_queries(config)[0]
+    rows = [
+        {"region": "a", "year": 2000, "sex": None, "grouping_id": 1, "count": 4},
+        {"region": "b", "year": 2000, "sex": None, "grouping_id": 1, "count": 1},
+        {"region": None, "year": None, "sex": None, "grouping_id": 7, "count": 8},
+        {"region": None, "year": None, "sex": "f", "grouping_id": 6, "count": 3},
+        {"region": None, "year": None, "sex": None, "grouping_id": 6, "count": 5}
+    ]
+
+    results = fused.split(iter(rows))
+    assert results[NumberOfRows.count_stmt({"table": "cases"})] == [{"count": 8}]
+    assert results[NumberOfRows.count_stmt({"table": "cases", "groupby": ["region", "year"]})] == [
+        {"region": "a", "year": 2000, "count": 4},
+        {"region": "b", "year": 2000, "count": 1}
+    ]
+    assert results[NumberOfRows.count_stmt({"table": "cases", "groupby": ["sex"]})] == [
+        {"sex": "f", "count": 3},
+        {"sex": None, "count": 5}
+    ]
+
+
+def test_planned_database():
+    """
+    Test that NumberOfRows takes the same snapshot from prefetched results
+    """
+
+    db = PlannedDatabase(None, [])
+    db.prefetched = {
+        NumberOfRows.count_stmt({"table": "cases"}): [{"count": 8}],
+        NumberOfRows.count_stmt({"table": "cases", "groupby": ["sex"]}): [{"sex": "f", "count": 3}, {"sex": "m", "count": 5}]
+    }
+
+    watcher_config = [{"table": "cases"}, {"table": "cases", "groupby": ["sex"]}]
+    assert NumberOfRows.take_snapshot(db, watcher_config)["data"] == [
+        ("cases", 8),
+        ("cases", [[["f"], 3], [["m"], 5]])
+    ]
@@ -0,0 +1,51 @@
+"""
+Tests for query helpers
+"""
+
+from diffport.query import BinaryValueParser, CopyReader, PGCOPY_SIGNATURE, TextLineParser, stream_query
+import dataset
+import struct
+
+
+def test_stream_query():
+    """
+    Test that streamed rows match the complete result across batches
+    """
+
+    db = dataset.connect("sqlite:///:memory:")
+    db["numbers"].insert_many([{"parity": idx % 2, "value": idx} for idx in range(25)])
+
+    stmt = "SELECT parity, value FROM numbers ORDER BY value"
+    expected = [dict(row) for row in db.query(stmt)]
+
+    for batch_size in [1, 4, 25, 100]:
+        assert list(stream_query(db, stmt, batch_size)) == expected
+
+
+def test_copy_parsers():
+    """
+    Test parsing of COPY output written in pieces as psycopg2 does
+    """
+
+    digests = [bytes([idx]) * 16 for idx in range(5)]
+
+    binary = bytearray(PGCOPY_SIGNATURE + struct.pack("!II", 0, 0))
+    for digest in digests:
+        binary += struct.pack("!hi", 1, len(digest)) + digest
+    binary += struct.pack("!h", -1)
+
+    parser = BinaryValueParser()
+    reader = CopyReader(parser)
+    for start in range(0, len(binary), 7):
+        reader.write(binary[start:start + 7])
+        reader.flush()
+    assert parser.output == b"".join(digests)
+    assert len(reader.buffer) == 0
+
+    text = "".join(digest.hex() + "\n" for digest in digests).encode("utf-8")
+    parser = TextLineParser()
+    reader = CopyReader(parser)
+    for start in range(0, len(text), 5):
+        reader.write(text[start:start + 5])
+        reader.flush()
+    assert parser.lines == [digest.hex() for digest in digests]
@@ -0,0 +1,60 @@
+"""
+Tests for diffing hash lists on disk
+"""
+
+import os
+from random import Random
+
+from diffport.hashes import HashArray, HashBlob
+from diffport.spill import merge_counts, read_run, spill_diff_counts, write_runs
+from .helpers import md5
+
+
+def test_runs(tmpdir):
+    digests = [bytes.fromhex(md5(i))[:4] for i in range(25)]
+    paths = write_runs(iter(digests), 10, str(tmpdir))
+
+    assert len(paths) == 3
+    runs = [list(read_run(path, 4, 3)) for path in paths]
+    assert runs[0] == sorted(digests[:10])
+    assert sorted(digest for run in runs for digest in run) == sorted(digests)
+
+
+def test_merge_counts():
+    a = [b"a", b"b", b"b", b"d"]
+    b = [b"b", b"c", b"c", b"e", b"f"]
+
+    assert merge_counts(iter(a), iter(b)) == (2, 3)
+    assert merge_counts(iter([]), iter(b)) == (0, 4)
+    assert merge_counts(iter(a), iter([])) == (3, 0)
+
+
+def test_spill_diff_counts(tmpdir):
+    rng = Random(0)
+    old = [md5(rng.randint(0, 500)) for _ in range(400)]
+    new = [md5(rng.randint(0, 500)) for _ in range(400)]
+
+    expected = (len(set(old) - set(new)), len(set(new) - set(old)))
+    assert spill_diff_counts(old, new, 256, str(tmpdir)) == expected
+    assert spill_diff_counts(old, None, 256, str(tmpdir)) == (len(set(old)), 0)
+
+    # Packed arrays are compared at the smaller width
+    packed = HashArray.from_hex(new, 8).to_json()
+    assert spill_diff_counts(old, packed, 256, str(tmpdir)) == expected
+
+    # Runs are removed after the diff
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_spill_hash_blobs(tmpdir):
+    rng = Random(0)
+    old = HashArray.from_hex([md5(rng.randint(0, 500)) for _ in range(400)], 8)
+    new = HashArray.from_hex([md5(rng.randint(0, 500)) for _ in range(400)], 8)
+
+    # Chunks are not aligned to digests
+    chunked = lambda array: HashBlob(lambda: (array.buffer[i:i + 100] for i in range(0, len(array.buffer), 100)),
+                                     array.width, len(array.buffer))
+    old_set, new_set = set(old), set(new)
+    expected = (len(old_set - new_set), len(new_set - old_set))
+    assert spill_diff_counts(chunked(old), chunked(new), 64, str(tmpdir)) == expected
+    assert spill_diff_counts(chunked(old), new.to_json(), 64, str(tmpdir)) == expected
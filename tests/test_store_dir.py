@@ -2,12 +2,17 @@
 Tests for store module
 """
 
+from diffport.delta import apply_delta, make_delta
+from diffport.hashes import HashArray, HashBlob
 from diffport.store import StoreDirectory
 from pathlib import Path
 import os
 import time
 import json
 import gzip
+import pytest
+
+from .helpers import md5
 
 
 def test_create_directory(tmpdir):
@@ -39,8 +44,8 @@ def test_add_snap(tmpdir):
     assert len(store.get_index()) == 1
     assert store.get_index()[0]["hash"] == snap["hash"]
     assert store.get_snapshot(snap["hash"]) == snap
-    with gzip.open(store_path.joinpath(f"{snap['time']}.gz")) as fp:
-        assert snap == json.load(fp)
+    with gzip.open(store_path.joinpath(f"{snap['time']}-{snap['hash'][:12]}.gz")) as fp:
+        assert json.load(fp)["hash"] == snap["hash"]
 
 def test_remove_snap(tmpdir):
     """
@@ -62,3 +67,398 @@ def test_remove_snap(tmpdir):
 
     assert len(store.get_index()) == 0
     assert not store_path.joinpath(str(snap["time"])).exists()
+
+    with pytest.raises(KeyError):
+        store.remove_snapshot(snap["hash"])
+
+def test_index_persists(tmpdir):
+    """
+    Test that a fresh store reads the index without opening snapshot files
+    """
+
+    store_path = Path(tmpdir.join("store"))
+    store = StoreDirectory(store_path)
+
+    snap = {
+        "time": time.time(),
+        "identifier": "Test snapshot",
+        "hash": "some-hash-here",
+        "items": []
+    }
+
+    store.add_snapshot(snap)
+    snap_file = store_path.joinpath(store.get_index()[0]["file"])
+
+    # Corrupt the snapshot file, listing should still work
+    snap_file.write_bytes(b"not a gzip file")
+    store = StoreDirectory(store_path)
+    assert [it["hash"] for it in store.get_index()] == [snap["hash"]]
+    assert store.get_index()[0]["identifier"] == snap["identifier"]
+
+def test_index_rebuild(tmpdir):
+    """
+    Test that index is built for stores without one
+    """
+
+    store_path = Path(tmpdir.join("store"))
+    store_path.mkdir()
+
+    snap = {
+        "time": 1234,
+        "hash": "some-hash-here",
+        "items": []
+    }
+
+    with gzip.open(store_path.joinpath("1234.gz"), "w") as fp:
+        fp.write(json.dumps(snap).encode("utf-8"))
+
+    store = StoreDirectory(store_path)
+    assert store_path.joinpath(StoreDirectory.INDEX_FILE).is_file()
+    assert store.get_index()[0]["hash"] == snap["hash"]
+    assert store.get_snapshot(snap["hash"]) == snap
+    assert store.get_snapshot("missing-hash") is None
+
+def test_index_rebuild_inline(tmpdir):
+    """
+    Test that snapshots with inline data from older versions are converted
+    to blobs when the index is built
+    """
+
+    store_path = Path(tmpdir.join("store"))
+    store_path.mkdir()
+
+    snap = {
+        "time": 1234,
+        "hash": "some-hash-here",
+        "items": [{"watcher": "one", "data": [1, 2]}, {"watcher": "two", "data": {"a": 3}}]
+    }
+
+    with gzip.open(store_path.joinpath("1234.gz"), "w") as fp:
+        fp.write(json.dumps(snap).encode("utf-8"))
+
+    store = StoreDirectory(store_path)
+    assert store.get_snapshot(snap["hash"]) == snap
+    assert store.get_snapshot(snap["hash"], ["two"])["items"] == snap["items"][1:]
+    assert len(list(store_path.joinpath("blobs").glob("*/*.gz"))) == 2
+
+    with gzip.open(store_path.joinpath("1234.gz")) as fp:
+        manifest = json.loads(fp.read().decode("utf-8"))
+    assert all("blob" in item and "data" not in item for item in manifest["items"])
+
+    store.remove_snapshot(snap["hash"])
+    assert len(list(store_path.joinpath("blobs").glob("*/*.gz"))) == 0
+
+def test_snapshot_cache(tmpdir):
+    """
+    Test that decoded watcher data is cached within the budget
+    """
+
+    store_path = Path(tmpdir.join("store"))
+    store = StoreDirectory(store_path)
+
+    snaps = [{
+        "time": idx,
+        "hash": f"hash-{idx}",
+        "items": [{"watcher": "w", "data": str(idx) * 100}]
+    } for idx in range(3)]
+
+    for snap in snaps:
+        store.add_snapshot(snap)
+
+    digest = lambda idx: store.load_manifest(f"hash-{idx}")["items"][0]["blob"]
+
+    store = StoreDirectory(store_path, cache_size=250)
+    store.get_snapshot("hash-0")
+    store.get_snapshot("hash-0")
+    assert (store.cache.hits, store.cache.misses) == (1, 1)
+
+    # Only two blobs fit in the budget, least recently used goes out
+    store.get_snapshot("hash-1")
+    store.get_snapshot("hash-2")
+    assert store.cache.current_bytes <= 250
+    assert digest(0) not in store.cache.items
+    assert digest(2) in store.cache.items
+    assert store.get_snapshot("hash-0") == snaps[0]
+
+def test_partial_read(tmpdir):
+    """
+    Test that only asked watchers are read from a snapshot
+    """
+
+    store_path = Path(tmpdir.join("store"))
+    store = StoreDirectory(store_path)
+
+    snap = {
+        "time": 0,
+        "hash": "hash-0",
+        "items": [{"watcher": "one", "data": 1}, {"watcher": "two", "data": 2}]
+    }
+    store.add_snapshot(snap)
+
+    # Break blob of watcher two, reading watcher one should still work
+    manifest = store.load_manifest("hash-0")
+    store.blob_file(manifest["items"][1]["blob"]).write_bytes(b"broken")
+
+    store = StoreDirectory(store_path)
+    assert store.get_snapshot("hash-0", watchers=["one"])["items"] == [{"watcher": "one", "data": 1}]
+
+def test_blob_dedup(tmpdir):
+    """
+    Test that unchanged watcher data is stored once and cleaned up on removal
+    """
+
+    store_path = Path(tmpdir.join("store"))
+    store = StoreDirectory(store_path)
+
+    same_item = {"watcher": "same", "data": {"config": [], "data": [1, 2, 3]}}
+    snaps = [{
+        "time": idx,
+        "hash": f"hash-{idx}",
+        "items": [same_item, {"watcher": "changing", "data": idx}]
+    } for idx in range(2)]
+
+    for snap in snaps:
+        store.add_snapshot(snap)
+
+    blob_files = lambda: list(store_path.joinpath("blobs").glob("*/*.gz"))
+    assert len(blob_files()) == 3
+
+    store = StoreDirectory(store_path)
+    assert store.get_snapshot("hash-0") == snaps[0]
+    assert store.get_snapshot("hash-1") == snaps[1]
+
+    store.remove_snapshot("hash-0")
+    assert len(blob_files()) == 2
+    assert store.get_snapshot("hash-1") == snaps[1]
+
+    store.remove_snapshot("hash-1")
+    assert len(blob_files()) == 0
+
+def test_hash_blobs(tmpdir):
+    """
+    Test that big packed hash arrays are kept in their own blobs which can be
+    streamed, and are cleaned up on removal
+    """
+
+    store_path = Path(tmpdir.join("store"))
+    store = StoreDirectory(store_path)
+    store.hash_blob_size = 32
+
+    big = HashArray.from_hex([md5(i) for i in range(10)], 4)
+    small = HashArray.from_hex([md5(i) for i in range(2)], 4)
+    snaps = [{
+        "time": idx,
+        "hash": f"hash-{idx}",
+        "items": [{"watcher": "w", "data": {"config": [], "data": [["a", big.to_json()], ["b", small.to_json()], ["c", idx]]}}]
+    } for idx in range(2)]
+
+    for snap in snaps:
+        store.add_snapshot(snap)
+
+    hashes_files = lambda: list(store_path.joinpath("blobs").glob("*/*.hashes"))
+    assert len(hashes_files()) == 1
+
+    store = StoreDirectory(store_path)
+    assert store.get_snapshot("hash-0") == snaps[0]
+
+    data = store.get_snapshot("hash-0", lazy_hashes=True)["items"][0]["data"]["data"]
+    assert isinstance(data[0][1], HashBlob)
+    assert list(data[0][1]) == list(big)
+    assert data[1][1] == small.to_json()
+
+    store.rebuild_index()
+    store.remove_snapshot("hash-0")
+    assert len(hashes_files()) == 1
+    assert store.get_snapshot("hash-1") == snaps[1]
+
+    store.remove_snapshot("hash-1")
+    assert len(hashes_files()) == 0
+
+def test_delta_chain(tmpdir):
+    """
+    Test that delta mode writes keyframes and reconstructs snapshots
+    """
+
+    store_path = Path(tmpdir.join("store"))
+    store = StoreDirectory(store_path, keyframe_interval=3)
+
+    hashes = [f"{idx:032x}" for idx in range(200)]
+    snaps = []
+    for idx in range(5):
+        hashes = hashes[1:] + [f"{1000 + idx:032x}"]
+        snaps.append({
+            "time": idx,
+            "hash": f"hash-{idx}",
+            "items": [{
+                "watcher": "number-of-rows-hash",
+                "data": {"config": [{"table": "t"}], "data": [["t", list(hashes)]]}
+            }]
+        })
+        store.add_snapshot(snaps[-1])
+
+    depths = sorted(blob.get("depth", 0) for blob in store.blobs.values())
+    assert depths == [0, 0, 1, 1, 2]
+    assert len(list(store_path.joinpath("blobs").glob("*/*.delta.gz"))) == 3
+
+    # Rebuilt index should know about the chains too
+    store_path.joinpath(StoreDirectory.INDEX_FILE).unlink()
+    store = StoreDirectory(store_path, keyframe_interval=3)
+    for snap in snaps:
+        assert store.get_snapshot(snap["hash"]) == snap
+
+    # Rebuilt deltas are charged at least the size of their data in the cache
+    data_size = len(json.dumps(snaps[-1]["items"][0]["data"], sort_keys=True))
+    assert all(size >= data_size for _, size in store.cache.items.values())
+
+    # Bases stay around as long as a delta needs them
+    for snap in snaps[:-1]:
+        store.remove_snapshot(snap["hash"])
+    assert store.get_snapshot(snaps[-1]["hash"]) == snaps[-1]
+    store.remove_snapshot(snaps[-1]["hash"])
+    assert len(list(store_path.joinpath("blobs").glob("*/*.gz"))) == 0
+
+def test_delta_types():
+    """
+    Test that deltas keep values which compare equal but serialize
+    differently, like True, 1 and 1.0
+    """
+
+    base = {"a": [1, True, 1.0, [1]], "b": 1, "c": [["k", 0]]}
+    target = {"a": [True, 1.0, 1, [True]], "b": 1.0, "c": [["k", False]]}
+
+    rebuilt = apply_delta(base, make_delta(base, target))
+    assert json.dumps(rebuilt, sort_keys=True) == json.dumps(target, sort_keys=True)
+    assert make_delta(base, base) == {"op": "same"}
+
+def test_writer_abort(tmpdir):
+    """
+    Test that an aborted snapshot leaves nothing behind
+    """
+
+    store_path = Path(tmpdir.join("store"))
+    store = StoreDirectory(store_path)
+
+    store.add_snapshot({"time": 0, "hash": "hash-0", "items": [{"watcher": "w", "data": 0}]})
+
+    writer = store.begin_snapshot()
+    writer.add_item("w", 0)
+    writer.add_item("v", [1, 2, 3], json.dumps([1, 2, 3]))
+    writer.abort()
+
+    assert len(list(store_path.joinpath("blobs").glob("*/*.gz"))) == 1
+    assert [it["hash"] for it in store.get_index()] == ["hash-0"]
+    assert store.get_snapshot("hash-0")["items"] == [{"watcher": "w", "data": 0}]
+
+def test_concurrent_writers(tmpdir):
+    """
+    Test that two stores on the same path see each other's commits and that
+    blobs of a pending save survive a parallel removal
+    """
+
+    store_path = Path(tmpdir.join("store"))
+    store_a = StoreDirectory(store_path)
+    store_b = StoreDirectory(store_path)
+
+    writer_a = store_a.begin_snapshot()
+    writer_a.add_item("w", [1, 2, 3])
+
+    store_b.add_snapshot({"time": 0, "hash": "hash-b", "items": [{"watcher": "w", "data": [1, 2, 3]}]})
+    assert writer_a.commit({"time": 0, "hash": "hash-a"})
+
+    # Same hash from another process is not added again
+    writer_b = store_b.begin_snapshot()
+    writer_b.add_item("w", [1, 2, 3])
+    assert not writer_b.commit({"time": 1, "hash": "hash-a"})
+
+    assert sorted(it["hash"] for it in store_b.get_index()) == ["hash-a", "hash-b"]
+    store_a.remove_snapshot("hash-b")
+    assert store_b.get_snapshot("hash-a")["items"] == [{"watcher": "w", "data": [1, 2, 3]}]
+    assert len(list(store_path.rglob(".*.tmp"))) == 0
+
+def test_remove_during_save(tmpdir):
+    """
+    Test that a removal doesn't wait for a save in progress nor collect its
+    blobs, and that markers of crashed saves are cleaned up
+    """
+
+    store_path = Path(tmpdir.join("store"))
+    store_a = StoreDirectory(store_path, keyframe_interval=3)
+    store_b = StoreDirectory(store_path)
+
+    store_b.add_snapshot({"time": 0, "hash": "hash-0", "items": [{"watcher": "w", "data": list(range(100))}]})
+
+    # Writer a uses the blob of hash-0 as delta base and writes its own
+    writer_a = store_a.begin_snapshot()
+    writer_a.add_item("w", list(range(101)))
+    writer_a.add_item("v", [1, 2, 3])
+
+    # Removing hash-0 doesn't block (the lock would raise otherwise) and
+    # leaves the blobs writer a needs
+    with store_b.lock(store_b.GC_LOCK, blocking=False):
+        pass
+    store_b.remove_snapshot("hash-0")
+    assert writer_a.commit({"time": 1, "hash": "hash-1"})
+
+    store_b.load_index()
+    snap = store_b.get_snapshot("hash-1")
+    assert snap["items"] == [{"watcher": "w", "data": list(range(101))}, {"watcher": "v", "data": [1, 2, 3]}]
+    assert list(store_path.joinpath(StoreDirectory.PENDING_DIR).glob("*")) == []
+
+    # A crashed save leaves an unlocked marker and an unreferenced blob
+    writer = store_a.begin_snapshot()
+    writer.add_item("u", [4, 5])
+    writer.marker.close()
+
+    store_b.add_snapshot({"time": 2, "hash": "hash-2", "items": []})
+    store_b.remove_snapshot("hash-2")
+    assert list(store_path.joinpath(StoreDirectory.PENDING_DIR).glob("*")) == []
+    store_b.remove_snapshot("hash-1")
+    assert len(list(store_path.joinpath("blobs").glob("*/*.gz"))) == 0
+
+def test_remove_base_chain_during_save(tmpdir):
+    """
+    Test that a removal keeps the whole base chain of a pending delta base
+    """
+
+    store_path = Path(tmpdir.join("store"))
+    store_a = StoreDirectory(store_path, keyframe_interval=5)
+
+    for idx in range(2):
+        store_a.add_snapshot({"time": idx, "hash": f"hash-{idx}", "items": [{"watcher": "w", "data": list(range(100 + idx))}]})
+    store_a.remove_snapshot("hash-0")
+
+    # The base of writer a is a delta over the blob of hash-0
+    writer_a = store_a.begin_snapshot()
+    store_b = StoreDirectory(store_path)
+    store_b.remove_snapshot("hash-1")
+
+    writer_a.add_item("w", list(range(102)))
+    assert writer_a.commit({"time": 2, "hash": "hash-2"})
+
+    store_b.load_index()
+    assert store_b.get_snapshot("hash-2")["items"] == [{"watcher": "w", "data": list(range(102))}]
+
+@pytest.mark.parametrize("codec", ["gzip:1", "lzma:6", "zlib:6", "zlib:6:dict", "none"])
+def test_codecs(tmpdir, codec):
+    """
+    Test that snapshots written with any codec read back in any store
+    """
+
+    store_path = Path(tmpdir.join("store"))
+    store = StoreDirectory(store_path, codec=codec)
+
+    snaps = [{
+        "time": idx,
+        "hash": f"hash-{idx}",
+        "items": [{"watcher": "w", "data": {"config": ["scm"], "data": [["scm", ["tab", idx]]]}}]
+    } for idx in range(3)]
+
+    for snap in snaps:
+        store.add_snapshot(snap)
+
+    if codec.endswith(":dict"):
+        assert store.current_zdict_id() is not None
+
+    store = StoreDirectory(store_path)
+    for snap in snaps:
+        assert store.get_snapshot(snap["hash"]) == snap
@@ -0,0 +1,124 @@
+"""
+Tests for sqlite store
+"""
+
+from diffport.hashes import HashArray, HashBlob
+from diffport.store import StoreSQLite
+from pathlib import Path
+import pytest
+import time
+
+from .helpers import md5
+
+
+def test_create_db(tmpdir):
+    """
+    Test that store is creating the database file
+    """
+
+    store_path = Path(tmpdir.join("store"))
+    store = StoreSQLite(store_path)
+    assert store_path.joinpath(StoreSQLite.DB_FILE).is_file()
+
+def test_add_snap(tmpdir):
+    """
+    Test that snapshot is added and persists
+    """
+
+    store_path = Path(tmpdir.join("store"))
+    store = StoreSQLite(store_path)
+
+    snap = {
+        "time": time.time(),
+        "identifier": "Test snapshot",
+        "hash": "some-hash-here",
+        "items": [{"watcher": "w", "data": {"config": [], "data": [["t", 1]]}}]
+    }
+
+    store.add_snapshot(snap)
+    assert store.has_snapshot(snap["hash"])
+    assert not store.has_snapshot("other-hash")
+
+    store = StoreSQLite(store_path)
+    assert len(store.get_index()) == 1
+    assert store.get_index()[0]["hash"] == snap["hash"]
+    assert store.get_snapshot(snap["hash"]) == snap
+
+    # Integer times come back as integers
+    store.add_snapshot({"time": 5, "hash": "int-time", "items": []})
+    assert store.get_snapshot("int-time") == {"time": 5, "hash": "int-time", "items": []}
+    assert isinstance(store.get_snapshot("int-time")["time"], int)
+    assert store.get_snapshot("other-hash") is None
+
+def test_remove_snap(tmpdir):
+    """
+    Test that snap removal works and drops unused blobs
+    """
+
+    store_path = Path(tmpdir.join("store"))
+    store = StoreSQLite(store_path)
+
+    same_item = {"watcher": "same", "data": [1, 2, 3]}
+    snaps = [{
+        "time": idx,
+        "hash": f"hash-{idx}",
+        "items": [same_item, same_item, {"watcher": "changing", "data": idx}]
+    } for idx in range(2)]
+
+    for snap in snaps:
+        store.add_snapshot(snap)
+
+    count_blobs = lambda: store.conn.execute("SELECT count(*) FROM blobs").fetchone()[0]
+    assert count_blobs() == 3
+
+    store.remove_snapshot("hash-0")
+    assert [it["hash"] for it in store.get_index()] == ["hash-1"]
+    assert count_blobs() == 2
+    assert store.get_snapshot("hash-1") == snaps[1]
+
+    store.remove_snapshot("hash-1")
+    assert len(store.get_index()) == 0
+    assert count_blobs() == 0
+
+    with pytest.raises(KeyError):
+        store.remove_snapshot("hash-1")
+
+def test_hash_blobs(tmpdir, monkeypatch):
+    """
+    Test that big packed hash arrays are kept in chunks which can be streamed
+    """
+
+    # Chunks smaller than a digest
+    monkeypatch.setattr("diffport.store.CHUNK_SIZE", 3)
+
+    store_path = Path(tmpdir.join("store"))
+    store = StoreSQLite(store_path)
+    store.hash_blob_size = 32
+
+    big = HashArray.from_hex([md5(i) for i in range(10)], 4)
+    snaps = [{
+        "time": idx,
+        "hash": f"hash-{idx}",
+        "items": [{"watcher": "w", "data": idx}, {"watcher": "v", "data": [big.to_json(), big.to_json()]}]
+    } for idx in range(2)]
+
+    for snap in snaps:
+        store.add_snapshot(snap)
+
+    count_chunks = lambda: store.conn.execute("SELECT count(*) FROM hash_chunks").fetchone()[0]
+    assert count_chunks() == 14
+    assert list(store_path.iterdir()) == [store_path.joinpath(StoreSQLite.DB_FILE)]
+
+    store = StoreSQLite(store_path)
+    assert store.get_snapshot("hash-1") == snaps[1]
+
+    data = store.get_snapshot("hash-1", watchers=["v"], lazy_hashes=True)["items"][0]["data"]
+    assert isinstance(data[0], HashBlob)
+    assert list(data[0]) == list(big)
+
+    store.remove_snapshot("hash-0")
+    assert count_chunks() == 14
+    assert store.get_snapshot("hash-1") == snaps[1]
+
+    store.remove_snapshot("hash-1")
+    assert count_chunks() == 0
@@ -4,10 +4,13 @@ Tests for watchers
 
 from diffport.core import Diffport
 from diffport.watchers import *
+from diffport.hashes import HashArray
+from .helpers import md5
 from pathlib import Path
 from random import random, randint
 import pytest
 import dataset
+import json
 
 
 @pytest.fixture
@@ -29,6 +32,21 @@ def pgurl(request):
     return url
 
 
+def grouped_hashes(seed, width=None):
+    """
+    Return grouped hash lists for a few groups, some groups left out
+    depending on seed. Hashes are packed if width is given.
+    """
+
+    groups = []
+    for group in range(20):
+        if (group + seed) % 7 == 0:
+            continue
+        hashes = [md5(randint(0, 40)) for _ in range(randint(0, 30))]
+        groups.append([[f"g{group}"], HashArray.from_hex(hashes, width).to_json() if width else hashes])
+    return groups
+
+
 def get_diffp(path, config, url):
     """
     Return a diffport instance
@@ -152,6 +170,148 @@ class TestNumberOfRowsHash:
         report = NumberOfRowsHash.report(diff)
         assert diffp.report(old_hash, new_hash).endswith(report)
 
+    def test_diff_aggregated(self, tmpdir, pgurl):
+        config = [{
+            "name": "number-of-rows-hash",
+            "config": [{"groupby": ["g_one", "g_two"], "table": "table_grouped", "aggregate": True}]
+        }]
+        diffp = get_diffp(tmpdir, config, pgurl)
+        self.init_db(diffp.db)
+        self.seed_db(diffp.db)
+        old_hash = diffp.save_snapshot()
+        self.add_rows(diffp.db)
+        self.remove_rows(diffp.db)
+        new_hash = diffp.save_snapshot()
+        self.clean_db(diffp.db)
+
+        # Unchanged group is taken from the old snapshot
+        old_groups = diffp.store.get_snapshot(old_hash)["items"][0]["data"]["data"][0][1]
+        new_groups = diffp.store.get_snapshot(new_hash)["items"][0]["data"]["data"][0][1]
+        assert [g for g in old_groups if g[0] == ["elec", "c"]] == [g for g in new_groups if g[0] == ["elec", "c"]]
+
+        diff = {
+            "config": config[0]["config"],
+            "data": [
+                ["table_grouped",
+                 [(['elec', 'a'], {"removed": 1, "added": 1}),
+                  (['mech', 'x'], {"removed": 2, "added": 0}),
+                  (['mech', 'y'], {"removed": 0, "added": 2}),
+                  (['elec', 'b'], {"removed": 20, "added": 0}),
+                  (['mech', 'z'], {"removed": 0, "added": 3})],
+                 "grouped"]
+            ]
+        }
+        report = NumberOfRowsHash.report(diff)
+        assert diffp.report(old_hash, new_hash).endswith(report)
+
+    def test_diff_hash_array(self):
+        """
+        Test that packed hash arrays diff like hex lists, also when mixed
+        """
+
+        old_hashes = [md5(idx) for idx in [1, 2, 3, 3, 4]]
+        new_hashes = [md5(idx) for idx in [3, 4, 5, 6, 6, 7]]
+        config = [{"table": "table_basic", "hash_bytes": 8}]
+        expected = [["table_basic", {"removed": 2, "added": 3}, "basic"]]
+
+        packed_old = HashArray.from_hex(old_hashes, 8).to_json()
+        packed_new = HashArray.from_hex(new_hashes, 16).to_json()
+
+        for old, new in [(old_hashes, new_hashes), (packed_old, packed_new), (old_hashes, packed_new)]:
+            diff = NumberOfRowsHash.diff(
+                {"config": config, "data": [("table_basic", old)]},
+                {"config": config, "data": [("table_basic", new)]}
+            )
+            assert diff["data"] == expected
+
+
+    def test_diff_buckets(self):
+        """
+        Test that bucketed hashes diff like flat lists, including buckets
+        with same digest and fallback for different prefixes
+        """
+
+        def bucketed(hashes, prefix, width=None):
+            buckets = {} # type: Dict[str, List[str]]
+            for h in hashes:
+                buckets.setdefault(h[:prefix], []).append(h)
+            return {"prefix": prefix, "buckets": [
+                [key, len(bucket), md5(sorted(bucket)),
+                 HashArray.from_hex(bucket, width).to_json() if width else bucket]
+                for key, bucket in sorted(buckets.items())
+            ]}
+
+        old_hashes = [md5(idx) for idx in range(100)]
+        new_hashes = [md5(idx) for idx in range(10, 130)]
+        config = [{"table": "table_basic", "buckets": 1}]
+        expected = [["table_basic", {"removed": 10, "added": 30}, "basic"]]
+
+        for old, new in [(bucketed(old_hashes, 1), bucketed(new_hashes, 1)),
+                         (bucketed(old_hashes, 1, 8), bucketed(new_hashes, 1, 8)),
+                         (bucketed(old_hashes, 1), bucketed(new_hashes, 2, 8)),
+                         (old_hashes, bucketed(new_hashes, 2))]:
+            diff = NumberOfRowsHash.diff(
+                {"config": config, "data": [("table_basic", old)]},
+                {"config": config, "data": [("table_basic", new)]}
+            )
+            assert diff["data"] == expected
+
+    def test_diff_aggregated_unordered(self):
+        """
+        Test diff of aggregated groups whose ids are not in python's order
+        """
+
+        config = [{"table": "table_grouped", "groupby": ["g"], "aggregate": True}]
+        old_snap = {"config": config, "data": [("table_grouped", [
+            [["b"], ["h1", "h2"], "d1"], [["A"], ["h3"], "d2"], [[None], ["h4"], "d3"]
+        ])]}
+        new_snap = {"config": config, "data": [("table_grouped", [
+            [["b"], ["h1", "h5"], "d4"], [["A"], ["h3"], "d2"], [["C"], ["h6"], "d5"]
+        ])]}
+
+        diff = NumberOfRowsHash.diff(old_snap, new_snap)
+        assert diff["data"][0][1] == [
+            (["b"], {"removed": 1, "added": 1}),
+            ([None], {"removed": 1, "added": 0}),
+            (["C"], {"removed": 0, "added": 1})
+        ]
+
+    def test_diff_vectorized(self, monkeypatch):
+        """
+        Test that the numpy batch diff gives the same output as the python
+        fallback for grouped, packed and mixed hash lists
+        """
+
+        pytest.importorskip("numpy")
+
+        config = [{"table": "table_grouped", "groupby": ["g"]}]
+        for old_width, new_width in [(None, None), (8, 8), (None, 4)]:
+            old_snap = {"config": config, "data": [("table_grouped", grouped_hashes(0, old_width))]}
+            new_snap = {"config": config, "data": [("table_grouped", grouped_hashes(1, new_width))]}
+
+            vectorized = NumberOfRowsHash.diff(old_snap, new_snap)
+            monkeypatch.setattr("diffport.hashes.np", None)
+            fallback = NumberOfRowsHash.diff(old_snap, new_snap)
+            monkeypatch.undo()
+
+            assert vectorized == fallback
+
+    def test_diff_spill(self):
+        """
+        Test that diffing with hash lists sorted on disk gives the same output
+        as the in memory diff
+        """
+
+        for old_width, new_width in [(None, None), (8, 8), (None, 4)]:
+            old_data = [("table_grouped", grouped_hashes(0, old_width)), ("table_basic", grouped_hashes(2, old_width)[0][1])]
+            new_data = [("table_grouped", grouped_hashes(1, new_width)), ("table_basic", grouped_hashes(3, new_width)[0][1])]
+            config = [{"table": "table_grouped", "groupby": ["g"]}, {"table": "table_basic"}]
+            spill_config = [{**table_config, "spill_memory": 64} for table_config in config]
+
+            in_memory = NumberOfRowsHash.diff({"config": config, "data": old_data}, {"config": config, "data": new_data})
+            spilled = NumberOfRowsHash.diff({"config": config, "data": old_data}, {"config": spill_config, "data": new_data})
+
+            assert spilled["data"] == in_memory["data"]
 
 class TestNumberOfRows:
     """
@@ -448,3 +608,191 @@ class TestTableChange:
         }
         report = TableChange.report(diff)
         assert diffp.report(old_hash, new_hash).endswith(report)
+
+    def test_diff_skip_unchanged(self, tmpdir, pgurl):
+        config = [{"name": "table-change", "config": {**self.config[0]["config"], "skip_unchanged": True}}]
+        diffp = get_diffp(tmpdir, config, pgurl)
+        self.init_db(diffp.db)
+        old_hash = diffp.save_snapshot()
+        self.fill_db(diffp.db)
+        new_hash = diffp.save_snapshot()
+        self.clean_db(diffp.db)
+
+        assert "stats" in diffp.store.get_snapshot(new_hash)["items"][0]["data"]
+
+        diff = {
+            "config": config[0]["config"],
+            "data": self.to_change
+        }
+        report = TableChange.report(diff)
+        assert diffp.report(old_hash, new_hash).endswith(report)
+
+    def test_diff_parallel(self, tmpdir, pgurl):
+        config = [{"name": "table-change", "config": {**self.config[0]["config"], "workers": 3}}]
+        diffp = get_diffp(tmpdir, config, pgurl)
+        self.init_db(diffp.db)
+        old_hash = diffp.save_snapshot()
+        self.fill_db(diffp.db)
+        new_hash = diffp.save_snapshot()
+        self.clean_db(diffp.db)
+
+        diff = {
+            "config": config[0]["config"],
+            "data": self.to_change
+        }
+        report = TableChange.report(diff)
+        assert diffp.report(old_hash, new_hash).endswith(report)
+
+    def test_diff_unordered(self, tmpdir, pgurl):
+        config = [{"name": "table-change", "config": {**self.config[0]["config"], "digest": "unordered"}}]
+        diffp = get_diffp(tmpdir, config, pgurl)
+        self.init_db(diffp.db)
+        old_hash = diffp.save_snapshot()
+        self.fill_db(diffp.db)
+        new_hash = diffp.save_snapshot()
+        self.clean_db(diffp.db)
+
+        diff = {
+            "config": config[0]["config"],
+            "data": self.to_change
+        }
+        report = TableChange.report(diff)
+        assert diffp.report(old_hash, new_hash).endswith(report)
+
+    def test_diff_digest_modes(self):
+        """
+        Test that digests made in different modes are not compared
+        """
+
+        old = {"config": {}, "data": [["one", "a" * 32], ["two", "b" * 32], ["three", "unordered:2:10"]]}
+        new = {"config": {}, "data": [["one", "a" * 32], ["two", "unordered:2:10"], ["three", "unordered:3:12"]]}
+
+        diff = TableChange.diff(old, new)
+        assert diff["data"] == ["three"]
+        assert diff["skipped"] == ["two"]
+        assert "two" in TableChange.report(diff)
+
+    def test_diff_empty_tables(self):
+        """
+        Test that NULL digests of empty tables diff as ordered digests
+        """
+
+        old = {"config": {}, "data": [["one", None], ["two", None], ["three", "a" * 32]]}
+        new = {"config": {}, "data": [["one", None], ["two", "b" * 32], ["three", None]]}
+
+        diff = TableChange.diff(old, new)
+        assert diff["data"] == ["two", "three"]
+        assert "skipped" not in diff
+        assert digest_mode(None) == "ordered"
+
+    def test_diff_chunked(self, tmpdir, pgurl):
+        config = [{"name": "table-change", "config": {"tables": ["tab_chunked"], "chunks": {"tab_chunked": {"size": 10}}}}]
+        diffp = get_diffp(tmpdir, config, pgurl)
+        diffp.db.query("CREATE TABLE tab_chunked (id INTEGER PRIMARY KEY, num INTEGER);")
+        for idx in range(50):
+            diffp.db.query(f"INSERT INTO tab_chunked VALUES ({idx}, {randint(0, 100)});")
+        old_hash = diffp.save_snapshot()
+        diffp.db.query("UPDATE tab_chunked SET num = -1 WHERE id IN (3, 42);")
+        new_hash = diffp.save_snapshot()
+
+        # Unchanged chunk is carried over without rehashing
+        old_ranges = diffp.store.get_snapshot(old_hash)["items"][0]["data"]["chunks"]["tab_chunked"]["ranges"]
+        new_ranges = diffp.store.get_snapshot(new_hash)["items"][0]["data"]["chunks"]["tab_chunked"]["ranges"]
+        assert old_ranges[1] == new_ranges[1]
+        diffp.db.query("DROP TABLE tab_chunked;")
+
+        diff = {
+            "config": config[0]["config"],
+            "data": ["tab_chunked"],
+            "ranges": {"tab_chunked": {"key": "id", "ranges": [[0, 10], [40, 50]]}}
+        }
+        report = TableChange.report(diff)
+        assert diffp.report(old_hash, new_hash).endswith(report)
+
+    def test_diff_chunk_ranges(self):
+        """
+        Test that diff lists the key ranges whose digests changed
+        """
+
+        def chunks(digests):
+            return {"key": "id", "size": 100, "ranges": [[c, [1, "1"], d] for c, d in digests]}
+
+        old = {"config": {}, "data": [["big", "chunked:a"]], "chunks": {"big": chunks([(0, "a"), (1, "b"), (2, "c")])}}
+        new = {"config": {}, "data": [["big", "chunked:b"]], "chunks": {"big": chunks([(0, "a"), (1, "x"), (3, "d")])}}
+
+        diff = TableChange.diff(old, new)
+        assert diff["ranges"] == {"big": {"key": "id", "ranges": [[100, 200], [200, 300], [300, 400]]}}
+        assert "- big (`id` in [100, 200), [200, 300), [300, 400))" in TableChange.report(diff)
+
+        # Rows with NULL keys are a range of their own
+        new["chunks"]["big"]["ranges"].append([None, [1, "1"], "e"])
+        diff = TableChange.diff(old, new)
+        assert diff["ranges"]["big"]["ranges"][-1] == [None, None]
+        assert "[300, 400), NULL)" in TableChange.report(diff)
+
+
+def test_split_items():
+    """
+    Test that split_items matches the quadratic lookups it replaced, for
+    sorted, unsorted and repeating identifiers
+    """
+
+    def reference(a, b):
+        common_a, common_b = [], []
+        for item_id, item_data in a:
+            matches = [it for it in b if it[0] == item_id]
+            if matches:
+                common_a.append((item_id, item_data))
+                common_b.append((item_id, matches[0][1]))
+        only_a = [it for it in a if it[0] not in [x[0] for x in b]]
+        only_b = [it for it in b if it[0] not in [x[0] for x in a]]
+        return common_a, common_b, only_a, only_b
+
+    for trial in range(50):
+        a = [[[randint(0, 5), str(randint(0, 3))], idx] for idx in range(randint(0, 20))]
+        b = [[[randint(0, 5), str(randint(0, 3))], -idx] for idx in range(randint(0, 20))]
+        if trial % 2 == 0:
+            # Sorted and unique, as from the watcher queries
+            a = sorted({json.dumps(it[0]): it for it in a}.values())
+            b = sorted({json.dumps(it[0]): it for it in b}.values())
+        assert split_items(a, b) == reference(a, b)
+
+    # Incomparable identifiers fall back to the hash join
+    a = [[[None, 1], 1], [[2, 1], 2]]
+    b = [[[2, 1], 3], [["x", None], 4]]
+    assert split_items(a, b) == reference(a, b)
+
+    # Sorted sides with identifiers not comparable across the two
+    a, b = [[["x"], 1]], [[[1], 3]]
+    assert split_items(a, b) == reference(a, b)
+
+    # Aggregated groups carry a digest after the data, with ids in database
+    # collation order or with NULLs going through the hash join
+    for a, b in [
+        ([[["b"], [1], "d1"], [["A"], [2], "d2"]], [[["b"], [3], "d3"], [["C"], [4], "d4"]]),
+        ([[[None], [1], "d1"], [["x"], [2], "d2"]], [[["x"], [3], "d3"]])
+    ]:
+        common_a, common_b, only_a, only_b = split_items(a, b)
+        assert [it[1] for it in common_a] == [[1] if a[0][0] == ["b"] else [2]]
+        assert [it[1] for it in common_b] == [[3]]
+        assert len(only_a) == 1 and len(only_b) == len(b) - 1
+
+def test_group_runs():
+    """
+    Test that ordered rows are grouped by runs of equal group values
+    """
+
+    rows = [
+        {"a": 1, "b": "x", "hash": "h1"},
+        {"a": 1, "b": "x", "hash": "h2"},
+        {"a": 1, "b": "y", "hash": "h3"},
+        {"a": 2, "b": None, "hash": "h4"},
+        {"a": 2, "b": None, "hash": "h5"}
+    ]
+
+    assert list(group_runs(iter(rows), ["a", "b"], "hash")) == [
+        [[1, "x"], ["h1", "h2"]],
+        [[1, "y"], ["h3"]],
+        [[2, None], ["h4", "h5"]]
+    ]
+    assert list(group_runs(iter([]), ["a"], "hash")) == []